@@ -0,0 +1,75 @@
+# compare heart beats recorded by Firstbeat and E4 (IBI.csv)
+import os
+import warnings
+import pandas as pd
+import numpy as np
+from preprocess_modules import utilities_hrv as hrvutils
+from preprocess_modules import utilities_e4 as e4utils
+from preprocess_modules import utilities_crossdevice as cdutils
+from preprocess_modules import utilities_catalog as catalogutils
+
+main_dir = r"P:\Spironolactone\main_qualtrics"
+main_filename = "main_dat21.csv"
+hrv_dir = r"P:\Spironolactone\Firstbeat"
+e4_dir = r"P:\Spironolactone\E4"
+# max secs between beats for them to count as the same beat
+tolerance = 0.15
+# max secs the estimated clock offset may differ from the qualtrics/E4 header based one
+max_offset = 300
+# index of input files, updated on every run (None = scan without saving)
+catalog_path = os.path.join(os.path.expanduser("~"),".spironolactone_cache","catalog.json")
+
+# paths to input files
+catalog = catalogutils.refresh_catalog({"firstbeat": hrv_dir, "e4": e4_dir}, catalog_path)
+duplicates = catalogutils.get_duplicates(catalog, "e4")
+
+output_dir = os.path.join(hrv_dir,"processed_hrv_files")
+os.makedirs(output_dir, exist_ok = True)
+output_names = ["clock_offsets.csv","beat_agreement.csv"]
+existing = [name for name in output_names if os.path.exists(os.path.join(output_dir,name))]
+if existing:
+    warnings.warn(f"Output files will be overwritten: {', '.join(existing)}. Manual check advised.")
+
+# read in qualtrics file and make interval table
+boundaries, pnum_rows, interval_names, firstbeat_starts, _ = hrvutils.load_interval_table(
+                                                                            os.path.join(main_dir,main_filename)
+                                                                            )
+
+agreement_dfs = []
+offsets = []
+for pnum in catalogutils.get_pnums(catalog, "e4"):
+    if pnum not in pnum_rows or pnum in duplicates:
+        continue
+    try:
+        hrv_rec = catalogutils.get_path(catalog, "firstbeat", pnum)
+        e4_start, e4_ibi = e4utils.read_e4_ibi(os.path.join(catalogutils.get_path(catalog, "e4", pnum),"IBI.csv"))
+    except (IndexError, FileNotFoundError):
+        print(f"Firstbeat or E4 IBI file missing for participant {pnum}. Skipping.")
+        continue
+    hrv_df = hrvutils.read_hrv_record(hrv_rec)
+    fb_times = hrvutils.get_beat_times(hrv_df.IB_intervals)
+    row = pnum_rows[pnum]
+    # qualtrics/E4 header based guess, refined from the beats themselves
+    initial_offset = e4utils.get_clock_offset(e4_start, firstbeat_starts[row])
+    if np.isnan(initial_offset):
+        initial_offset = 0
+    offset, match_rate = cdutils.estimate_clock_offset(
+                                                        fb_times, e4_ibi[:,0], initial_offset,
+                                                        max_offset = max_offset, tolerance = tolerance
+                                                        )
+    if match_rate < 0.5:
+        print(f"Only {match_rate:.0%} of Firstbeat beats matched for participant {pnum}. Manual check advised.")
+    offsets.append([pnum, initial_offset, offset, match_rate])
+    agreement_df = cdutils.get_beat_agreement(
+                                            fb_times, e4_ibi[:,0], boundaries[row],
+                                            interval_names, offset, tolerance
+                                            )
+    agreement_df.insert(0, "participant_number", pnum)
+    agreement_dfs.append(agreement_df)
+
+# save to file
+offsets_df = pd.DataFrame(offsets, columns = ["participant_number","initial_offset","offset","match_rate"])
+offsets_df.to_csv(os.path.join(output_dir,"clock_offsets.csv"),index = False)
+if agreement_dfs:
+    pd.concat(agreement_dfs, ignore_index = True).to_csv(os.path.join(output_dir,"beat_agreement.csv"),index = False)
+print(offsets_df)
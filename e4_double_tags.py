@@ -1,92 +1,90 @@
 import os
-import re
 from datetime import datetime
-import pandas as pd
 import numpy as np
 from preprocess_modules import utilities_e4 as e4
 from preprocess_modules import utilities_hrv as hrvutils
 from preprocess_modules import utilities as dutils
+from preprocess_modules import utilities_catalog as catalogutils
 
 input_dir = r"P:\Spironolactone\E4"
 main_dir = r"P:\Spironolactone\main_qualtrics"
-participant_folders = os.listdir(input_dir)
-participant_folders = [f for f in participant_folders if re.search("^p[0][0-9][0-9]",f.lower())] 
+# number of threads for reading tag files
+n_workers = 8
+# index of input files, updated on every run (None = scan without saving)
+catalog_path = os.path.join(os.path.expanduser("~"),".spironolactone_cache","catalog.json")
 
 # get relevant cols from the main qualtrics session file
-col_list =  ["Status","Finished","DQ-1","Firstbeat_on_time", "MUSIC-T1"]
-new_names = ["response_type","finished","participant_number","firstbeat_start","music_start"]
-qualtrics_df = pd.read_csv(os.path.join(main_dir,"main_dat.csv"),usecols =col_list,skiprows= [1,2])
+col_list =  [
+            "Status","Finished","DQ-1","Firstbeat_on_time","baseline start","baseline end",
+            "Q645","Q646","FILM-START","Q648","Q649","MUSIC-T1"
+            ]
+new_names = [
+            "response_type","finished","participant_number","firstbeat_start","RT1_start","RT1_end",
+            "RT2_start","RT2_end","Film_start","RT3_start","RT3_end","music_start"
+            ]
+# participant ids as float, times as strings (parsed by convert_time_cols)
+qualtrics_dtypes = {"DQ-1": "float64", **{col: "string" for col in col_list[3:]}}
+qualtrics_df = dutils.read_qualtrics(os.path.join(main_dir,"main_dat.csv"), names = col_list, dtype = qualtrics_dtypes)
 qualtrics_df.columns = new_names
 qualtrics_df = hrvutils.remove_invalid_records(qualtrics_df, "participant_number",[1])
 qualtrics_df = dutils.remove_incomplete_rows(qualtrics_df, "finished")
 qualtrics_df = qualtrics_df.drop(labels = ["response_type","finished"], axis = 1)
-# get time difference between qualtrics firstbeat on and music start time stamps
 qualtrics_df = hrvutils.convert_time_cols(qualtrics_df)
-qualtrics_df["time_delta"] = qualtrics_df["music_start"]- qualtrics_df["firstbeat_start"]
+qualtrics_df = hrvutils.add_end_time(qualtrics_df,"Film_start",15)
 
-# load tag file for each participant and construct tags dataframe
-missing_tags = []
-pnums = []
-tags_dat = []
-duplicates = e4.flag_duplicates(participant_folders)
-below_min = []
+# load tag file for each participant and construct tags array (tags x participants)
+catalog = catalogutils.refresh_catalog({"e4": input_dir}, catalog_path)
+participant_folders = sorted(catalog["modalities"]["e4"]["entries"])
+tags_arr, pnums, tag_flags = e4.load_tag_files(
+                                            input_dir, min_tags = 14, n_workers = n_workers,
+                                            participant_folders = participant_folders
+                                            )
+duplicates = tag_flags["duplicates"]
+missing_tags = tag_flags["missing"]
+below_min = tag_flags["below_min"]
 
-for folder in participant_folders:
-    pnum = e4.get_participant_num(folder)
-    if pnum in duplicates:
-        print(f"More than one tag file exists for participant {pnum}. Skipping.")
-        continue
-    try:
-        tags_df = pd.read_csv(os.path.join(input_dir,folder,"tags.csv"),header = 0,names = [pnum])
-    except FileNotFoundError:
-        print(f"No tags file found for participant {pnum}.Manual check advised.")
-        missing_tags.append(pnum)
-        continue
-    if tags_df.shape[0]<14:
-        print(f"Participant {pnum} recorded fewer than the minimum number of tags. Manual check advised.")
-        below_min.append(pnum)
-        continue
-    pnums.append(pnum)
-    tags_dat.append(tags_df)
-
-tags_df = pd.concat(tags_dat,axis = 1,keys =[pnum for pnum in pnums])
-tags_df = e4.remove_multindex(tags_df,1,1)
-
-
-tags_diff_df = tags_df.apply(lambda x: e4.get_rowdiff(x))
+tags_diff_df = e4.get_tag_deltas(tags_arr, pnums)
 min_deltas = e4.find_min_delta(tags_diff_df)
-thresholds = np.arange(1.5,5,0.5)
-all_tag_vals = []
-for thresh in thresholds:
-    double_df = e4.return_likely_doubles(min_deltas, tags_diff_df, thresh)
-    tag_vals = e4.get_num_double_tags(double_df)
-    num_twos = tag_vals[2]
-    all_tag_vals.append((num_twos,thresh))
-max_thresh = e4.get_best_thresh(all_tag_vals)
+thresholds = np.arange(1.5,5,0.01)
+num_twos, _ = e4.sweep_double_thresholds(min_deltas, tags_diff_df, thresholds)
+max_thresh = e4.get_best_thresh(num_twos, thresholds)
 double_df = e4.return_likely_doubles(min_deltas, tags_diff_df,max_thresh)
 detect_missing_doubles_df = e4.detect_missing_doubles(double_df)
 
-double_df["Events"] = pd.Series([
-                                "Firstbeat","RT1_start","RT1_end","Drug",
-                                "RT2_start","RT2_end","Film_start","Film_end",
-                                "RT3_start","RT3_end","DT1_music_starts",
-                                "DT2_music_starts"
-                                ])
+# match tags to qualtrics events on one clock (tag times are unix, qualtrics times are time of day)
+# (the qualtrics file has no times for the Drug and DT2_music_starts tags, these are labelled below)
+event_cols = {
+            "Firstbeat": "firstbeat_start", "RT1_start": "RT1_start", "RT1_end": "RT1_end",
+            "RT2_start": "RT2_start", "RT2_end": "RT2_end", "Film_start": "Film_start",
+            "Film_end": "Film_end", "RT3_start": "RT3_start", "RT3_end": "RT3_end",
+            "DT1_music_starts": "music_start"
+            }
+tags_long = e4.tags_to_long(tags_arr, pnums)
+first_tags = tags_long.groupby("participant_number").tag_time.min().to_dict()
+events_long = e4.events_to_unix(qualtrics_df, "participant_number", event_cols, first_tags)
+labelled_tags_df, clock_df = e4.align_tags(tags_long, events_long, tolerance_secs = 120)
+# events without a qualtrics time are labelled by where they fall between the matched events
+labelled_tags_df = e4.label_tags_between(labelled_tags_df, "Drug", "RT1_end", "RT2_start")
+labelled_tags_df = e4.label_tags_between(labelled_tags_df, "DT2_music_starts", "DT1_music_starts")
+# participants for whom not all expected events could be matched to a tag
+unmatched_events = clock_df.loc[clock_df.n_matched<clock_df.n_events, "participant_number"].tolist()
 
 single_tags = e4.check_double_tags(double_df,1)
-print(double_df[double_df.Events.isin(["DT1_music_starts","DT2_music_starts"])])
+print(labelled_tags_df[labelled_tags_df.event.isin(["DT1_music_starts","DT2_music_starts"])])
 
-qualtrics_df = pd.read_csv(os.path.join(main_dir,"main_dat.csv"),skiprows = [1,2],usecols = ["DQ-1", "NOTES"])
+qualtrics_df = dutils.read_qualtrics(os.path.join(main_dir,"main_dat.csv"), names = ["DQ-1", "NOTES"], dtype = {"DQ-1": "float64"})
 qualtrics_df.columns = ["pnum","session_notes"]
 qualtrics_df = qualtrics_df.drop(labels = qualtrics_df[qualtrics_df.session_notes.isna()].index, axis = 0)
 keywords = ["tag","e4"]
 flagged_participants = e4.find_e4_notes(qualtrics_df,"session_notes","pnum",keywords)
 
-manual_check_pnums = e4.check_pnums(flagged_participants,missing_tags,below_min,duplicates)
+manual_check_pnums = e4.check_pnums(flagged_participants,missing_tags,below_min,duplicates,unmatched_events)
 print(f"\nThe following participants had fewer or more than the expected number of double tags:\n{[num for num in detect_missing_doubles_df.pnum]}\n")
 print(f"\nThe following participants are worth checking manually:\n{manual_check_pnums}")
 print("\nA breakdown of reasons:")
 print(f"duplicates:\n{duplicates}")
 print(f"missing tag files:\n{missing_tags}")
 print(f"fewer than min tags (14):\n{below_min}")
-print(f"session notes mention E4:\n{flagged_participants}")
\ No newline at end of file
+print(f"session notes mention E4:\n{flagged_participants}")
+print(f"qualtrics events without matching tag:\n{unmatched_events}")
+print(f"\nEstimated E4 clock offset (secs) and drift:\n{clock_df}")
\ No newline at end of file
@@ -1,19 +1,31 @@
 import os
-import re
 import warnings
-import pandas as pd
-import numpy as np
 from preprocess_modules import utilities_hrv as hrvutils
 from preprocess_modules import utilities_e4 as e4utils
+from preprocess_modules import utilities_store as storeutils
+from preprocess_modules import utilities_catalog as catalogutils
+from preprocess_modules import utilities_manifest as manifestutils
 
 
 # paths to input directories
 e4_dir = r"P:\Spironolactone\E4"
 main_dir = r"P:\Spironolactone\main_qualtrics"
 main_filename = "main_dat21.csv"
-participant_folders = os.listdir(e4_dir)
+# "csv" = one file per participant/interval, "npz" = single segment store
+# (default shared with get_hrv_segments.py and watch_sessions.py)
+output_format = storeutils.OUTPUT_FORMAT
+# E4 signals to segment (any of EDA, BVP, ACC, TEMP, HR, IBI)
+signals = ["EDA"]
+# get EDA features (SCL, SCR peaks, AUC) for all intervals?
+get_features = 1
+# index of input files, updated on every run (None = scan without saving)
+catalog_path = os.path.join(os.path.expanduser("~"),".spironolactone_cache","catalog.json")
+# only reprocess participants whose E4 files or interval times changed since the last run?
+# (0 = reprocess everyone; the manifest is updated either way)
+incremental = 1
 # get relevant folders from E4 direcotries
-participant_folders = [f for f in participant_folders if re.search("^p[0][0-9][0-9]",f.lower())]
+catalog = catalogutils.refresh_catalog({"e4": e4_dir}, catalog_path)
+participant_folders = sorted(catalog["modalities"]["e4"]["entries"])
 
 # make output directory
 output_dir = os.path.join(e4_dir,"processed_e4_files")
@@ -21,72 +33,126 @@ try:
     os.mkdir(output_dir)
 except OSError:
     # if directory already exists
-    warnings.warn("Directory already exists. Files may be overwritten. Manual check advised.")
+    if not incremental:
+        warnings.warn("Directory already exists. Files may be overwritten. Manual check advised.")
 
-# read in qualtrics file
-col_list =  ["Status","DQ-1","Firstbeat_on_time","baseline start","baseline end","Q645","Q646","FILM-START","Q648","Q649"]
-new_names = ["Response_type","Participant_number","Firstbeat_start","RT1_start","RT1_end","RT2_start","RT2_end","Film_start","RT3_start","RT3_end"]
-qualtrics_df = pd.read_csv(os.path.join(main_dir,main_filename),usecols =col_list,skiprows= [1,2])
-qualtrics_df.columns = new_names
-
-# make interval cols
-qualtrics_df = hrvutils.remove_invalid_records(qualtrics_df,"Participant_number",exclude_pnums = [1])
-duplicates = hrvutils.flag_duplicate_participants(qualtrics_df,"Participant_number")
-qualtrics_df = hrvutils.remove_duplicate_participants(qualtrics_df,"Participant_number")
-qualtrics_df = hrvutils.convert_time_cols(qualtrics_df)
-qualtrics_df = hrvutils.add_end_time(qualtrics_df,"Film_start",15)
-rt_time_cols = [f for f in qualtrics_df.columns if any(k in f for k in ["start","end"])]
-for rt_time in rt_time_cols[1:]:
-    qualtrics_df = hrvutils.make_rel_time_cols(qualtrics_df,rt_time_cols[0],rt_time)
-qualtrics_df = hrvutils.convert_to_secs(qualtrics_df)
-
-start_intervals = qualtrics_df.filter(like = "start_interval", axis = 1).columns.sort_values()
-end_intervals = qualtrics_df.filter(like = "end_interval", axis = 1).columns.sort_values()
-intervals = list(zip(start_intervals, end_intervals))
-qualtrics_pnums = qualtrics_df.Participant_number.values
+# read in qualtrics file and make interval table
+# (interval times are relative to each participant's Firstbeat start)
+boundaries, pnum_rows, interval_names, firstbeat_starts, qualtrics_flags = hrvutils.load_interval_table(
+                                                                                os.path.join(main_dir,main_filename)
+                                                                                )
 
 missing_eda = []
-pnums = []
-eda_dat = []
 below_min = []
+# header could not be read (empty or malformed file)
+bad_header = []
 missing_sec = []
-duplicates = e4utils.flag_duplicates(participant_folders)
+eda_segments = []
+# EDA sample rate (from the file header) for each participant with EDA segments
+eda_rates = {}
+duplicates = catalogutils.get_duplicates(catalog, "e4")
 # somewhat arbitrary. If length of EDA recording indicates that session<4 hours, flag this.
-# the formula for calculating min_session_length is: hours*minutes_per_hour*seconds_per_minute*sampling_rate
-min_session_length = 4*60*60*4
+# the formula for calculating min_session_secs is: hours*minutes_per_hour*seconds_per_minute
+# (sample rate is taken from the header of each signal file)
+min_session_secs = 4*60*60
 
+# check recording lengths for all folders/signals before reading any data
+check_folders = [f for f in participant_folders if e4utils.get_participant_num(f) not in duplicates]
+length_df = e4utils.check_recording_lengths(e4_dir, check_folders, signals, min_session_secs)
+for status, flagged in [("missing", missing_eda), ("empty", bad_header), ("short", below_min)]:
+    status_df = length_df[length_df.status == status]
+    for pnum, signal in zip(status_df.participant_number, status_df.signal):
+        print(f"{signal} recording for participant {pnum} is {status}. Manual check advised.")
+        flagged.append([pnum, signal])
+ok_signals = length_df[length_df.status == "ok"].groupby("folder").signal.apply(list).to_dict()
 
-for folder in participant_folders:
+store_path = None
+if output_format == "npz":
+    store_path = os.path.join(output_dir,"e4_segments.npz")
+
+# compare inputs/interval times against the last run
+manifest_path = os.path.join(output_dir,"e4_manifest.json")
+manifest = manifestutils.load_manifest(manifest_path)
+settings = {
+            "intervals": interval_names, "output_format": output_format,
+            "signals": signals, "features": get_features,
+            "min_session_secs": min_session_secs
+            }
+entries = {}
+for folder, folder_signals in ok_signals.items():
     pnum = e4utils.get_participant_num(folder)
-    if pnum not in qualtrics_pnums:
-        print(f" Participant {pnum} not in qualtrics file. Skipping.")
-        continue
-    if pnum in duplicates:
-        print(f"More than one file exists for participant {pnum}. Skipping.")
+    if pnum not in pnum_rows or pnum in duplicates:
         continue
-    try:
-        eda_df = pd.read_csv(os.path.join(e4_dir,folder,"EDA.csv"),header = None,names = ["EDA"])
-    except FileNotFoundError:
-        print(f"No E4 file found for participant {pnum}.Manual check advised.")
-        missing_eda.append(pnum)
-        continue
-    if eda_df.shape[0]<min_session_length:
-        print(f"Recording for participant {pnum} seems short. Manual check advised.")
-        below_min.append(pnum)
-        continue
-    for start, stop in intervals:
-        start_val = qualtrics_df.loc[qualtrics_df.Participant_number == pnum,start]
-        stop_val = qualtrics_df.loc[qualtrics_df.Participant_number == pnum,stop]
-        try:
-            [int(val) for val in [start_val, stop_val]]
-        except (ValueError, TypeError) as e:
-            print(f"At least one of start_val, stop_val not int. Skipping participant {pnum}.")
+    row = pnum_rows[pnum]
+    signal_paths = [os.path.join(e4_dir,folder,f"{signal}.csv") for signal in folder_signals]
+    entries[pnum] = manifestutils.make_entry(
+                                            manifestutils.fingerprint_files(signal_paths, catalog),
+                                            boundaries[row], str(firstbeat_starts[row])
+                                            )
+changed, removed = manifestutils.get_changed(manifest, entries, settings, force = not incremental)
+# outputs of participants that are reprocessed or gone are stale
+stale = [name for pnum in changed + removed for name in manifestutils.get_outputs(manifest, pnum)]
+manifestutils.remove_outputs(stale, output_dir, os.path.join(output_dir,"e4_segments.npz"))
+print(f"Processing {len(changed)} of {len(entries)} participants ({len(removed)} removed).")
+
+
+def segment_participants():
+    """
+    Cut out intervals for all participants and
+    selected signals, one participant at a time.
+    """
+    for folder in participant_folders:
+        pnum = e4utils.get_participant_num(folder)
+        if pnum not in pnum_rows:
+            print(f" Participant {pnum} not in qualtrics file. Skipping.")
+            continue
+        if pnum in duplicates:
+            print(f"More than one file exists for participant {pnum}. Skipping.")
             continue
-        interval_df = e4utils.get_eda_intervals(eda_df,start_val,stop_val,4)
-        if interval_df.empty:
-            interval_name = start.split("_")[0]
-            warnings.warn(f"Participant {pnum} has no valid data for {interval_name} interval.\nManual check advised.")
-            missing_sec.append([pnum,interval_name])
+        if folder not in ok_signals or pnum not in changed:
             continue
-        # save to file
-        interval_df.to_csv(os.path.join(output_dir, "_".join([start.split("_")[0],str(int(pnum)),"eda.csv"])),index = False)
\ No newline at end of file
+        row = pnum_rows[pnum]
+        segments, flags, samp_rates = e4utils.segment_e4_participant(
+                                                        os.path.join(e4_dir,folder), pnum,
+                                                        boundaries[row], interval_names,
+                                                        reference_time = firstbeat_starts[row],
+                                                        signals = ok_signals[folder]
+                                                        )
+        missing_eda.extend(flags["missing_file"])
+        bad_header.extend(flags["bad_header"])
+        below_min.extend(flags["short"])
+        missing_sec.extend(flags["no_data"])
+        missing_sec.extend(flags["before_start"])
+        if get_features:
+            eda_segments.extend(seg for seg in segments if seg[0] == "eda")
+            if "EDA" in samp_rates:
+                eda_rates[pnum] = samp_rates["EDA"]
+        yield from segments
+
+
+# save to file (one file per segment or a single segment store)
+if output_format == "npz":
+    storeutils.write_segments(store_path, segment_participants())
+else:
+    for signal, interval_name, pnum, values in segment_participants():
+        e4utils.write_segment_csv(output_dir, signal, interval_name, pnum, values)
+
+outputs = manifestutils.find_outputs(
+                                    changed, interval_names, [signal.lower() for signal in signals],
+                                    output_dir, store_path
+                                    )
+manifest = manifestutils.update_manifest(
+                                        manifest, {pnum: entries[pnum] for pnum in changed},
+                                        outputs, removed, settings
+                                        )
+manifestutils.save_manifest(manifest, manifest_path)
+
+if get_features:
+    features_path = os.path.join(output_dir,"eda_features.csv")
+    features_df = e4utils.get_eda_features(
+                                            eda_segments, eda_rates,
+                                            interval_names = interval_names, pnums = list(eda_rates)
+                                            )
+    if incremental:
+        features_df = manifestutils.update_table(features_path, features_df, changed + removed)
+    features_df.to_csv(features_path,index = False)
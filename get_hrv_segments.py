@@ -1,77 +1,104 @@
 import os
-import pandas as pd
-import numpy as np
 import warnings
 from preprocess_modules import utilities_hrv
+from preprocess_modules import utilities_catalog
+from preprocess_modules import utilities_manifest
+from preprocess_modules import utilities_store
 
 main_dir = r"P:\Spironolactone\main_qualtrics"
 main_filename = "main_dat21.csv"
 hrv_dir = r"P:\Spironolactone\Firstbeat"
-hrv_files = [file for file in os.listdir(hrv_dir) if file.lower().startswith('p') and file.endswith('.csv')]
+# number of participants to process in parallel (1 = one at a time)
+n_workers = 1
+# get HRV features (mean IBI, SDNN, RMSSD, pNN50) for all intervals?
+get_features = 1
+# include LF/HF power in features? (requires scipy)
+freq_domain = 0
+# correct ectopic/missed beats before cutting out intervals?
+# (% corrected beats per interval is added to the features file)
+correct_artifacts = 0
+# "csv" = one file per participant/interval, "npz" = single segment store
+# (default shared with get_eda_segments_e4.py and watch_sessions.py)
+output_format = utilities_store.OUTPUT_FORMAT
+# binary cache of parsed Firstbeat files, so repeat runs skip csv parsing (None = no cache)
+cache_dir = os.path.join(os.path.expanduser("~"),".spironolactone_cache","ibi")
+# index of input files, updated on every run (None = scan without saving)
+catalog_path = os.path.join(os.path.expanduser("~"),".spironolactone_cache","catalog.json")
+# only reprocess participants whose Firstbeat file or interval times changed since the last run?
+# (0 = reprocess everyone; the manifest is updated either way)
+incremental = 1
 
-output_dir = os.path.join(hrv_dir,"processed_hrv_files")
-try:
-    os.makedirs(output_dir)
-except OSError:
-    # if directory already exists
-    warnings.warn("Directory already exists. Files may be overwritten. Manual check advised.")
+if __name__ == "__main__":
+    catalog = utilities_catalog.refresh_catalog({"firstbeat": hrv_dir}, catalog_path)
 
-col_list =  ["Status","DQ-1","Firstbeat_on_time","baseline start","baseline end","Q645","Q646","FILM-START","Q648","Q649"]
-new_names = ["response_type","participant_number","Firstbeat_start","RT1_start","RT1_end","RT2_start","RT2_end","Film_start","RT3_start","RT3_end"]
-qualtrics_df = pd.read_csv(os.path.join(main_dir,main_filename),usecols =col_list,skiprows= [1,2])
-qualtrics_df.columns = new_names
-
-qualtrics_df = utilities_hrv.remove_invalid_records(qualtrics_df, "participant_number",exclude_pnums = [1])
-duplicates = utilities_hrv.flag_duplicate_participants(qualtrics_df,"participant_number")
-qualtrics_df = utilities_hrv.remove_duplicate_participants(qualtrics_df,"participant_number")
-qualtrics_df = utilities_hrv.convert_time_cols(qualtrics_df)
-qualtrics_df = utilities_hrv.add_end_time(qualtrics_df,"Film_start",15)
-rt_time_cols = [f for f in qualtrics_df.columns if any(k in f for k in ["start","end"])]
-for rt_time in rt_time_cols[1:]:
-    qualtrics_df = utilities_hrv.make_rel_time_cols(qualtrics_df,rt_time_cols[0],rt_time)
-qualtrics_df = utilities_hrv.convert_to_secs(qualtrics_df)
-
-# Zip up start/end interval column names for easier access in for loop below:
-start_intervals = qualtrics_df.filter(like = "start_interval", axis = 1).columns.sort_values()
-end_intervals = qualtrics_df.filter(like = "end_interval", axis = 1).columns.sort_values()
-intervals = list(zip(start_intervals, end_intervals))
+    output_dir = os.path.join(hrv_dir,"processed_hrv_files")
+    try:
+        os.makedirs(output_dir)
+    except OSError:
+        # if directory already exists
+        if not incremental:
+            warnings.warn("Directory already exists. Files may be overwritten. Manual check advised.")
 
-# Track participants whose HRV data for any of the intervals is missing
-# Zip up start/end interval column names for easier access in for loop below:
-start_intervals = qualtrics_df.filter(like = "start_interval", axis = 1).columns.sort_values()
-end_intervals = qualtrics_df.filter(like = "end_interval", axis = 1).columns.sort_values()
-intervals = list(zip(start_intervals, end_intervals))
+    qualtrics_path = os.path.join(main_dir,main_filename)
+    boundaries, pnum_rows, interval_names, _, qualtrics_flags = utilities_hrv.load_interval_table(qualtrics_path)
 
-# Track participants whose HRV data for any of the intervals is missing
-missing_pnums = []
-for pnum in qualtrics_df.participant_number:
-    # check if file exists
-    try:
-        my_rec = utilities_hrv.select_hrv_record(pnum,hrv_files)
-    except IndexError:
-        print(f"No HRV file found for participant {pnum}.")
-        continue
-    # read in HRV file for participant pnum
-    hrv_df = pd.read_csv(
-                        os.path.join(hrv_dir,my_rec),
-                        header = 0, names = ["IB_intervals"],
-                        skiprows = np.arange(0,4)
-                        )
-    # select the part of the HRV file that corresponds to given interval
-    # do this for all intervals (Film, RT1, RT2, RT3)
-    for start_interval, end_interval in intervals:
-        start_time = utilities_hrv.get_time_stamp(qualtrics_df,"participant_number", start_interval, pnum)
-        end_time = utilities_hrv.get_time_stamp(qualtrics_df, "participant_number",end_interval, pnum)
+    # find HRV file for each participant
+    jobs = []
+    for pnum, row in pnum_rows.items():
+        # check if file exists
         try:
-            interval_df = utilities_hrv.get_hrv_interval(hrv_df,start_time,end_time)
-        except TypeError:
-            print(f"Start or end of interval for participant {pnum} is {start_time}. Indexing not possible. Skipping.")
+            my_rec = utilities_catalog.get_path(catalog,"firstbeat",pnum)
+        except IndexError:
+            print(f"No HRV file found for participant {pnum}.")
             continue
-        # if the resulting dataframe is empty, flag this and hold on to pnum/interval
-        if interval_df.empty:
-            interval_name = start_interval.split("_")[0]
-            print(f"Participant {pnum} has no valid data for {interval_name} interval.\nManual check advised. Skipping.")
-            missing_pnums.append([pnum,interval_name])
-            continue
-        # save to file
-        interval_df.to_csv(os.path.join(output_dir, "_".join([start_interval.split("_")[0],str(int(pnum)),"hrv.csv"])),index = False)
\ No newline at end of file
+        jobs.append((pnum, row, my_rec))
+
+    store_path = None
+    if output_format == "npz":
+        store_path = os.path.join(output_dir,"hrv_segments.npz")
+
+    # compare inputs/interval times against the last run
+    manifest_path = os.path.join(output_dir,"hrv_manifest.json")
+    manifest = utilities_manifest.load_manifest(manifest_path)
+    settings = {
+                "intervals": interval_names, "output_format": output_format,
+                "features": get_features, "freq_domain": freq_domain,
+                "correct_artifacts": correct_artifacts
+                }
+    entries = {
+            pnum: utilities_manifest.make_entry(
+                                            utilities_manifest.fingerprint_files([path], catalog),
+                                            boundaries[row]
+                                            )
+            for pnum, _, path in jobs
+            }
+    changed, removed = utilities_manifest.get_changed(manifest, entries, settings, force = not incremental)
+    # outputs of participants that are reprocessed or gone are stale
+    stale = [name for pnum in changed + removed for name in utilities_manifest.get_outputs(manifest, pnum)]
+    utilities_manifest.remove_outputs(stale, output_dir, os.path.join(output_dir,"hrv_segments.npz"))
+    print(f"Processing {len(changed)} of {len(jobs)} participants ({len(removed)} removed).")
+    jobs = [job for job in jobs if job[0] in changed]
+
+    # select the parts of the HRV files that correspond to all intervals (Film, RT1, RT2, RT3)
+    # and track participants whose HRV data for any of the intervals is missing
+    missing_pnums, features_df = utilities_hrv.process_hrv_participants(
+                                                        jobs, boundaries, interval_names,
+                                                        output_dir, n_workers = n_workers,
+                                                        features = bool(get_features),
+                                                        freq_domain = bool(freq_domain),
+                                                        store_path = store_path,
+                                                        cache_dir = cache_dir,
+                                                        correct_artifacts = bool(correct_artifacts)
+                                                        )
+    outputs = utilities_manifest.find_outputs(changed, interval_names, ["hrv"], output_dir, store_path)
+    manifest = utilities_manifest.update_manifest(
+                                                manifest, {pnum: entries[pnum] for pnum in changed},
+                                                outputs, removed, settings
+                                                )
+    utilities_manifest.save_manifest(manifest, manifest_path)
+    if get_features or correct_artifacts:
+        features_path = os.path.join(output_dir,"hrv_features.csv")
+        if incremental:
+            features_df = utilities_manifest.update_table(features_path, features_df, changed + removed)
+        if features_df is not None:
+            features_df.to_csv(features_path,index = False)
@@ -1,32 +1,95 @@
 # main script for preprocessing diary files.
 import os
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 import preprocess_modules.utilities as utils
+import preprocess_modules.utilities_catalog as catalogutils
+import preprocess_modules.utilities_manifest as manifestutils
 
 #specify path to input dir and read in files using identifier ('diary')
 input_dir = r"P:\Spironolactone\preprocess_dat"
-input_files = [file for file in os.listdir(input_dir) if 'diary' in file]
-
-# make output dir
-output_dir = os.path.join(input_dir,"processed_diaries")
-try:
-    os.makedirs(output_dir)
-except OSError:
-    # if directory already exists
-    print(
-        "Directory already exists. Files may be overwritten."
-        )
-
+# qualtrics exports (indexed in the catalog along with the diary exports, if the directory exists)
+qualtrics_dir = r"P:\Spironolactone\main_qualtrics"
+# index of input files, updated on every run (None = scan without saving)
+catalog_path = os.path.join(os.path.expanduser("~"),".spironolactone_cache","catalog.json")
+# only process diary exports that changed since the last run?
+# (0 = process all; the manifest is updated either way)
+incremental = 1
+# answers to the questions asked for each file (True/False), None = ask every time.
+# remove_incomplete: remove participants with incomplete records?
+# clean: apply cleaning (rem_dat_no_ints) and write to file?
+policy = {"remove_incomplete": None, "clean": None}
+# number of files to process in parallel (batch mode, needs all policy answers set)
+n_workers = 1
+# columns to retain (in addition to intrusion related ones)
+select_list = ["Start Date","Participant number:","Start time (HH:MM):"]
 # save to output dir?
 save = 1
-for file in input_files:
-    diary_file = pd.read_csv(os.path.join(input_dir,file),skiprows = [0,2])
-    diary_file = utils.preprocess_frame(diary_file, 'Finished',["Start Date","Participant number:","Start time (HH:MM):"],"had_intrusions")
-    carry_on = input("If you proceed, some cleaning processes will be applied and the data will be written to a file. Continue? Y/N\n")
-    if carry_on.lower()==("y"):
-        diary_file = utils.rem_dat_no_ints(diary_file)
-        if save:
-            diary_file.to_csv(os.path.join(output_dir, '_'.join([file[:-4],'processed.csv'])),index = False)
-        else:
-            pass
+
+def run_job(job):
+    return utils.process_diary_file(*job)
+
+if __name__ == "__main__":
+    catalog_dirs = {"diary": input_dir}
+    if os.path.isdir(qualtrics_dir):
+        catalog_dirs["qualtrics"] = qualtrics_dir
+    catalog = catalogutils.refresh_catalog(catalog_dirs, catalog_path)
+    input_files = [os.path.basename(path) for path in catalogutils.get_exports(catalog, "diary")]
+
+    # make output dir
+    output_dir = os.path.join(input_dir,"processed_diaries")
+    try:
+        os.makedirs(output_dir)
+    except OSError:
+        # if directory already exists
+        if not incremental:
+            print(
+                "Directory already exists. Files may be overwritten."
+                )
+
+    # compare diary exports against the last run
+    manifest_path = os.path.join(output_dir,"diary_manifest.json")
+    manifest = manifestutils.load_manifest(manifest_path)
+    # outputs depend on these, so a change reprocesses all files
+    settings = {"select_list": select_list, "policy": policy}
+    entries = {
+            file: manifestutils.make_entry(manifestutils.fingerprint_files([os.path.join(input_dir,file)], catalog))
+            for file in input_files
+            }
+    changed, removed = manifestutils.get_changed(manifest, entries, settings, force = not incremental)
+    # processed files for exports that are reprocessed or gone are stale
+    stale = [name for file in changed + removed for name in manifestutils.get_outputs(manifest, file)]
+    manifestutils.remove_outputs(stale, output_dir)
+    manifest = manifestutils.update_manifest(manifest, {}, {}, changed + removed, settings)
+    print(f"Processing {len(changed)} of {len(input_files)} diary files ({len(removed)} removed).")
+
+    out_names = {file: '_'.join([file[:-4],'processed.csv']) for file in changed}
+    jobs = [
+            (os.path.join(input_dir,file), os.path.join(output_dir,out_names[file]) if save else None,
+            select_list, policy)
+            for file in changed
+            ]
+    if n_workers > 1:
+        if any(answer is None for answer in policy.values()):
+            raise ValueError("Batch mode (n_workers > 1) needs an answer for every policy decision.")
+        with ProcessPoolExecutor(max_workers = n_workers) as pool:
+            results = list(pool.map(run_job, jobs))
+    else:
+        results = map(run_job, jobs)
+
+    # single audit log of decisions and flagged participants for all files
+    audit_dfs = []
+    for file, (cleaned, audit) in zip(changed, results):
+        if cleaned and save:
+            manifest = manifestutils.update_manifest(manifest, {file: entries[file]}, {file: [out_names[file]]}, settings = settings)
+            manifestutils.save_manifest(manifest, manifest_path)
+        audit_df = pd.DataFrame(audit)
+        audit_df.insert(0, "file", file)
+        audit_dfs.append(audit_df)
+    manifestutils.save_manifest(manifest, manifest_path)
+    if audit_dfs:
+        audit_path = os.path.join(output_dir,"diary_audit.csv")
+        audit_df = pd.concat(audit_dfs, ignore_index = True)
+        audit_df.insert(0, "run_time", pd.Timestamp.now().floor("s"))
+        audit_df.to_csv(audit_path, mode = "a", index = False, header = not os.path.exists(audit_path))
@@ -1,8 +1,101 @@
 # utilities
 
+from functools import lru_cache
 import numpy as np
+import pandas as pd
 import re
 
+# substrings of diary export columns used by preprocess_frame()
+# (intrusion question, rating columns and anything select_columns() keeps)
+DIARY_COLS_CONTAIN = ["have you experienced","COLUMN 1","COLUMN 2","COLUMN 3","COLUMN 4",
+                        "had_intrusions","content","freq","distress","vivid"]
+
+def read_qualtrics_header(file_path, skiprows = (1,2)):
+    """
+    Read column names of a qualtrics export
+    without reading any data.
+
+    Parameters
+    ----------
+    file_path:  str
+        path to qualtrics export
+    skiprows:   list[int]
+        metadata rows to skip, eg [1,2] for main
+        session exports, [0,2] for diaries
+    Returns
+    -------
+        list of column names
+    """
+    return list(pd.read_csv(file_path, nrows = 0, skiprows = list(skiprows)).columns)
+
+def resolve_columns(columns, names = (), prefixes = (), contains = ()):
+    """
+    Get columns matching names, prefixes
+    or substrings.
+
+    Parameters
+    ----------
+    columns:    list[str]
+        all column names (see read_qualtrics_header())
+    names:  list[str]
+        exact column names (all must exist)
+    prefixes:   list[str]
+        eg "622_" for all STAI items
+    contains:   list[str]
+        substrings, as in in_df.filter(like = ...)
+    Returns
+    -------
+        names in the order given, followed by other
+        matching columns in the order of the header
+    """
+    names = list(dict.fromkeys(names))
+    missing = [name for name in names if name not in columns]
+    if missing:
+        raise ValueError(f"Columns not found in qualtrics export: {missing}")
+    matched = [
+                col for col in columns if col not in names and
+                (col.startswith(tuple(prefixes)) or any(sub in col for sub in contains))
+                ]
+    return names + matched
+
+def read_qualtrics(file_path, names = (), prefixes = (), contains = (), skiprows = (1,2), dtype = None):
+    """
+    Read only the needed columns of a (wide) qualtrics
+    export. The header is read first to find the columns,
+    then only those are parsed.
+
+    Parameters
+    ----------
+    file_path:  str
+        path to qualtrics export
+    names, prefixes, contains:
+        columns to read (see resolve_columns())
+    skiprows:   list[int]
+        metadata rows to skip, eg [1,2] for main
+        session exports, [0,2] for diaries
+    dtype:  dict or None
+        dtypes by column name, prefix or substring (exact
+        names first, then the first key found in the column name),
+        eg {"DQ-1": "float64", "622_": "category", "Firstbeat_on_time": "string"}.
+        Other columns are inferred as usual.
+    Returns
+    -------
+        dataframe with the resolved columns (in resolve_columns() order)
+    """
+    columns = resolve_columns(read_qualtrics_header(file_path, skiprows), names, prefixes, contains)
+    dtypes = {}
+    for col in columns:
+        if dtype is None:
+            break
+        if col in dtype:
+            dtypes[col] = dtype[col]
+        else:
+            key = next((key for key in dtype if key in col), None)
+            if key is not None:
+                dtypes[col] = dtype[key]
+    in_df = pd.read_csv(file_path, usecols = columns, skiprows = list(skiprows), dtype = dtypes)
+    return in_df.loc[:, columns]
+
 def remove_incomplete_rows(in_df,finished_col):
     """
     remove rows containing incomplete records
@@ -135,7 +228,108 @@ def strip_col_names(in_df):
     in_df.columns = [f.replace(" ","_") for f in in_df.columns]
     return in_df
 
-def preprocess_frame(in_df,finished_col,select_list,int_col):
+@lru_cache(maxsize = 32)
+def get_column_plan(columns, select_list):
+    """
+    Work out renaming/selection of diary columns once
+    per header. Runs the usual steps (rename_diary_cols,
+    select_columns, strip_col_names) on a one-row frame with
+    the same header, holding each column's position, so the
+    result is identical and the positions of the retained
+    columns can be read off the remaining row.
+
+    Parameters
+    ----------
+    columns:    tuple[str]
+        header of diary export (in_df.columns)
+    select_list:    tuple[str]
+        column names to retain (in addition to intrusion related ones)
+    Returns
+    -------
+        positions of retained columns in the header,
+        their final names, and the original name of
+        the had_intrusions column (all tuples/str, as the
+        result is cached)
+    """
+    plan_df = pd.DataFrame([np.arange(len(columns))], columns = list(columns))
+    plan_df = rename_diary_cols(plan_df, start_phrase = "have you experienced")
+    int_source = columns[int(plan_df["had_intrusions"].iloc[0])]
+    col_nums = [' '.join(['column',str(num)]) for num in np.arange(1,5)]
+    for col in col_nums:
+        plan_df = rename_diary_cols(plan_df,col_num = col)
+    plan_df = select_columns(plan_df,list(select_list))
+    plan_df = strip_col_names(plan_df)
+    return tuple(plan_df.iloc[0].tolist()), tuple(plan_df.columns), int_source
+
+def apply_column_plan(in_df, plan):
+    """
+    Rename and select diary columns in one step
+    (see get_column_plan()).
+
+    Parameters
+    ----------
+    in_df:  pd DataFrame
+        dataframe to operate on
+    plan:   tuple
+        as returned by get_column_plan()
+    Returns
+    -------
+    in_df w/o irrelevant columns, w renamed columns
+    """
+    positions, names, _ = plan
+    out_df = in_df.iloc[:, list(positions)]
+    out_df.columns = list(names)
+    return out_df
+
+def decide(policy, decision, question):
+    """
+    Get yes/no decision from policy, or ask
+    if the policy leaves it open (interactive mode).
+
+    Parameters
+    ----------
+    policy: dict or None
+        decision name: True/False, or None to ask
+        eg {"remove_incomplete": True, "clean": True}
+    decision:   str
+        name of decision, eg "remove_incomplete"
+    question:   str
+        question to ask if policy leaves it open
+    Returns
+    -------
+        answer (bool) and where it came from
+        ("policy" or "prompt")
+    """
+    answer = None if policy is None else policy.get(decision)
+    if answer is None:
+        return input(question).lower() == "y", "prompt"
+    return bool(answer), "policy"
+
+def add_audit(audit, step, value, source, participants = ()):
+    """
+    Add decision/flag to audit log
+    (nothing happens if audit is None).
+
+    Parameters
+    ----------
+    audit:  list or None
+        audit log to append to
+    step:   str
+        name of decision or flag
+    value:
+        answer for decisions, number of participants for flags
+    source: str
+        "policy", "prompt" or "flag"
+    participants:   array-like
+        participant numbers concerned
+    """
+    if audit is not None:
+        audit.append({
+                    "step": step, "value": value, "source": source,
+                    "participants": " ".join(str(p) for p in np.asarray(participants).tolist())
+                    })
+
+def preprocess_frame(in_df,finished_col,select_list,int_col, policy = None, audit = None):
     """
     preprocess dataframe
     This just strings together some of the other functions.
@@ -151,23 +345,72 @@ def preprocess_frame(in_df,finished_col,select_list,int_col):
         list of column names to retain (in addition to intrusion related ones)
     int_col:    str
         name of column with intrusions yes/no answer
+    policy: dict or None
+        answers to the questions otherwise asked while
+        processing (see decide()). None = ask.
+    audit:  list or None
+        if a list, decisions and flagged participants
+        are added to it (see add_audit())
     """
     pnums_incomplete = flag_incomplete_rows(in_df,'Finished')
-    remove_recs = input("Would you like to participants with incomplete records? Y/N\n")
-    if remove_recs.lower() == "y":
+    remove_recs, source = decide(policy, "remove_incomplete", "Would you like to participants with incomplete records? Y/N\n")
+    add_audit(audit, "remove_incomplete", remove_recs, source, pnums_incomplete)
+    if remove_recs:
         in_df = remove_incomplete_rows(in_df,finished_col)
     else:
         pass
-    in_df = rename_diary_cols(in_df, start_phrase = "have you experienced")
-    pnums_notyn = flag_ints_notyesno(in_df,int_col)
-    col_nums = [' '.join(['column',str(num)]) for num in np.arange(1,5)]
-    for col in col_nums:
-        in_df = rename_diary_cols(in_df,col_num = col)
-    in_df = select_columns(in_df,select_list)
-    in_df = strip_col_names(in_df)
+    # same header for all diary exports, so column handling is worked out once
+    plan = get_column_plan(tuple(in_df.columns), tuple(select_list))
+    pnums_notyn = flag_ints_notyesno(
+                                    in_df.loc[:,[plan[2],'Participant number:']].set_axis(
+                                    [int_col,'Participant number:'], axis = 1),
+                                    int_col
+                                    )
+    add_audit(audit, "not_yes_no", len(pnums_notyn), "flag", pnums_notyn)
+    in_df = apply_column_plan(in_df, plan)
     pnums_noint = flag_dat_no_cont(in_df)
+    add_audit(audit, "no_intrusions_with_content", len(pnums_noint), "flag", pnums_noint)
     return in_df
-    
+
+def process_diary_file(input_path, output_path, select_list, policy = None):
+    """
+    Read, preprocess and clean a single diary
+    export, and write it to file.
+    With a complete policy, this runs without
+    any input, eg on a worker pool.
+
+    Parameters
+    ----------
+    input_path: str
+        path to qualtrics diary export
+    output_path:    str or None
+        path to write processed diary to (None = don't save)
+    select_list:    list[str]
+        list of column names to retain (in addition to intrusion related ones)
+    policy: dict or None
+        see decide(). "remove_incomplete" and "clean"
+        are used. None = ask.
+    Returns
+    -------
+        whether the file was cleaned (and saved),
+        and audit log for the file (list of dicts)
+    """
+    audit = []
+    # only read columns that preprocess_frame() can use
+    diary_file = read_qualtrics(
+                                input_path, names = ['Finished','Participant number:'] + list(select_list),
+                                contains = DIARY_COLS_CONTAIN, skiprows = [0,2],
+                                dtype = {"Start time (HH:MM):": "string"}
+                                )
+    diary_file = preprocess_frame(diary_file, 'Finished', list(select_list), "had_intrusions", policy, audit)
+    carry_on, source = decide(policy, "clean", "If you proceed, some cleaning processes will be applied and the data will be written to a file. Continue? Y/N\n")
+    add_audit(audit, "clean", carry_on, source)
+    if carry_on:
+        diary_file = rem_dat_no_ints(diary_file)
+        if output_path is not None:
+            diary_file.to_csv(output_path,index = False)
+    return carry_on, audit
+
 def rem_dat_no_ints(in_df, set_val = np.nan):
     """
     Remove data for records w/out intrusions
@@ -0,0 +1,282 @@
+import os
+import re
+import json
+import warnings
+
+CATALOG_VERSION = 1
+
+# how to recognise files/folders for each modality:
+# (is folder, regex on lower case name, group with participant number or None for cohort exports)
+MODALITIES = {
+            "firstbeat": (False, r"^p(\d{3}).*\.csv$", 1),
+            "e4": (True, r"^p(0\d\d)", 1),
+            "diary": (False, r"diary.*\.csv$", None),
+            "qualtrics": (False, r"\.csv$", None)
+            }
+
+
+def new_catalog():
+    """
+    Make an empty catalog.
+
+    Returns
+    -------
+    catalog dict
+    """
+    return {"version": CATALOG_VERSION, "modalities": {}, "index": {}}
+
+def load_catalog(catalog_path):
+    """
+    Load catalog from disk. Returns an
+    empty catalog if the file does not exist
+    or was written by another catalog version.
+
+    Parameters
+    ----------
+    catalog_path:   str
+        path to catalog (json)
+
+    Returns
+    -------
+    catalog dict (with participant index)
+    """
+    try:
+        with open(catalog_path) as f:
+            catalog = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return new_catalog()
+    if catalog.get("version") != CATALOG_VERSION:
+        return new_catalog()
+    catalog["index"] = index_catalog(catalog)
+    return catalog
+
+def save_catalog(catalog, catalog_path):
+    """
+    Write catalog to disk (the participant index
+    is rebuilt on load, so it is not saved).
+    The file is replaced in one step, so an
+    interrupted run cannot leave half a catalog.
+    The temp file is named per process, as all
+    scripts share the same catalog.
+
+    Parameters
+    ----------
+    catalog:    dict
+        catalog to save
+    catalog_path:   str
+        path to catalog (json)
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(catalog_path)), exist_ok = True)
+    tmp_path = f"{catalog_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({k: v for k, v in catalog.items() if k != "index"}, f)
+    os.replace(tmp_path, catalog_path)
+
+def _stat_record(entry):
+    """
+    Size and mtime from a DirEntry
+    (no extra system call on Windows).
+    """
+    st = entry.stat()
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+def scan_e4_folder(folder_path, names = None):
+    """
+    Get size and mtime of all files in
+    an E4 participant folder.
+
+    Parameters
+    ----------
+    folder_path:    str
+        path to participant folder
+    names:  iterable of str or None
+        files known to be in the folder (the folder is
+        not listed, but files are still stat'ed as they
+        may have been overwritten). None = list folder.
+
+    Returns
+    -------
+    dict of file name: {"size", "mtime_ns"}
+    """
+    if names is not None:
+        files = {}
+        for name in names:
+            try:
+                st = os.stat(os.path.join(folder_path, name))
+            except FileNotFoundError:
+                continue
+            files[name] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+        return files
+    with os.scandir(folder_path) as entries:
+        return {entry.name: _stat_record(entry) for entry in entries if entry.is_file()}
+
+def scan_modality(modality, dir_path, previous = None):
+    """
+    Index all files (or folders) of one modality in a
+    single directory scan. E4 folders whose mtime is
+    unchanged since the previous scan are not listed again.
+
+    Parameters
+    ----------
+    modality:   str
+        one of MODALITIES
+    dir_path:   str
+        directory with the files for this modality
+    previous:   dict or None
+        result of an earlier scan of this modality
+
+    Returns
+    -------
+    dict with "path", "mtime_ns" and "entries"
+    (name: {"pnum", "size", "mtime_ns"[, "files"]})
+    """
+    is_folder, pattern, pnum_group = MODALITIES[modality]
+    old_entries = {}
+    if previous is not None and previous["path"] == dir_path:
+        old_entries = previous["entries"]
+    entries = {}
+    with os.scandir(dir_path) as dir_entries:
+        for entry in dir_entries:
+            if entry.is_dir() != is_folder:
+                continue
+            match = re.search(pattern, entry.name.lower())
+            if match is None:
+                continue
+            record = _stat_record(entry)
+            record["pnum"] = int(match.group(pnum_group)) if pnum_group else None
+            if is_folder:
+                old = old_entries.get(entry.name)
+                if old is not None and old["mtime_ns"] == record["mtime_ns"]:
+                    record["files"] = scan_e4_folder(entry.path, old["files"])
+                else:
+                    record["files"] = scan_e4_folder(entry.path)
+            entries[entry.name] = record
+    return {"path": dir_path, "mtime_ns": os.stat(dir_path).st_mtime_ns, "entries": entries}
+
+def index_catalog(catalog):
+    """
+    Build participant number lookup for all
+    modalities in the catalog.
+
+    Parameters
+    ----------
+    catalog:    dict
+        catalog
+
+    Returns
+    -------
+    dict of modality: {pnum: sorted list of names}
+    """
+    index = {}
+    for modality, scan in catalog["modalities"].items():
+        by_pnum = {}
+        for name in sorted(scan["entries"]):
+            pnum = scan["entries"][name]["pnum"]
+            if pnum is not None:
+                by_pnum.setdefault(pnum, []).append(name)
+        index[modality] = by_pnum
+    return index
+
+def refresh_catalog(dirs, catalog_path = None):
+    """
+    Update the catalog for the given directories.
+    Modalities that are not listed are kept as they are.
+
+    Parameters
+    ----------
+    dirs:   dict
+        modality: directory, eg {"firstbeat": hrv_dir, "e4": e4_dir}
+    catalog_path:   str or None
+        path to catalog (json). If None, nothing is loaded or saved.
+
+    Returns
+    -------
+    catalog dict (with participant index)
+    """
+    catalog = new_catalog() if catalog_path is None else load_catalog(catalog_path)
+    for modality, dir_path in dirs.items():
+        previous = catalog["modalities"].get(modality)
+        catalog["modalities"][modality] = scan_modality(modality, dir_path, previous)
+    catalog["index"] = index_catalog(catalog)
+    if catalog_path is not None:
+        save_catalog(catalog, catalog_path)
+    return catalog
+
+def get_pnums(catalog, modality):
+    """
+    Participant numbers with at least one
+    file/folder for modality.
+    """
+    return sorted(catalog["index"].get(modality, {}))
+
+def get_names(catalog, modality, pnum):
+    """
+    Names of all files/folders for participant
+    pnum (empty list if there are none).
+    """
+    return catalog["index"].get(modality, {}).get(pnum, [])
+
+def get_path(catalog, modality, pnum):
+    """
+    Get path to file/folder for participant.
+
+    Parameters
+    ----------
+    catalog:    dict
+        catalog
+    modality:   str
+        one of MODALITIES
+    pnum:   int or float
+        participant number
+
+    Returns
+    -------
+    path (str). Raises IndexError if there is no
+    file for pnum and warns if there is more than one.
+    """
+    names = get_names(catalog, modality, pnum)
+    if len(names)>1:
+        warnings.warn(f"Found more than one file for participant {pnum}.\nManual check advised.")
+    return os.path.join(catalog["modalities"][modality]["path"], names[-1])
+
+def get_duplicates(catalog, modality):
+    """
+    Participant numbers with more than one
+    file/folder for modality.
+    """
+    return [pnum for pnum, names in sorted(catalog["index"].get(modality, {}).items()) if len(names)>1]
+
+def get_exports(catalog, modality):
+    """
+    Paths of files not tied to a single
+    participant (eg diary exports).
+    """
+    scan = catalog["modalities"].get(modality)
+    if scan is None:
+        return []
+    return [os.path.join(scan["path"], name) for name in sorted(scan["entries"])]
+
+def get_file_record(catalog, path):
+    """
+    Look up size/mtime recorded for a file.
+
+    Parameters
+    ----------
+    catalog:    dict
+        catalog
+    path:   str
+        path to file (for E4 signal files: folder/file)
+
+    Returns
+    -------
+    dict with "size" and "mtime_ns", or None if
+    the file is not in the catalog.
+    """
+    dir_path, name = os.path.split(path)
+    folder_path, folder = os.path.split(dir_path)
+    for scan in catalog["modalities"].values():
+        if scan["path"] == dir_path and name in scan["entries"]:
+            return scan["entries"][name]
+        if scan["path"] == folder_path and folder in scan["entries"]:
+            return scan["entries"][folder].get("files", {}).get(name)
+    return None
@@ -0,0 +1,174 @@
+import numpy as np
+import pandas as pd
+from preprocess_modules import utilities_hrv
+
+def match_beats(ref_times, other_times, tolerance = 0.15):
+    """
+    Match beats from two devices with a sorted
+    nearest-neighbour search. A pair only counts if
+    both beats are each other's nearest beat and they
+    are at most tolerance secs apart.
+
+    Parameters
+    ----------
+    ref_times:  np.ndarray
+        beat times of reference device (eg Firstbeat),
+        sorted, in secs
+    other_times:    np.ndarray
+        beat times of other device (eg E4), sorted, in secs
+        on the same clock as ref_times
+    tolerance:  float
+        max secs between matched beats
+
+    Returns
+    -------
+    index of matched beat in other_times for each
+    ref beat (-1 if no match), and lag (other - ref,
+    NaN if no match) for each ref beat.
+    """
+    ref_times = np.asarray(ref_times, dtype = np.float64)
+    other_times = np.asarray(other_times, dtype = np.float64)
+    matches = np.full(len(ref_times), -1, dtype = np.int64)
+    lags = np.full(len(ref_times), np.nan)
+    if len(ref_times) == 0 or len(other_times) == 0:
+        return matches, lags
+    nearest = utilities_hrv.find_nearest_beat(other_times, ref_times)
+    reverse = utilities_hrv.find_nearest_beat(ref_times, other_times[nearest])
+    nearest_lags = other_times[nearest]-ref_times
+    matched = (reverse == np.arange(len(ref_times))) & (np.abs(nearest_lags) <= tolerance)
+    matches[matched] = nearest[matched]
+    lags[matched] = nearest_lags[matched]
+    return matches, lags
+
+def estimate_clock_offset(ref_times, other_times, initial_offset = 0,
+    max_offset = 300, tolerance = 0.15, n_anchors = 500, bin_width = 0.02):
+    """
+    Estimate offset between two device clocks from their
+    beat times, so that other_time = ref_time + offset.
+    Every anchor beat (a sample of ref beats) votes for the
+    offsets to all other beats within max_offset; the most
+    common offset (votes summed over 3 neighbouring bins) is
+    then refined with the median lag of matched beats.
+
+    Parameters
+    ----------
+    ref_times:  np.ndarray
+        beat times of reference device, sorted, in secs
+    other_times:    np.ndarray
+        beat times of other device, sorted, in secs
+    initial_offset: float
+        best guess of offset (eg utilities_e4.get_clock_offset()
+        for Firstbeat start vs E4 start)
+    max_offset: float
+        max secs the offset can differ from initial_offset
+    tolerance:  float
+        max secs between matched beats
+    n_anchors:  int
+        number of ref beats used for voting
+    bin_width:  float
+        width of offset histogram bins in secs. Should be
+        well below a typical IBI, otherwise offsets of
+        whole beats can't be told apart.
+
+    Returns
+    -------
+    estimated offset in secs and proportion of ref
+    beats matched at that offset (NaN, 0 if no beats)
+    """
+    ref_times = np.asarray(ref_times, dtype = np.float64)
+    other_times = np.asarray(other_times, dtype = np.float64)
+    if len(ref_times) == 0 or len(other_times) == 0:
+        return np.nan, 0.0
+    anchors = ref_times[np.linspace(0, len(ref_times)-1, min(n_anchors, len(ref_times))).astype(int)]
+    lo = np.searchsorted(other_times, anchors+initial_offset-max_offset)
+    hi = np.searchsorted(other_times, anchors+initial_offset+max_offset, side = "right")
+    counts = hi-lo
+    if counts.sum() == 0:
+        return np.nan, 0.0
+    # all (anchor, other beat) pairs within the window, without a python loop
+    anchor_ids = np.repeat(np.arange(len(anchors)), counts)
+    other_ids = np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts, counts)+np.repeat(lo, counts)
+    candidate_offsets = other_times[other_ids]-anchors[anchor_ids]
+    bins = np.arange(initial_offset-max_offset, initial_offset+max_offset+bin_width, bin_width)
+    votes, edges = np.histogram(candidate_offsets, bins = bins)
+    # sum over neighbouring bins so a peak split across a bin edge isn't missed
+    votes = np.convolve(votes, np.ones(3), mode = "same")
+    best = np.argmax(votes)
+    offset = (edges[best]+edges[best+1])/2
+    # refine with median lag of matched beats
+    _, lags = match_beats(ref_times+offset, other_times, tolerance)
+    if np.isnan(lags).all():
+        return offset, 0.0
+    offset += np.nanmedian(lags)
+    _, lags = match_beats(ref_times+offset, other_times, tolerance)
+    return offset, np.mean(~np.isnan(lags))
+
+def get_beat_agreement(ref_times, other_times, boundaries, interval_names,
+    offset = 0, tolerance = 0.15):
+    """
+    Compare beats of two devices for each interval.
+
+    Parameters
+    ----------
+    ref_times:  np.ndarray
+        beat times of reference device (eg Firstbeat,
+        see utilities_hrv.get_beat_times()), sorted, in secs
+    other_times:    np.ndarray
+        beat times of other device (eg E4 IBI.csv time
+        column), sorted, in secs
+    boundaries: array-like
+        interval start/end times on the ref clock,
+        shape (n_intervals, 2) or flat
+    interval_names: list[str]
+        names of intervals
+    offset: float
+        other_time = ref_time + offset
+        (see estimate_clock_offset())
+    tolerance:  float
+        max secs between matched beats
+
+    Returns
+    -------
+    dataframe with one row per interval: interval, n_ref,
+    n_other, match_rate (ref beats with a matching beat),
+    dropout_rate (ref beats without one), lag_mean and lag_sd
+    (secs) and ibi_mae (ms, successive matched beats).
+    NaN for intervals with missing start/end times.
+    """
+    ref_times = np.asarray(ref_times, dtype = np.float64)
+    other_times = np.asarray(other_times, dtype = np.float64)-offset
+    boundaries = np.asarray(boundaries, dtype = np.float64).reshape(-1, 2)
+    matches, lags = match_beats(ref_times, other_times, tolerance)
+    matched = matches >= 0
+    # ibi difference where a beat and the one before are both matched
+    both = matched[1:] & matched[:-1]
+    ibi_diffs = np.full(len(ref_times), np.nan)
+    ibi_diffs[1:][both] = np.abs(np.diff(ref_times)[both]
+                            -(other_times[matches[1:][both]]-other_times[matches[:-1][both]]))*1000
+    missing = np.isnan(boundaries).any(axis = 1)
+    ref_bounds = np.searchsorted(ref_times, boundaries)
+    other_bounds = np.searchsorted(other_times, boundaries)
+    agreement = []
+    for interval_name, (start, end), (other_start, other_end), is_missing in zip(
+                                    interval_names, ref_bounds, other_bounds, missing):
+        if is_missing:
+            agreement.append({"interval": interval_name})
+            continue
+        n_ref = end-start
+        n_matched = matched[start:end].sum()
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            match_rate = n_matched/n_ref
+        interval_lags = lags[start:end]
+        # ibi_diffs[i] is set where both[i-1] is (never for i = 0)
+        both_start, both_end = max(start, 1)-1, max(end, 1)-1
+        agreement.append({
+                        "interval": interval_name,
+                        "n_ref": n_ref,
+                        "n_other": other_end-other_start,
+                        "match_rate": match_rate,
+                        "dropout_rate": 1-match_rate,
+                        "lag_mean": np.nanmean(interval_lags) if n_matched else np.nan,
+                        "lag_sd": np.nanstd(interval_lags) if n_matched else np.nan,
+                        "ibi_mae": np.nanmean(ibi_diffs[start:end]) if both[both_start:both_end].any() else np.nan
+                        })
+    return pd.DataFrame(agreement)
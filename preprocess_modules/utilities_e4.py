@@ -1,6 +1,23 @@
+import os
 import re
+import warnings
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from zoneinfo import ZoneInfo
+import numpy as np
+import pandas as pd
+
+# E4 signal files and their columns
+E4_SIGNALS = {
+            "EDA": ["EDA"], "BVP": ["BVP"], "ACC": ["x","y","z"],
+            "TEMP": ["TEMP"], "HR": ["HR"], "IBI": ["time","IBI"]
+            }
+# time zone of the study site. E4 times are unix (UTC), qualtrics
+# times are local, so E4 times are converted to this zone rather than
+# to the time zone of the machine running the scripts
+# (on Windows, zoneinfo needs the tzdata package)
+STUDY_TZ = "Europe/London"
 
 
 def get_participant_num(folder_name):
@@ -73,23 +90,67 @@ def get_rowdiff(values):
 
     Paramters
     ---------
-    values
+    values: array-like
+        tag times for one participant
 
     Returns
         differences between successive
-        rows
+        rows (first row is kept as is)
     """
+    values = np.asarray(values, dtype = np.float64)
     if len(values)<=1:
         return values
-    else:
-        new_vals = []
-        for i,val in enumerate(values):
-            if i==0:
-                new_val = val
-            else:
-                new_val = val-values[i-1]
-            new_vals.append(new_val)
-    return new_vals
+    return np.concatenate([values[:1], np.diff(values)])
+
+def pack_ragged(arrays):
+    """
+    Pack 1d arrays of different lengths (eg tag
+    times per participant) into a single NaN-padded
+    array, one column per array.
+
+    Parameters
+    ----------
+    arrays: list of array-like
+        values for each column (eg participant)
+    
+    Returns
+    -------
+    float64 array of shape (max length,
+    number of arrays), NaN where an array
+    is shorter.
+    """
+    lengths = np.array([len(values) for values in arrays], dtype = np.int64)
+    n_rows = lengths.max() if len(lengths) else 0
+    packed = np.full((len(arrays), n_rows), np.nan)
+    if n_rows:
+        packed[np.arange(n_rows) < lengths[:,None]] = np.concatenate(
+                                                    [np.asarray(values, dtype = np.float64)
+                                                    for values in arrays]
+                                                    )
+    return packed.T
+
+def get_tag_deltas(tags, pnums):
+    """
+    calculate difference between successive
+    tags for all participants in one go.
+    Same as get_rowdiff() for each column.
+
+    Parameters
+    ----------
+    tags:   np.ndarray
+        packed tag times, as returned by pack_ragged()
+    pnums:  list
+        participant number for each column
+
+    Returns
+    -------
+    dataframe of row-to-row differences, one col per
+    participant (first row is kept as is, NaN padded)
+    """
+    tag_deltas = np.empty_like(tags)
+    tag_deltas[:1] = tags[:1]
+    tag_deltas[1:] = np.diff(tags, axis = 0)
+    return pd.DataFrame(tag_deltas, columns = pnums)
 
 def find_min_delta(tag_deltas, axis = 0):
     """
@@ -108,7 +169,7 @@ def find_min_delta(tag_deltas, axis = 0):
     -------
         min value for each column (participant)
     """
-    min_diffs = tag_deltas.apply(lambda x: min(x),axis = axis)
+    min_diffs = tag_deltas.min(axis = axis)
     return min_diffs
 
 def return_likely_doubles(min_deltas, time_delta_df, threshold):
@@ -164,28 +225,68 @@ def get_num_double_tags(double_tag_df):
                                         ).value_counts()
     return double_counts
 
-def get_best_thresh(tag_val_counts):
+def sweep_double_thresholds(min_deltas, tag_deltas, thresholds, num_doubles = 2):
+    """
+    Get number of participants with exactly num_doubles
+    likely double tags for each threshold in one go
+    (same rule as return_likely_doubles()).
+
+    Parameters
+    ----------
+    min_deltas: pd Series
+        minimum difference between rows
+        for each participant
+    tag_deltas: pd DataFrame
+        dataframe representing differences
+        between successive rows
+    thresholds: array-like
+        thresholds to test
+        eg np.arange(1.5, 5, 0.01)
+    num_doubles:    int
+        number of double tags expected per participant
+    
+    Returns
+    -------
+    number of participants with num_doubles double tags
+    for each threshold, and array (thresholds x participants)
+    with the number of double tags for each participant.
+    """
+    thresholds = np.asarray(thresholds, dtype = np.float64)
+    deltas = tag_deltas.to_numpy(dtype = np.float64)
+    limits = thresholds[:,None]*min_deltas.to_numpy(dtype = np.float64)[None,:]
+    # thresholds x rows x participants; NaN padding compares False
+    double_counts = (deltas[None,:,:] <= limits[:,None,:]).sum(axis = 1)
+    num_with_doubles = (double_counts == num_doubles).sum(axis = 1)
+    return num_with_doubles, double_counts
+
+def get_best_thresh(num_with_doubles, thresholds):
     """
     get threshold that maximises
     number of double tags detected
 
     Parameters
     ----------
-    tag_val_counts: list of tuples
-        of type [(two_counts, threshold)]
+    num_with_doubles:   array-like
+        number of participants with two double
+        tags for each threshold
+        (see sweep_double_thresholds())
+    thresholds: array-like
+        thresholds tested
     
     Returns
     -------
-        Threshold at which max number of 
+        Lowest threshold at which max number of 
         two double tags were detected.
 
     """
-    max_num = max([val[0] for val in tag_val_counts])
-    max_threshold = [thresh for (num,thresh)
-                    in tag_val_counts if num == max_num]
-    if len(max_threshold)>1:
+    num_with_doubles = np.asarray(num_with_doubles)
+    is_max = num_with_doubles == num_with_doubles.max()
+    # neighbouring thresholds giving the same result are expected
+    # for a fine grid, separate peaks are not
+    num_peaks = np.count_nonzero(np.diff(np.concatenate([[0], is_max.astype(int)])) == 1)
+    if num_peaks>1:
         print(f"More than 1 max val detected. Manual check advised.")
-    return max_threshold
+    return thresholds[np.argmax(is_max)]
 
 def detect_missing_doubles(double_tags_df):
     """
@@ -287,7 +388,7 @@ def check_double_tags(double_tag_df, num_tags):
     double_view_df = double_tag_df.loc[
                                         :,double_tag_df.notna().sum()==num_tags
                                         ]
-    if double_view_df.shape[1]<=1:
+    if double_view_df.shape[1]==0:
         print("No participants found for this number of tags.")
     else:
         return double_view_df
@@ -312,13 +413,923 @@ def get_only_time(in_df, time_cols:list[str]):
             lambda x: datetime.strptime(x,"%H:%M").time())
     return in_df
 
-def get_eda_intervals(eda_df, start_secs, end_secs, samp_rate):
+def get_eda_intervals(eda_df, start_secs, end_secs, samp_rate, offset_secs = 0):
     """
     Get eda data for specified
     time interval
     (eg Film, RT1, RT2,...)
+
+    Parameters
+    ----------
+    eda_df: pd DataFrame
+        EDA data (w/o header rows)
+    start_secs, end_secs:   float
+        interval start/end in secs from
+        reference (Firstbeat) start
+    samp_rate:  float
+        sample rate in Hz (see read_e4_header())
+    offset_secs:    float
+        secs from start of E4 recording to
+        reference start (see get_clock_offset())
+
+    Returns
+    -------
+    rows of eda_df for the interval
     """
-    start_ind = int(start_secs)*samp_rate
-    end_ind = int(end_secs)*samp_rate
+    start_ind, end_ind = get_row_range(start_secs, end_secs, samp_rate, offset_secs)
     eda_sec_df = eda_df.iloc[start_ind:end_ind]
-    return eda_sec_df
\ No newline at end of file
+    return eda_sec_df
+
+def get_row_range(start_secs, end_secs, samp_rate, offset_secs = 0):
+    """
+    Convert interval start/end times to
+    rows of an E4 signal file (excluding
+    the header rows).
+
+    Parameters
+    ----------
+    see get_eda_intervals()
+
+    Returns
+    -------
+    start and end row (end row not included).
+    If the interval starts before the recording,
+    a warning is given and no rows are returned
+    (rather than a shortened interval).
+    """
+    if start_secs+offset_secs < 0:
+        warnings.warn(f"Interval starts {-(start_secs+offset_secs):.0f} secs before the E4 recording.\nManual check advised.")
+        return 0, 0
+    start_ind = int((start_secs+offset_secs)*samp_rate)
+    end_ind = max(int((end_secs+offset_secs)*samp_rate), start_ind)
+    return start_ind, end_ind
+
+def read_e4_header(signal_path):
+    """
+    Read header of E4 signal file (EDA, BVP,
+    ACC, TEMP, HR). First row is the start time
+    of the recording (unix timestamp, UTC), second
+    row the sample rate (Hz), repeated for each column.
+
+    Parameters
+    ----------
+    signal_path:    str
+        path to signal file, eg .../p012/EDA.csv
+    
+    Returns
+    -------
+    start time, sample rate and number of columns
+    """
+    with open(signal_path, "rb") as f:
+        start_row = f.readline().split(b",")
+        rate_row = f.readline().split(b",")
+    start_time = float(start_row[0])
+    samp_rate = float(rate_row[0])
+    return start_time, samp_rate, len(start_row)
+
+def build_line_index(signal_path, header_rows = 2, chunk_size = 2**20):
+    """
+    Get byte offset of each data row in an E4 signal
+    file with a buffered scan for newlines (no parsing).
+    Use with read_e4_rows() to read only the rows you need.
+
+    Parameters
+    ----------
+    signal_path:    str
+        path to signal file
+    header_rows:    int
+        number of header rows to skip
+    chunk_size: int
+        bytes to read at a time
+
+    Returns
+    -------
+    int64 array with the offset of each data row,
+    plus the end of the last row. Number of data rows
+    is len(line_index)-1.
+    """
+    offsets = []
+    pos = 0
+    with open(signal_path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype = np.uint8) == ord("\n"))
+            offsets.append(newlines+pos+1)
+            pos += len(chunk)
+            last_byte = chunk[-1:]
+    line_starts = np.concatenate([[0]]+offsets).astype(np.int64)
+    # file not ending with a newline: last row ends at end of file
+    if pos and last_byte != b"\n":
+        line_starts = np.append(line_starts, pos)
+    return line_starts[header_rows:]
+
+def read_e4_rows(signal_path, line_index, start_row, end_row, n_cols = 1):
+    """
+    Read rows start_row:end_row of an E4 signal file,
+    seeking straight to them via the line index.
+
+    Parameters
+    ----------
+    signal_path:    str
+        path to signal file
+    line_index: np.ndarray
+        from build_line_index()
+    start_row, end_row: int
+        rows to read (excluding header rows;
+        end_row not included)
+    n_cols: int
+        number of columns in the file (eg 3 for ACC)
+
+    Returns
+    -------
+    float32 array, shape (n_rows,) or (n_rows, n_cols).
+    Rows beyond the end of the file are ignored.
+    """
+    n_rows = len(line_index)-1
+    start_row = min(max(start_row, 0), n_rows)
+    end_row = min(max(end_row, start_row), n_rows)
+    with open(signal_path, "rb") as f:
+        f.seek(line_index[start_row])
+        buf = f.read(line_index[end_row]-line_index[start_row])
+    values = np.array(buf.replace(b",", b" ").split(), dtype = np.float32)
+    if n_cols > 1:
+        values = values.reshape(-1, n_cols)
+    return values
+
+def to_study_time(unix_time, tz = STUDY_TZ):
+    """
+    Convert unix timestamp (eg E4 start time)
+    to local time at the study site.
+
+    Parameters
+    ----------
+    unix_time:  float
+        unix timestamp (UTC)
+    tz: str
+        time zone name, eg "Europe/London"
+
+    Returns
+    -------
+    timezone aware datetime
+    """
+    return datetime.fromtimestamp(unix_time, tz = ZoneInfo(tz))
+
+def get_clock_offset(e4_start_time, reference_time, tz = STUDY_TZ):
+    """
+    Get secs from start of E4 recording to a
+    reference time (eg Firstbeat start from qualtrics).
+    Compares time of day only, as qualtrics times
+    have no date.
+
+    Parameters
+    ----------
+    e4_start_time:  float
+        unix timestamp from E4 header (see read_e4_header())
+    reference_time: datetime, np.datetime64 or pd Timestamp
+        reference time in local time
+    tz: str
+        time zone of the study site (see to_study_time())
+    
+    Returns
+    -------
+    offset in secs (NaN if reference_time is missing)
+    """
+    if pd.isna(reference_time):
+        return np.nan
+    reference_time = pd.Timestamp(reference_time)
+    e4_start = to_study_time(e4_start_time, tz)
+    e4_secs = (e4_start.hour*3600+e4_start.minute*60
+                +e4_start.second+e4_start.microsecond/1e6)
+    ref_secs = (reference_time.hour*3600+reference_time.minute*60
+                +reference_time.second+reference_time.microsecond/1e6)
+    return ref_secs-e4_secs
+
+def read_e4_ibi(ibi_path):
+    """
+    Read E4 IBI.csv. First row is the start time
+    of the recording (unix timestamp), the other rows
+    are beat time (secs from start) and IBI (secs).
+
+    Parameters
+    ----------
+    ibi_path:   str
+        path to IBI.csv
+
+    Returns
+    -------
+    start time and float64 array of shape (n_beats, 2)
+    """
+    with open(ibi_path, "rb") as f:
+        start_time = float(f.readline().split(b",")[0])
+        buf = f.read()
+    ibi = np.array(buf.replace(b",", b" ").split(), dtype = np.float64).reshape(-1, 2)
+    return start_time, ibi
+
+def segment_e4_participant(folder_path, pnum, boundaries, interval_names,
+    reference_time = None, signals = ("EDA",), min_session_secs = 0, tz = STUDY_TZ):
+    """
+    Cut out all intervals from all selected E4 signals
+    for one participant. Each signal file is indexed once
+    and only the rows needed for the intervals are read.
+
+    Parameters
+    ----------
+    folder_path:    str
+        participant E4 folder
+    pnum:   int or float
+        participant number
+    boundaries: array-like
+        interval start/end times in secs from reference
+        start, shape (n_intervals, 2) or flat
+    interval_names: list[str]
+        names of intervals, in the same order as boundaries
+    reference_time: datetime, optional
+        time of day the interval times refer to (eg Firstbeat
+        start). If None, intervals are taken from E4 start.
+    signals:    list[str]
+        signals to segment, keys of E4_SIGNALS
+    min_session_secs:   float
+        signals with a shorter recording are flagged
+        and skipped
+    tz: str
+        time zone of the study site (see to_study_time())
+
+    Returns
+    -------
+    list of segments (signal, interval, pnum, values)
+    for utilities_store.write_segments(), and dict of
+    flags: "missing_file" ([pnum, signal]), "bad_header"
+    ([pnum, signal]), "short" ([pnum, signal]), "no_data"
+    and "before_start" ([pnum, signal, interval]), and dict
+    of sample rate (Hz, from the file header) for each
+    signal that was read (None for IBI, as it is irregular).
+    """
+    boundaries = np.asarray(boundaries, dtype = np.float64).reshape(-1, 2)
+    segments = []
+    samp_rates = {}
+    flags = {"missing_file": [], "bad_header": [], "short": [], "no_data": [], "before_start": []}
+    for signal in signals:
+        signal_path = os.path.join(folder_path, f"{signal}.csv")
+        try:
+            if signal == "IBI":
+                start_time, ibi = read_e4_ibi(signal_path)
+                n_secs = ibi[-1,0] if len(ibi) else 0
+                samp_rate = None
+            else:
+                start_time, samp_rate, n_cols = read_e4_header(signal_path)
+                line_index = build_line_index(signal_path)
+                n_secs = (len(line_index)-1)/samp_rate
+        except FileNotFoundError:
+            print(f"No {signal} file found for participant {pnum}. Manual check advised.")
+            flags["missing_file"].append([pnum, signal])
+            continue
+        except (ValueError, IndexError):
+            print(f"{signal} file for participant {pnum} could not be read. Manual check advised.")
+            flags["bad_header"].append([pnum, signal])
+            continue
+        if n_secs<min_session_secs:
+            print(f"{signal} recording for participant {pnum} seems short. Manual check advised.")
+            flags["short"].append([pnum, signal])
+            continue
+        samp_rates[signal] = samp_rate
+        offset_secs = 0
+        if reference_time is not None:
+            offset_secs = get_clock_offset(start_time, reference_time, tz)
+        for interval_name, (start_secs, end_secs) in zip(interval_names, boundaries):
+            if np.isnan([start_secs, end_secs, offset_secs]).any():
+                print(f"At least one of start_val, stop_val missing for {interval_name} interval. Skipping for participant {pnum}.")
+                continue
+            if start_secs+offset_secs < 0:
+                # not clamped to the start of the recording, as the interval would be cut short
+                warnings.warn(f"{interval_name} interval starts {-(start_secs+offset_secs):.0f} secs before the {signal} recording for participant {pnum}. Skipping.\nManual check advised.")
+                flags["before_start"].append([pnum, signal, interval_name])
+                continue
+            if signal == "IBI":
+                start_ind, end_ind = np.searchsorted(
+                                                    ibi[:,0],
+                                                    [start_secs+offset_secs, end_secs+offset_secs]
+                                                    )
+                values = ibi[start_ind:end_ind]
+            else:
+                start_row, end_row = get_row_range(start_secs, end_secs, samp_rate, offset_secs)
+                values = read_e4_rows(signal_path, line_index, start_row, end_row, n_cols)
+            if len(values) == 0:
+                warnings.warn(f"Participant {pnum} has no valid {signal} data for {interval_name} interval.\nManual check advised.")
+                flags["no_data"].append([pnum, signal, interval_name])
+                continue
+            segments.append((signal.lower(), interval_name, pnum, values))
+    return segments, flags, samp_rates
+
+def write_segment_csv(output_dir, signal, interval_name, pnum, values):
+    """
+    Write segment to its own csv file,
+    eg Film_12_eda.csv.
+
+    Parameters
+    ----------
+    output_dir: str
+        directory to write to
+    signal: str
+        signal name (key of E4_SIGNALS, any case)
+    interval_name:  str
+        interval name, eg "Film"
+    pnum:   int or float
+        participant number
+    values: np.ndarray
+        segment data
+    """
+    columns = E4_SIGNALS[signal.upper()]
+    out_df = pd.DataFrame(np.asarray(values).reshape(len(values), -1), columns = columns)
+    out_df.to_csv(os.path.join(output_dir, "_".join([interval_name,str(int(pnum)),f"{signal.lower()}.csv"])),index = False)
+
+def count_rows(signal_path, header_rows = 2, chunk_size = 2**20):
+    """
+    Count data rows in a signal file with a
+    buffered byte scan (no parsing).
+
+    Parameters
+    ----------
+    signal_path:    str
+        path to signal file
+    header_rows:    int
+        number of header rows
+    chunk_size: int
+        bytes to read at a time
+
+    Returns
+    -------
+    number of data rows
+    """
+    n_lines = 0
+    last_byte = b"\n"
+    with open(signal_path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            n_lines += chunk.count(b"\n")
+            last_byte = chunk[-1:]
+    # last row without newline at end of file
+    if last_byte != b"\n":
+        n_lines += 1
+    return max(n_lines-header_rows, 0)
+
+def estimate_num_rows(signal_path, header_rows = 2, sample_bytes = 2**16):
+    """
+    Estimate number of data rows in a signal file
+    from the file size and the average row width
+    in the first sample_bytes of data.
+
+    Parameters
+    ----------
+    signal_path:    str
+        path to signal file
+    header_rows:    int
+        number of header rows
+    sample_bytes:   int
+        bytes of data to sample
+    
+    Returns
+    -------
+    estimated number of data rows
+    """
+    file_size = os.path.getsize(signal_path)
+    with open(signal_path, "rb") as f:
+        for _ in range(header_rows):
+            f.readline()
+        header_size = f.tell()
+        sample = f.read(sample_bytes)
+    n_sampled = sample.count(b"\n")
+    # whole file was sampled (or single row): count is exact
+    if header_size+len(sample) >= file_size or n_sampled == 0:
+        return n_sampled+(1 if sample and not sample.endswith(b"\n") else 0)
+    row_width = sample.rfind(b"\n")/n_sampled
+    return int((file_size-header_size)/row_width)
+
+def get_ibi_duration(ibi_path, tail_bytes = 256):
+    """
+    Get duration of E4 IBI recording from the
+    last beat time, reading only the end of the file.
+
+    Parameters
+    ----------
+    ibi_path:   str
+        path to IBI.csv
+    tail_bytes: int
+        bytes to read from the end of the file
+    
+    Returns
+    -------
+    secs from start of recording to last beat
+    (0 if there are no beats)
+    """
+    file_size = os.path.getsize(ibi_path)
+    with open(ibi_path, "rb") as f:
+        first_row = f.readline()
+        f.seek(max(file_size-tail_bytes, len(first_row)))
+        tail = f.read().strip()
+    if not tail:
+        return 0
+    return float(tail.split(b"\n")[-1].split(b",")[0])
+
+def check_recording_lengths(e4_dir, participant_folders, signals = ("EDA",),
+    min_session_secs = 0, margin = 0.05):
+    """
+    Check length of E4 recordings for all participant folders
+    and signals without reading the data. Lengths are estimated
+    from file size, and only counted exactly if the estimate is
+    within margin of min_session_secs.
+
+    Parameters
+    ----------
+    e4_dir: str
+        E4 directory
+    participant_folders:    list[str]
+        participant folder names
+    signals:    list[str]
+        signals to check, keys of E4_SIGNALS
+    min_session_secs:   float
+        min recording length
+    margin: float
+        proportion of min_session_secs within which
+        rows are counted exactly
+
+    Returns
+    -------
+    dataframe with folder, participant_number, signal, n_secs
+    and status ("ok", "short", "empty" or "missing") for
+    each folder and signal.
+    """
+    checks = []
+    for folder in participant_folders:
+        pnum = get_participant_num(folder)
+        for signal in signals:
+            signal_path = os.path.join(e4_dir, folder, f"{signal}.csv")
+            n_secs = np.nan
+            try:
+                if os.path.getsize(signal_path) == 0:
+                    status = "empty"
+                elif signal == "IBI":
+                    n_secs = get_ibi_duration(signal_path)
+                else:
+                    _, samp_rate, _ = read_e4_header(signal_path)
+                    n_secs = estimate_num_rows(signal_path)/samp_rate
+                    if abs(n_secs-min_session_secs) <= margin*min_session_secs:
+                        n_secs = count_rows(signal_path)/samp_rate
+            except FileNotFoundError:
+                status = "missing"
+            except (ValueError, IndexError, ZeroDivisionError):
+                status = "empty"
+            else:
+                if not np.isnan(n_secs):
+                    status = "ok" if n_secs >= min_session_secs and n_secs > 0 else "short"
+            checks.append([folder, pnum, signal, n_secs, status])
+    return pd.DataFrame(checks, columns = ["folder","participant_number","signal","n_secs","status"])
+
+def scan_participant_folders(e4_dir):
+    """
+    Get participant folders (p0XX...) in the E4
+    directory with a single directory scan.
+
+    Parameters
+    ----------
+    e4_dir: str
+        E4 directory
+    
+    Returns
+    -------
+    sorted list of folder names
+    """
+    with os.scandir(e4_dir) as entries:
+        folders = [entry.name for entry in entries
+                    if entry.is_dir() and re.search("^p[0][0-9][0-9]",entry.name.lower())]
+    return sorted(folders)
+
+def read_tags(tags_path, skip_first = True):
+    """
+    Read E4 tags.csv (one unix timestamp per row).
+
+    Parameters
+    ----------
+    tags_path:  str
+        path to tags.csv
+    skip_first: bool
+        skip first row (as reading the file with
+        pd.read_csv(header = 0) does)
+    
+    Returns
+    -------
+    float64 array of tag times
+    """
+    with open(tags_path, "rb") as f:
+        tags = np.array(f.read().split(), dtype = np.float64)
+    if skip_first:
+        tags = tags[1:]
+    return tags
+
+def load_tag_files(e4_dir, min_tags = 14, n_workers = 8, participant_folders = None):
+    """
+    Load tags.csv for all participants. Files are read
+    concurrently on a thread pool (reading is I/O bound).
+    Participants with more than one folder, no tags file
+    or fewer than min_tags tags are flagged and left out.
+
+    Parameters
+    ----------
+    e4_dir: str
+        E4 directory
+    min_tags:   int
+        min number of tags expected
+    n_workers:  int
+        number of threads
+    participant_folders:    list[str] or None
+        participant folders (eg from the file catalog).
+        If None, the E4 directory is scanned.
+
+    Returns
+    -------
+    tags:   np.ndarray
+        packed tag times (tags x participants, see pack_ragged())
+    pnums:  list[int]
+        participant number for each column of tags
+    flags:  dict
+        participant numbers for "duplicates", "missing"
+        and "below_min"
+    """
+    if participant_folders is None:
+        participant_folders = scan_participant_folders(e4_dir)
+    duplicates = flag_duplicates(participant_folders)
+    folders = []
+    for folder in participant_folders:
+        pnum = get_participant_num(folder)
+        if pnum in duplicates:
+            print(f"More than one tag file exists for participant {pnum}. Skipping.")
+            continue
+        folders.append((pnum, os.path.join(e4_dir, folder, "tags.csv")))
+
+    def read_participant_tags(folder):
+        try:
+            return read_tags(folder[1])
+        except FileNotFoundError:
+            return None
+
+    with ThreadPoolExecutor(max_workers = n_workers) as executor:
+        all_tags = list(executor.map(read_participant_tags, folders))
+    flags = {"duplicates": duplicates, "missing": [], "below_min": []}
+    pnums = []
+    tag_arrays = []
+    for (pnum, _), tags in zip(folders, all_tags):
+        if tags is None:
+            print(f"No tags file found for participant {pnum}.Manual check advised.")
+            flags["missing"].append(pnum)
+        elif len(tags)<min_tags:
+            print(f"Participant {pnum} recorded fewer than the minimum number of tags. Manual check advised.")
+            flags["below_min"].append(pnum)
+        else:
+            pnums.append(pnum)
+            tag_arrays.append(tags)
+    return pack_ragged(tag_arrays), pnums, flags
+
+def get_tag_qc(tags, pnum, threshold, min_tags = 14, num_doubles = 2):
+    """
+    Tag checks for a single participant, eg as soon
+    as their data comes in. Uses the same double tag
+    rule as return_likely_doubles(), with a threshold
+    from an earlier run over the whole cohort
+    (see get_best_thresh()).
+
+    Parameters
+    ----------
+    tags:   array-like
+        tag times (see read_tags())
+    pnum:   int or float
+        participant number
+    threshold:  float
+        double tag threshold
+    min_tags:   int
+        min number of tags expected
+    num_doubles:    int
+        number of double tags expected
+
+    Returns
+    -------
+    dict with participant_number, n_tags, n_doubles,
+    below_min and check (True if worth checking manually)
+    """
+    tags = np.asarray(tags, dtype = np.float64)
+    n_doubles = 0
+    if len(tags)>1:
+        deltas = get_tag_deltas(pack_ragged([tags]), [pnum])
+        double_df = return_likely_doubles(find_min_delta(deltas), deltas, threshold)
+        n_doubles = int(double_df.notna().sum().iloc[0])
+    below_min = len(tags)<min_tags
+    return {
+            "participant_number": pnum, "n_tags": len(tags), "n_doubles": n_doubles,
+            "below_min": below_min, "check": below_min or n_doubles != num_doubles
+            }
+
+def _moving_average(values, window):
+    """
+    Centred moving average along rows of NaN-padded
+    array, ignoring NaNs (shorter window at the edges).
+    """
+    n_cols = values.shape[1]
+    valid = ~np.isnan(values)
+    zeros = np.zeros((values.shape[0], 1))
+    sums = np.concatenate([zeros, np.cumsum(np.where(valid, values, 0), axis = 1)], axis = 1)
+    counts = np.concatenate([zeros, np.cumsum(valid, axis = 1)], axis = 1)
+    half_window = window//2
+    col_inds = np.arange(n_cols)
+    lo = np.clip(col_inds-half_window, 0, n_cols)
+    hi = np.clip(col_inds+half_window+1, 0, n_cols)
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        averaged = (sums[:,hi]-sums[:,lo])/(counts[:,hi]-counts[:,lo])
+    averaged[~valid] = np.nan
+    return averaged
+
+def get_eda_features(segments, samp_rate = 4.0, tonic_window_secs = 10.0, min_amplitude = 0.01,
+    interval_names = None, pnums = None):
+    """
+    Get EDA features for all participants and intervals
+    in one go. Segments are packed into a single NaN-padded
+    array and the tonic (skin conductance level) component is
+    taken as a centred moving average (low-pass filter). The
+    phasic component is the difference between the signal
+    and the tonic component.
+
+    Parameters
+    ----------
+    segments:   iterable of tuples
+        (signal, interval, pnum, values), as returned by
+        segment_e4_participant(). Only "eda" segments are used.
+    samp_rate:  float or dict
+        sample rate in Hz, either one for all segments or
+        participant number -> sample rate from the EDA file
+        header (see segment_e4_participant())
+    tonic_window_secs:  float
+        length of moving average window for the tonic component
+    min_amplitude:  float
+        min phasic amplitude (uS) for a peak to count as SCR
+    interval_names: list[str] or None
+        if given, there is a row for every participant and
+        interval (NaN features where the interval is missing),
+        as in utilities_hrv.get_hrv_features()
+    pnums:  list or None
+        participants to include when interval_names is given
+        (None = participants with at least one segment)
+
+    Returns
+    -------
+    dataframe with one row per participant and interval
+    (participant_number, interval, n_samples, mean_eda, scl,
+    scr_count, scr_amplitude, auc). auc is the area of the
+    phasic component above zero in uS*s.
+    """
+    segments = [(pnum, interval, values) for signal, interval, pnum, values
+                in segments if signal.lower() == "eda"]
+    features_df = pd.DataFrame({
+                                "participant_number": np.array([pnum for pnum, _, _ in segments], dtype = np.int64),
+                                "interval": pd.Series([interval for _, interval, _ in segments], dtype = object)
+                                })
+    if segments:
+        eda = pack_ragged([np.ravel(values) for _, _, values in segments]).T
+        if isinstance(samp_rate, dict):
+            rates = np.array([samp_rate[pnum] for pnum, _, _ in segments], dtype = np.float64)
+        else:
+            rates = np.full(len(segments), samp_rate, dtype = np.float64)
+        # moving average window depends on sample rate (usually the same for everyone)
+        tonic = np.full(eda.shape, np.nan)
+        for rate in np.unique(rates):
+            rows = rates == rate
+            tonic[rows] = _moving_average(eda[rows], max(int(tonic_window_secs*rate), 1))
+        phasic = eda-tonic
+        # local maxima of phasic component above min_amplitude (NaN compares False)
+        mid = phasic[:,1:-1]
+        peaks = (mid > phasic[:,:-2]) & (mid >= phasic[:,2:]) & (mid > min_amplitude)
+        scr_count = peaks.sum(axis = 1)
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            features_df["n_samples"] = (~np.isnan(eda)).sum(axis = 1)
+            features_df["mean_eda"] = np.nanmean(eda, axis = 1)
+            features_df["scl"] = np.nanmean(tonic, axis = 1)
+            features_df["scr_count"] = scr_count
+            features_df["scr_amplitude"] = np.where(peaks, mid, 0).sum(axis = 1)/scr_count
+            features_df["auc"] = np.nansum(np.clip(phasic, 0, None), axis = 1)/rates
+    else:
+        for col in ["n_samples","mean_eda","scl","scr_count","scr_amplitude","auc"]:
+            features_df[col] = np.nan
+    if interval_names is None:
+        return features_df
+    if pnums is None:
+        pnums = list(dict.fromkeys(features_df.participant_number))
+    grid_df = pd.DataFrame({
+                            "participant_number": np.repeat(np.asarray(pnums, dtype = np.int64), len(interval_names)),
+                            "interval": np.tile(interval_names, len(pnums))
+                            })
+    return grid_df.merge(features_df, on = ["participant_number","interval"], how = "left")
+
+def tags_to_long(tags, pnums):
+    """
+    Convert packed tags to one row per tag.
+
+    Parameters
+    ----------
+    tags:   np.ndarray
+        packed tag times (see pack_ragged())
+    pnums:  list
+        participant number for each column of tags
+
+    Returns
+    -------
+    dataframe with participant_number, tag_num
+    and tag_time (unix) for each tag.
+    """
+    tag_nums, cols = np.nonzero(~np.isnan(tags))
+    tags_long = pd.DataFrame({
+                            "participant_number": np.asarray(pnums, dtype = np.int64)[cols],
+                            "tag_num": tag_nums,
+                            "tag_time": tags[tag_nums, cols]
+                            })
+    return tags_long.sort_values(["participant_number","tag_num"]).reset_index(drop = True)
+
+def events_to_unix(events_df, id_col, event_cols, ref_times, tz = STUDY_TZ):
+    """
+    Convert qualtrics event times (time of day) to unix
+    timestamps, using the date of a reference unix time
+    for each participant (eg their first E4 tag).
+
+    Parameters
+    ----------
+    events_df:  pd DataFrame
+        qualtrics data with event times as datetimes
+        (see utilities_hrv.convert_time_cols())
+    id_col: str
+        name of column containing participant ids
+    event_cols: dict
+        event name -> column in events_df
+        eg {"Firstbeat": "firstbeat_start"}
+    ref_times:  dict
+        participant number -> reference unix time
+    tz: str
+        time zone of the study site, the qualtrics times
+        are local times there (see to_study_time())
+    
+    Returns
+    -------
+    dataframe with participant_number, event and event_time
+    (unix) for each participant in ref_times and event.
+    Events with missing times are left out.
+    """
+    events_df = events_df[events_df[id_col].isin(list(ref_times))]
+    pnums = events_df[id_col].to_numpy(dtype = np.int64)
+    # local date at the study site of each participant's reference time
+    ref_local = pd.to_datetime(pd.Series([ref_times[pnum] for pnum in pnums], dtype = np.float64),
+                                unit = "s", utc = True).dt.tz_convert(tz)
+    dates = ref_local.dt.tz_localize(None).dt.normalize().to_numpy()
+    epoch = pd.Timestamp(0, tz = "UTC")
+    events_long = []
+    for event, col in event_cols.items():
+        times = pd.to_datetime(events_df[col])
+        local_times = pd.Series(dates+(times-times.dt.normalize()).to_numpy())
+        # local time at the study site -> unix (DST aware)
+        unix_times = local_times.dt.tz_localize(tz, ambiguous = "NaT", nonexistent = "NaT")
+        events_long.append(pd.DataFrame({
+                                        "participant_number": pnums,
+                                        "event": event,
+                                        "event_time": (unix_times-epoch).dt.total_seconds().to_numpy()
+                                        }))
+    events_long = pd.concat(events_long, ignore_index = True).dropna(subset = ["event_time"])
+    return events_long.sort_values(["participant_number","event_time"]).reset_index(drop = True)
+
+def _fit_clock(matched):
+    """
+    Least squares fit of tag-event residual against event
+    time for each participant: residual = offset + drift*t,
+    with t in secs from the participant's first matched event.
+    """
+    t = matched.event_time-matched.groupby("participant_number").event_time.transform("min")
+    fit_df = pd.DataFrame({
+                        "participant_number": matched.participant_number,
+                        "t": t, "r": matched.residual,
+                        "tt": t*t, "tr": t*matched.residual
+                        })
+    sums = fit_df.groupby("participant_number").agg(
+                                                    n = ("t","size"), t = ("t","sum"),
+                                                    r = ("r","sum"), tt = ("tt","sum"),
+                                                    tr = ("tr","sum")
+                                                    )
+    denom = sums.n*sums.tt-sums.t**2
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        drift = (sums.n*sums.tr-sums.t*sums.r)/denom
+    # fewer than two distinct event times: no drift estimate
+    drift = drift.where(denom > 1e-9)
+    offset = (sums.r-drift.fillna(0)*sums.t)/sums.n
+    return pd.DataFrame({"offset_secs": offset, "drift": drift, "n_matched": sums.n})
+
+def align_tags(tags_long, events_long, tolerance_secs = 120, n_iter = 2):
+    """
+    Match E4 tags to expected (qualtrics) events for all
+    participants. An initial clock offset per participant is
+    the median difference between each event and its nearest
+    tag. Tags are then matched to the nearest offset-corrected
+    event within tolerance_secs (sorted as-of merge), and
+    offset and drift are re-estimated from the matches.
+
+    Parameters
+    ----------
+    tags_long:  pd DataFrame
+        one row per tag (see tags_to_long())
+    events_long:    pd DataFrame
+        one row per expected event (see events_to_unix())
+    tolerance_secs: float
+        max distance between tag and event for a match
+    n_iter: int
+        number of match/re-estimate rounds
+
+    Returns
+    -------
+    labelled_df:    pd DataFrame
+        tags_long with matched event (NaN if none) and
+        residual (tag time - corrected event time)
+    clock_df:   pd DataFrame
+        per participant offset_secs (E4 - qualtrics clock),
+        drift (secs per sec), n_matched and n_events
+    """
+    tags_long = tags_long.sort_values("tag_time")
+    events_long = events_long.sort_values("event_time")
+    # initial offset: each event to its nearest tag
+    nearest = pd.merge_asof(
+                            events_long, tags_long[["participant_number","tag_time"]],
+                            left_on = "event_time", right_on = "tag_time",
+                            by = "participant_number", direction = "nearest"
+                            )
+    clock_df = pd.DataFrame({
+                            "offset_secs": (nearest.tag_time-nearest.event_time).groupby(
+                                            nearest.participant_number).median(),
+                            })
+    clock_df["drift"] = np.nan
+    for _ in range(n_iter):
+        shifted = events_long.join(clock_df, on = "participant_number")
+        t0 = shifted.groupby("participant_number").event_time.transform("min")
+        shifted["corrected_time"] = (shifted.event_time+shifted.offset_secs.fillna(0)
+                                    +shifted.drift.fillna(0)*(shifted.event_time-t0))
+        shifted = shifted.dropna(subset = ["corrected_time"]).sort_values("corrected_time")
+        labelled_df = pd.merge_asof(
+                                    tags_long,
+                                    shifted[["participant_number","event","event_time","corrected_time"]],
+                                    left_on = "tag_time", right_on = "corrected_time",
+                                    by = "participant_number", direction = "nearest",
+                                    tolerance = tolerance_secs
+                                    )
+        labelled_df["residual"] = labelled_df.tag_time-labelled_df.event_time
+        matched = labelled_df.dropna(subset = ["event"])
+        if matched.empty:
+            break
+        # several tags (eg double tags) can match the same event: use the first
+        matched = matched.sort_values("tag_time").drop_duplicates(["participant_number","event"])
+        fitted = _fit_clock(matched)
+        clock_df = fitted[["offset_secs","drift"]].combine_first(clock_df)
+    clock_df["n_matched"] = labelled_df.dropna(subset = ["event"]).groupby(
+                                "participant_number").event.nunique()
+    clock_df["n_events"] = events_long.groupby("participant_number").event.nunique()
+    clock_df["n_matched"] = clock_df.n_matched.fillna(0).astype(int)
+    labelled_df = labelled_df.drop(columns = ["corrected_time"]).sort_values(
+                                    ["participant_number","tag_num"]).reset_index(drop = True)
+    return labelled_df, clock_df.reset_index()
+
+def label_tags_between(labelled_df, event, after_event, before_event = None):
+    """
+    Label tags for events that have no qualtrics time
+    (eg Drug, DT2_music_starts) by their position: tags
+    without a matched event that fall between the tags
+    of two matched events get the event name.
+
+    Parameters
+    ----------
+    labelled_df:    pd DataFrame
+        labelled tags (see align_tags())
+    event:  str
+        name to give the tags
+    after_event:    str
+        matched event the tags come after (eg RT1_end)
+    before_event:   str or None
+        matched event the tags come before (eg RT2_start).
+        None = any time after after_event.
+
+    Returns
+    -------
+    labelled_df with event filled in for these tags.
+    Participants without a matched after_event (or
+    before_event) are left as they are.
+    """
+    labelled_df = labelled_df.copy()
+    after = labelled_df.tag_time.where(labelled_df.event == after_event).groupby(
+                            labelled_df.participant_number).transform("max")
+    in_window = labelled_df.event.isna() & (labelled_df.tag_time > after)
+    if before_event is not None:
+        before = labelled_df.tag_time.where(labelled_df.event == before_event).groupby(
+                                labelled_df.participant_number).transform("min")
+        in_window &= labelled_df.tag_time < before
+    labelled_df.loc[in_window, "event"] = event
+    return labelled_df
@@ -1,6 +1,33 @@
+import os
+import hashlib
 import datetime
 import warnings
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
+from preprocess_modules import utilities_store
+from preprocess_modules import utilities as dutils
+
+# default max size of the binary IBI cache (see read_ibi_cached())
+MAX_CACHE_BYTES = 500*1024**2
+
+# formats tried by infer_time_format(), in order
+TIME_FORMATS = [
+                "%H:%M", "%H:%M:%S",
+                "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M",
+                "%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M",
+                "%m/%d/%Y %H:%M:%S", "%m/%d/%Y %H:%M"
+                ]
+# date for times of day (same as for time only formats, eg "%H:%M")
+TIME_BASE = pd.Timestamp("1900-01-01")
+# qualtrics columns (main session file) with interval times, and their names
+INTERVAL_COLS = {
+                "Status": "response_type", "DQ-1": "participant_number",
+                "Firstbeat_on_time": "Firstbeat_start", "baseline start": "RT1_start",
+                "baseline end": "RT1_end", "Q645": "RT2_start", "Q646": "RT2_end",
+                "FILM-START": "Film_start", "Q648": "RT3_start", "Q649": "RT3_end"
+                }
 
 def remove_invalid_records(in_df, id_col,
     exclude_pnums = None,max_val = 100):
@@ -34,11 +61,55 @@ def remove_invalid_records(in_df, id_col,
                 axis = 0)
     return in_df
     
+def resolve_duplicate_participants(in_df, id_col):
+    """
+    If we have duplicate records
+    for a given participant, keep only
+    that with the fewest NaNs.
+    If there is a tie, the later record is kept.
+
+    Parameters
+    ----------
+    in_df:  pd Dataframe
+        dataframe to operate on
+    id_col: str
+        name of column containing
+        participant ids
+
+    Returns
+    -------
+    in_df w/o duplicates, and an audit dataframe
+    with one row per dropped record (participant id,
+    dropped/kept index labels and NaN counts).
+    """
+    ids = in_df[id_col].to_numpy()
+    nan_counts = in_df.isna().sum(axis = 1).to_numpy()
+    positions = np.arange(len(in_df))
+    # sort by participant, then fewest NaNs, then latest record
+    order = np.lexsort((-positions, nan_counts, ids))
+    sorted_ids = ids[order]
+    first = np.ones(len(order), dtype = bool)
+    first[1:] = sorted_ids[1:] != sorted_ids[:-1]
+    # position (in sorted order) of the record kept for each participant
+    kept_sorted = np.maximum.accumulate(np.where(first, positions, 0))
+    drop_pos = order[~first]
+    kept_pos = order[kept_sorted[~first]]
+    audit_df = pd.DataFrame({
+                            id_col: ids[drop_pos],
+                            "dropped_index": in_df.index[drop_pos],
+                            "dropped_nan_count": nan_counts[drop_pos],
+                            "kept_index": in_df.index[kept_pos],
+                            "kept_nan_count": nan_counts[kept_pos]
+                            }).sort_values([id_col, "dropped_index"]).reset_index(drop = True)
+    in_df = in_df.iloc[np.sort(order[first])]
+    return in_df, audit_df
+
 def remove_duplicate_participants(in_df, id_col):
     """
     If we have duplicate records
     for a given participant, remove
-    that with the most NaNs.
+    those with the most NaNs.
+    See resolve_duplicate_participants().
 
     Parameters
     ----------
@@ -50,21 +121,12 @@ def remove_duplicate_participants(in_df, id_col):
 
     Returns
     -------
-        in_df w/o all nan duplicates
+        in_df w/o duplicates
     """
-    duplicated = in_df.loc[in_df.duplicated(subset = id_col),id_col]
-    if duplicated is None:
-        return in_df
-    else:
-        drop_inds = []
-        for dup in duplicated:
-            nan_sum = in_df[in_df[id_col] == dup].isna().sum(axis = 1)
-            nan_max_ind = nan_sum[nan_sum == nan_sum.max()].index
-            drop_inds.append(nan_max_ind[0])
-        in_df = in_df.drop(labels = drop_inds, axis = 0)
-        return in_df       
+    in_df, _ = resolve_duplicate_participants(in_df, id_col)
+    return in_df
 
-def flag_duplicate_participants(in_df, id_col):
+def flag_duplicate_participants(in_df, id_col, audit_df = None):
     """
     If we have duplicate records
     for a given participant, flag
@@ -76,17 +138,24 @@ def flag_duplicate_participants(in_df, id_col):
     id_col: str
         name of column containing
         participant ids
+    audit_df:   pd Dataframe, optional
+        audit dataframe returned by
+        resolve_duplicate_participants(). If provided,
+        duplicates are taken from it rather than in_df.
 
     Returns
     -------
         participant numbers for those
         with duplicate records
     """
-    duplicated = in_df.loc[in_df.duplicated(subset = id_col),id_col]
+    if audit_df is None:
+        duplicated = in_df.loc[in_df.duplicated(subset = id_col),id_col]
+    else:
+        duplicated = audit_df[id_col]
     print(f"The following participants have duplicate records:\n{duplicated.values}")
     return duplicated       
 
-def convert_time_cols(in_df):
+def convert_time_cols(in_df, time_format = None):
     """
     convert time cols to datetime format
     
@@ -94,19 +163,100 @@ def convert_time_cols(in_df):
     ----------
     in_df:  pd Dataframe
         dataframe to operate on
+    time_format:    str, optional
+        format of the time strings, eg "%H:%M".
+        If not provided, the format is inferred
+        per column (see infer_time_format()).
     
     Returns
     -------
     dataframe with time cols converted
-    to datetime format.
+    to datetime format. Unless all columns
+    have dates, times are put on the same
+    date (TIME_BASE), so intervals between
+    columns are consistent.
     """
     time_cols = [col for col in in_df.columns
                 if any(k in col for k in ["start","end"])]
-    in_df.loc[:,time_cols] = in_df.loc[:,time_cols].apply(
-                                lambda x: pd.to_datetime(x,errors = "coerce"),
-                                axis = 1)
+    has_dates = True
+    for col in time_cols:
+        col_format = time_format
+        if col_format is None:
+            col_format = infer_time_format(in_df[col])
+        if col_format is None:
+            # no single format fits all values (or values are not strings)
+            has_dates = has_dates and in_df[col].isna().all()
+            in_df[col] = parse_times(in_df[col])
+        else:
+            # cache = True parses repeated strings (eg same session times) only once
+            in_df[col] = pd.to_datetime(in_df[col], format = col_format,
+                                        errors = "coerce", cache = True)
+            has_dates = has_dates and "%d" in col_format
+    if not has_dates:
+        for col in time_cols:
+            in_df[col] = TIME_BASE + (in_df[col]-in_df[col].dt.normalize())
     return in_df
 
+def infer_time_format(values, formats = TIME_FORMATS):
+    """
+    Infer time format of a column.
+
+    Parameters
+    ----------
+    values: pd Series
+        column of time strings
+    formats:    list[str]
+        candidate formats to try, in order
+    
+    Returns
+    -------
+    first format in formats that parses every
+    non-missing value, or None if none do or
+    there are no valid (string) values.
+    """
+    valid = values.dropna()
+    if valid.empty or not all(isinstance(val, str) for val in valid):
+        return None
+    # check each distinct value once
+    unique_vals = pd.Series(valid.unique())
+    for time_format in formats:
+        parsed = pd.to_datetime(unique_vals, format = time_format, errors = "coerce")
+        if parsed.notna().all():
+            return time_format
+    return None
+
+def parse_times(values, formats = TIME_FORMATS):
+    """
+    Parse a column of time strings that do not
+    share a single format. Each value is parsed with
+    the first format in formats that matches it.
+
+    Parameters
+    ----------
+    values: pd Series
+        column of time strings (or datetimes)
+    formats:    list[str]
+        candidate formats to try, in order
+    
+    Returns
+    -------
+    column as datetimes. Values that match
+    none of the formats are NaT (with a warning).
+    """
+    if not any(isinstance(val, str) for val in values.dropna()):
+        return pd.to_datetime(values, errors = "coerce")
+    parsed = pd.Series(pd.NaT, index = values.index, dtype = "datetime64[ns]")
+    for time_format in formats:
+        todo = parsed.isna() & values.notna()
+        if not todo.any():
+            break
+        parsed[todo] = pd.to_datetime(values[todo], format = time_format,
+                                    errors = "coerce", cache = True)
+    n_failed = int((parsed.isna() & values.notna()).sum())
+    if n_failed:
+        warnings.warn(f"{n_failed} values in column {values.name} could not be parsed as times.\nManual check advised.")
+    return parsed
+
 def add_end_time(in_df,start_time_col, amount):
     """
     If we don't have a time for the interval end,
@@ -166,8 +316,8 @@ def convert_to_secs(in_df):
     from Firstbeat start time.
     """
     interval_cols = in_df.filter(like = "interval",axis = 1).columns
-    in_df.loc[:,interval_cols] = in_df.loc[:,interval_cols].applymap(
-                                            lambda x: x.total_seconds())
+    for col in interval_cols:
+        in_df[col] = pd.to_timedelta(in_df[col]).dt.total_seconds().astype(np.float64)
     return in_df
 
 def select_hrv_record(pnum,hrv_files):
@@ -215,7 +365,175 @@ def get_time_stamp(in_df,id_col, interval_col,pnum):
     time_stamp = in_df[in_df[id_col]==pnum].reset_index().at[0,interval_col]
     return time_stamp
 
-def get_hrv_interval(hrv_df,interval_start:float,interval_end:float):
+def make_interval_table(in_df, id_col, interval_cols):
+    """
+    Make participants x boundaries lookup table
+    of interval start/end times. Use this instead of
+    get_time_stamp() when looking up several values.
+
+    Parameters
+    ----------
+    in_df:  pd Dataframe
+        input dataframe, one row per participant
+    id_col: str
+        name of column containing
+        participant ids
+    interval_cols:  list[str]
+        names of columns with interval times in secs,
+        eg ["Film_start_interval","Film_end_interval",...]
+
+    Returns
+    -------
+    table:  np.ndarray
+        contiguous float64 array, one row per participant
+        and one col per entry in interval_cols
+    pnum_rows:  dict
+        participant number -> row in table
+    missing:    np.ndarray
+        bool array, same shape as table. True where
+        time is missing (NaN/NaT).
+    """
+    table = np.ascontiguousarray(
+                                in_df.loc[:,interval_cols].apply(
+                                pd.to_numeric, errors = "coerce"
+                                ).to_numpy(dtype = np.float64)
+                                )
+    pnums = in_df[id_col].tolist()
+    pnum_rows = {pnum: row for row, pnum in enumerate(pnums)}
+    if len(pnum_rows) < len(pnums):
+        warnings.warn("Duplicate participant numbers in interval table. Using last record for each.")
+    missing = np.isnan(table)
+    return table, pnum_rows, missing
+
+def flag_missing_intervals(pnum_rows, missing, interval_cols):
+    """
+    Flag participants with missing
+    interval start/end times.
+
+    Parameters
+    ----------
+    pnum_rows, missing:
+        output of make_interval_table()
+    interval_cols:  list[str]
+        interval col names used for make_interval_table()
+
+    Returns
+    -------
+    dict of participant number -> names of
+    missing interval cols
+    """
+    flagged = {}
+    for pnum, row in pnum_rows.items():
+        if missing[row].any():
+            flagged[pnum] = [col for col, is_missing
+                            in zip(interval_cols, missing[row]) if is_missing]
+    if flagged:
+        print(f"The following participants have missing interval times:\n{list(flagged)}")
+    return flagged
+
+def load_interval_table(qualtrics_path, exclude_pnums = [1], film_mins = 15):
+    """
+    Read qualtrics file and get interval start/end times
+    (secs from Firstbeat start) for all participants.
+    Records that are not valid responses are removed and
+    for duplicate participants the most complete record is
+    kept. Duplicates and missing interval times are printed.
+
+    Parameters
+    ----------
+    qualtrics_path: str
+        path to main session qualtrics export
+    exclude_pnums:  list
+        participant numbers to leave out (eg pilot)
+    film_mins:  int
+        length of film in minutes (there is no film end time)
+
+    Returns
+    -------
+    boundaries, pnum_rows:
+        interval table, see make_interval_table()
+    interval_names: list[str]
+        names of intervals, in the order of the columns
+        of boundaries (start/end for each interval)
+    firstbeat_starts:   np.ndarray
+        Firstbeat start time for each row of boundaries
+    flags:  dict
+        "duplicates" (participants with duplicate records)
+        and "missing_times" (see flag_missing_intervals())
+    """
+    col_list = list(INTERVAL_COLS)
+    # participant ids as float, times as strings (parsed by convert_time_cols)
+    qualtrics_dtypes = {"DQ-1": "float64", **{col: "string" for col in col_list[2:]}}
+    qualtrics_df = dutils.read_qualtrics(qualtrics_path, names = col_list, dtype = qualtrics_dtypes)
+    qualtrics_df.columns = [INTERVAL_COLS[col] for col in col_list]
+
+    qualtrics_df = remove_invalid_records(qualtrics_df, "participant_number", exclude_pnums = exclude_pnums)
+    qualtrics_df, dropped_records = resolve_duplicate_participants(qualtrics_df, "participant_number")
+    duplicates = flag_duplicate_participants(qualtrics_df, "participant_number", audit_df = dropped_records)
+    qualtrics_df = convert_time_cols(qualtrics_df)
+    qualtrics_df = add_end_time(qualtrics_df, "Film_start", film_mins)
+    rt_time_cols = [f for f in qualtrics_df.columns if any(k in f for k in ["start","end"])]
+    for rt_time in rt_time_cols[1:]:
+        qualtrics_df = make_rel_time_cols(qualtrics_df, rt_time_cols[0], rt_time)
+    qualtrics_df = convert_to_secs(qualtrics_df)
+
+    # Zip up start/end interval column names
+    start_intervals = qualtrics_df.filter(like = "start_interval", axis = 1).columns.sort_values()
+    end_intervals = qualtrics_df.filter(like = "end_interval", axis = 1).columns.sort_values()
+    intervals = list(zip(start_intervals, end_intervals))
+    interval_names = [start_interval.split("_")[0] for start_interval, _ in intervals]
+    # start/end values for all intervals, one row per participant
+    boundary_cols = [col for interval in intervals for col in interval]
+    boundaries, pnum_rows, missing_bounds = make_interval_table(qualtrics_df, "participant_number", boundary_cols)
+    missing_times = flag_missing_intervals(pnum_rows, missing_bounds, boundary_cols)
+    flags = {"duplicates": duplicates.tolist(), "missing_times": missing_times}
+    return boundaries, pnum_rows, interval_names, qualtrics_df.Firstbeat_start.to_numpy(), flags
+
+def get_beat_times(ib_intervals):
+    """
+    Get beat times from inter-beat intervals.
+
+    Parameters
+    ----------
+    ib_intervals:   array-like
+        inter-beat intervals in ms
+        (eg hrv_df.IB_intervals)
+
+    Returns
+    -------
+    cumulative beat times in seconds from
+    start of Firstbeat as float64 array.
+    """
+    return np.cumsum(np.asarray(ib_intervals, dtype = np.float64))/1000
+
+def find_nearest_beat(beat_times, time_stamps):
+    """
+    Find index of the beat closest to each time stamp.
+    Uses a sorted search, so beat_times must be
+    monotonically increasing (as returned by
+    get_beat_times()). Ties go to the earlier beat.
+
+    Parameters
+    ----------
+    beat_times: np.ndarray
+        cumulative beat times in seconds
+    time_stamps:    float or array-like
+        time(s) in seconds from start of Firstbeat
+
+    Returns
+    -------
+    index (or array of indices) of the nearest beat.
+    """
+    time_stamps = np.asarray(time_stamps, dtype = np.float64)
+    right = np.searchsorted(beat_times, time_stamps, side = "left")
+    right = np.clip(right, 0, len(beat_times)-1)
+    left = np.clip(right-1, 0, None)
+    use_left = (np.abs(time_stamps-beat_times[left])
+                <= np.abs(beat_times[right]-time_stamps))
+    return np.where(use_left, left, right)
+
+def get_hrv_interval(hrv_df,interval_start:float,interval_end:float,
+    beat_times = None):
     """
     Get intervals for HRV data
     This function will find the closest value to the
@@ -229,10 +547,574 @@ def get_hrv_interval(hrv_df,interval_start:float,interval_end:float):
         start time as duration in seconds from
         start of Firstbeat (ie Film_start for participant 1)
     interval_end:   float
+    beat_times: np.ndarray, optional
+        output of get_beat_times() for hrv_df.
+        Pass this in when getting several intervals
+        from the same file so it is only computed once.
+
+    Returns
+    -------
+    IB_intervals for the specified interval.
+    hrv_df is not modified.
+    """
+    if pd.isna(interval_start) or pd.isna(interval_end):
+        raise TypeError("Interval start/end is missing.")
+    if beat_times is None:
+        beat_times = get_beat_times(hrv_df.IB_intervals)
+    if len(beat_times) == 0:
+        return hrv_df["IB_intervals"].iloc[0:0]
+    start_ind, end_ind = find_nearest_beat(beat_times, [interval_start, interval_end])
+    return hrv_df["IB_intervals"].iloc[start_ind:end_ind]
+
+def get_hrv_segments(ib_intervals, boundaries):
+    """
+    Get all intervals for one participant in one go.
+    Same nearest-beat rule as get_hrv_interval(), but
+    returns offsets into ib_intervals rather than
+    the data itself.
+
+    Parameters
+    ----------
+    ib_intervals:   array-like
+        inter-beat intervals in ms for a given participant
+    boundaries: array-like
+        interval start/end times in seconds from start
+        of Firstbeat, either as shape (n_intervals, 2)
+        or flat as [start_1, end_1, start_2, end_2, ...]
+
+    Returns
+    -------
+    int64 array of shape (n_intervals, 2) with start/end
+    offsets, so that ib_intervals[start:end] is the interval.
+    Rows are -1 where start or end time is missing.
+    """
+    boundaries = np.asarray(boundaries, dtype = np.float64).reshape(-1, 2)
+    offsets = np.full(boundaries.shape, -1, dtype = np.int64)
+    valid = ~np.isnan(boundaries).any(axis = 1)
+    beat_times = get_beat_times(ib_intervals)
+    if len(beat_times) == 0:
+        offsets[valid] = 0
+        return offsets
+    offsets[valid] = find_nearest_beat(beat_times, boundaries[valid])
+    return offsets
 
+def correct_ibi_artifacts(ib_intervals, window = 11, threshold = 0.2):
     """
-    hrv_df["IBI_cumsum"] = hrv_df.IB_intervals.cumsum()/1000
-    start_vals = (hrv_df.IBI_cumsum-interval_start).sub(0).abs().idxmin()
-    end_vals = (hrv_df.IBI_cumsum-interval_end).sub(0).abs().idxmin()
-    interval_df = hrv_df.iloc[start_vals:end_vals]
-    return interval_df["IB_intervals"]
\ No newline at end of file
+    Flag and correct ectopic/missed beats for a whole
+    recording in one go. A beat is flagged if its IBI deviates
+    from the rolling median of the surrounding beats by more
+    than threshold (as a proportion of the median).
+    Flagged IBIs are replaced by linear interpolation
+    between neighbouring valid IBIs.
+    Use this before get_hrv_segments() so all intervals
+    use the corrected data.
+
+    Parameters
+    ----------
+    ib_intervals:   array-like
+        inter-beat intervals in ms for the whole recording
+    window: int
+        number of beats in the rolling median window
+        (odd number, centred on each beat)
+    threshold:  float
+        max deviation from rolling median, eg 0.2 = 20%
+
+    Returns
+    -------
+    corrected IBIs (float64 array) and bool
+    array flagging the corrected beats.
+    """
+    ibi = np.asarray(ib_intervals, dtype = np.float64)
+    if len(ibi) == 0:
+        return ibi.copy(), np.zeros(0, dtype = bool)
+    half_window = window//2
+    padded = np.pad(ibi, half_window, mode = "edge")
+    rolling_median = np.median(
+                            np.lib.stride_tricks.sliding_window_view(padded, 2*half_window+1),
+                            axis = 1
+                            )
+    flags = np.abs(ibi-rolling_median) > threshold*rolling_median
+    corrected = ibi.copy()
+    if flags.any() and not flags.all():
+        beat_inds = np.arange(len(ibi))
+        corrected[flags] = np.interp(beat_inds[flags], beat_inds[~flags], ibi[~flags])
+    return corrected, flags
+
+def get_artifact_percent(flags, offsets):
+    """
+    Get percentage of corrected beats per segment.
+
+    Parameters
+    ----------
+    flags:  np.ndarray
+        bool array from correct_ibi_artifacts()
+    offsets:    np.ndarray
+        segment offsets from get_hrv_segments()
+
+    Returns
+    -------
+    float array with % of flagged beats for each
+    segment (NaN for missing/empty segments).
+    """
+    offsets = np.asarray(offsets, dtype = np.int64)
+    flag_counts = np.concatenate([[0], np.cumsum(flags)])
+    n_beats = offsets[:,1]-offsets[:,0]
+    valid = (offsets[:,0] >= 0) & (n_beats > 0)
+    artifact_pct = np.full(len(offsets), np.nan)
+    artifact_pct[valid] = ((flag_counts[offsets[valid,1]]-flag_counts[offsets[valid,0]])
+                            /n_beats[valid]*100)
+    return artifact_pct
+
+def _concat_segments(values, offsets):
+    """
+    Concatenate segments of values given by
+    (n_segments, 2) offsets. Returns the concatenated
+    values and the segment number of each value.
+    """
+    lengths = np.clip(offsets[:,1]-offsets[:,0], 0, None)
+    seg_ids = np.repeat(np.arange(len(offsets)), lengths)
+    # index of each value in the original array
+    starts = np.repeat(offsets[:,0]-np.concatenate([[0],np.cumsum(lengths)[:-1]]), lengths)
+    inds = starts+np.arange(lengths.sum())
+    return values[inds], seg_ids
+
+def get_time_domain_features(values, seg_ids, n_segments):
+    """
+    Get time domain HRV features for a number of
+    segments in one go.
+
+    Parameters
+    ----------
+    values: np.ndarray
+        IBIs in ms for all segments, concatenated
+    seg_ids:    np.ndarray
+        segment number for each value
+    n_segments: int
+        total number of segments
+
+    Returns
+    -------
+    dict of arrays (one value per segment):
+    n_beats, mean_ibi, sdnn, rmssd, pnn50
+    """
+    n_beats = np.bincount(seg_ids, minlength = n_segments)
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        mean_ibi = np.bincount(seg_ids, values, n_segments)/n_beats
+        sq_dev = (values-mean_ibi[seg_ids])**2
+        sdnn = np.sqrt(np.bincount(seg_ids, sq_dev, n_segments)/(n_beats-1))
+        sdnn[n_beats < 2] = np.nan
+        # successive differences, excluding those across segment borders
+        diffs = np.diff(values)
+        same_seg = seg_ids[1:] == seg_ids[:-1]
+        diff_ids = seg_ids[1:][same_seg]
+        diffs = diffs[same_seg]
+        n_diffs = np.bincount(diff_ids, minlength = n_segments)
+        rmssd = np.sqrt(np.bincount(diff_ids, diffs**2, n_segments)/n_diffs)
+        pnn50 = np.bincount(diff_ids, np.abs(diffs)>50, n_segments)/n_diffs*100
+    return {"n_beats": n_beats, "mean_ibi": mean_ibi, "sdnn": sdnn,
+            "rmssd": rmssd, "pnn50": pnn50}
+
+def get_freq_domain_features(values, seg_ids, n_segments,
+    lf_band = (0.04, 0.15), hf_band = (0.15, 0.4), n_freqs = 256):
+    """
+    Get LF/HF power for a number of segments using
+    a Lomb-Scargle periodogram on (uneven) beat times.
+    Requires scipy.
+
+    Parameters
+    ----------
+    values: np.ndarray
+        IBIs in ms for all segments, concatenated
+    seg_ids:    np.ndarray
+        segment number for each value
+    n_segments: int
+        total number of segments
+    lf_band, hf_band:   tuple
+        (low, high) frequency limits in Hz
+    n_freqs:    int
+        number of frequencies to evaluate
+    
+    Returns
+    -------
+    dict of arrays (one value per segment):
+    lf_power, hf_power (ms^2) and lf_hf
+    """
+    try:
+        from scipy.signal import lombscargle
+    except ImportError as e:
+        raise ImportError("scipy is required for frequency domain HRV features.") from e
+    freqs = np.linspace(lf_band[0], hf_band[1], n_freqs)
+    lf = (freqs >= lf_band[0]) & (freqs < lf_band[1])
+    hf = (freqs >= hf_band[0]) & (freqs <= hf_band[1])
+    lf_power = np.full(n_segments, np.nan)
+    hf_power = np.full(n_segments, np.nan)
+    borders = np.searchsorted(seg_ids, np.arange(n_segments+1))
+    for seg, (start, end) in enumerate(zip(borders[:-1], borders[1:])):
+        # need a few beats for a meaningful spectrum
+        if end-start < 3:
+            continue
+        seg_vals = values[start:end]
+        beat_times = np.cumsum(seg_vals)/1000
+        # scale periodogram to ms^2/Hz so band power integrates to variance
+        power = lombscargle(beat_times, seg_vals-seg_vals.mean(), 2*np.pi*freqs)
+        power = power*2*(beat_times[-1]-beat_times[0])/len(seg_vals)
+        lf_power[seg] = np.trapezoid(power[lf], freqs[lf])
+        hf_power[seg] = np.trapezoid(power[hf], freqs[hf])
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        lf_hf = lf_power/hf_power
+    return {"lf_power": lf_power, "hf_power": hf_power, "lf_hf": lf_hf}
+
+def get_hrv_features(ibi_data, offsets, interval_names, freq_domain = False):
+    """
+    Get HRV features for all intervals and participants
+    straight from the segment offsets, without going
+    via the interval files.
+
+    Parameters
+    ----------
+    ibi_data:   dict
+        participant number -> IBIs in ms (array-like)
+    offsets:    dict
+        participant number -> interval offsets,
+        as returned by get_hrv_segments()
+    interval_names: list[str]
+        names of intervals, in the same order as offsets
+    freq_domain:    bool
+        if True, also get LF/HF power (requires scipy)
+
+    Returns
+    -------
+    dataframe with one row per participant and interval
+    (participant_number, interval, n_beats, mean_ibi,
+    sdnn, rmssd, pnn50 and optionally lf_power, hf_power, lf_hf).
+    Features are NaN for intervals without valid data.
+    """
+    pnums = list(offsets)
+    all_offsets = []
+    all_values = []
+    base = 0
+    for pnum in pnums:
+        pnum_offsets = np.array(offsets[pnum], dtype = np.int64)
+        # missing intervals become empty segments
+        pnum_offsets[pnum_offsets[:,0] < 0] = 0
+        all_offsets.append(pnum_offsets+base)
+        values = np.asarray(ibi_data[pnum], dtype = np.float64)
+        all_values.append(values)
+        base += len(values)
+    n_intervals = len(interval_names)
+    features_df = pd.DataFrame({
+                                "participant_number": np.repeat(np.asarray(pnums, dtype = np.int64), n_intervals),
+                                "interval": np.tile(interval_names, len(pnums))
+                                })
+    if not pnums:
+        return features_df
+    values, seg_ids = _concat_segments(np.concatenate(all_values), np.concatenate(all_offsets))
+    n_segments = len(features_df)
+    features = get_time_domain_features(values, seg_ids, n_segments)
+    if freq_domain:
+        features.update(get_freq_domain_features(values, seg_ids, n_segments))
+    for name, vals in features.items():
+        features_df[name] = vals
+    return features_df
+
+def read_hrv_record(hrv_path, cache_dir = None, max_cache_bytes = MAX_CACHE_BYTES):
+    """
+    Read Firstbeat HRV file.
+
+    Parameters
+    ----------
+    hrv_path:   str
+        path to Firstbeat csv file
+    cache_dir:  str, optional
+        if provided, use the binary IBI cache in
+        this directory (see read_ibi_cached())
+    max_cache_bytes:    int
+        max total size of the cache
+
+    Returns
+    -------
+    dataframe with one column (IB_intervals)
+    """
+    if cache_dir is not None:
+        ibi = read_ibi_cached(hrv_path, cache_dir, max_cache_bytes)
+        return pd.DataFrame({"IB_intervals": ibi})
+    hrv_df = pd.read_csv(
+                        hrv_path,
+                        header = 0, names = ["IB_intervals"],
+                        skiprows = np.arange(0,4)
+                        )
+    return hrv_df
+
+def read_ibi_cached(hrv_path, cache_dir, max_cache_bytes = MAX_CACHE_BYTES):
+    """
+    Get IBIs for Firstbeat file from the binary cache.
+    The csv file is only parsed if it is not in the cache
+    or has changed since it was cached (cache entries are
+    keyed on path, size and modification time).
+    Least recently used entries are removed once the
+    cache exceeds max_cache_bytes.
+
+    Parameters
+    ----------
+    hrv_path:   str
+        path to Firstbeat csv file
+    cache_dir:  str
+        cache directory, created if it doesn't exist
+    max_cache_bytes:    int
+        max total size of the cache
+    
+    Returns
+    -------
+    IBIs in ms as (memory-mapped) numpy array.
+    uint16 if all values fit, float64 otherwise.
+    """
+    path_hash = hashlib.sha1(os.path.abspath(hrv_path).encode()).hexdigest()[:16]
+    file_stat = os.stat(hrv_path)
+    cache_name = f"{path_hash}_{file_stat.st_size}_{file_stat.st_mtime_ns}.npy"
+    cache_path = os.path.join(cache_dir, cache_name)
+    try:
+        ibi = np.load(cache_path, mmap_mode = "r")
+        # mark as recently used
+        os.utime(cache_path)
+        return ibi
+    except (OSError, ValueError):
+        pass
+    ibi = read_hrv_record(hrv_path).IB_intervals.to_numpy()
+    if (np.isfinite(ibi).all() and (ibi >= 0).all()
+        and (ibi <= np.iinfo(np.uint16).max).all() and (ibi == np.round(ibi)).all()):
+        ibi = ibi.astype(np.uint16)
+    else:
+        ibi = ibi.astype(np.float64)
+    os.makedirs(cache_dir, exist_ok = True)
+    tmp_path = cache_path + f".{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, ibi)
+    os.replace(tmp_path, cache_path)
+    # remove entries for older versions of this file
+    for entry in os.scandir(cache_dir):
+        if entry.name.startswith(path_hash) and entry.name != cache_name:
+            _remove_cache_entry(entry.path)
+    evict_cache(cache_dir, max_cache_bytes)
+    return ibi
+
+def evict_cache(cache_dir, max_cache_bytes = MAX_CACHE_BYTES):
+    """
+    Remove least recently used entries from the
+    IBI cache until it is at most max_cache_bytes.
+
+    Parameters
+    ----------
+    cache_dir:  str
+        cache directory
+    max_cache_bytes:    int
+        max total size of the cache
+
+    Returns
+    -------
+    list of removed cache files
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".npy"):
+            try:
+                entry_stat = entry.stat()
+            except OSError:
+                # removed by another process in the meantime
+                continue
+            entries.append((entry_stat.st_mtime_ns, entry_stat.st_size, entry.path))
+    # most recently used first
+    entries.sort(reverse = True)
+    removed = []
+    total = 0
+    for _, size, path in entries:
+        total += size
+        if total > max_cache_bytes and _remove_cache_entry(path):
+            removed.append(path)
+    return removed
+
+def _remove_cache_entry(path):
+    try:
+        os.remove(path)
+    except OSError:
+        # in use (eg memory-mapped on Windows) or already removed
+        return False
+    return True
+
+def process_hrv_participant(pnum, hrv_path, boundaries, interval_names, output_dir,
+    features = False, freq_domain = False, to_store = False, cache_dir = None,
+    correct_artifacts = False):
+    """
+    Read HRV file for one participant, cut out all
+    intervals and save each interval to file.
+
+    Parameters
+    ----------
+    pnum:   int or float
+        participant number
+    hrv_path:   str
+        path to participant's Firstbeat file
+    boundaries: array-like
+        interval start/end times for this participant
+        (see get_hrv_segments())
+    interval_names: list[str]
+        names of intervals, eg ["Film","RT1","RT2","RT3"],
+        in the same order as boundaries
+    output_dir: str
+        directory to write interval files to
+    features:   bool
+        if True, also get HRV features for all intervals
+    freq_domain:    bool
+        if True, include frequency domain features
+        (see get_hrv_features())
+    to_store:   bool
+        if True, return the intervals as segments for
+        utilities_store.write_segments() instead of
+        writing one csv file per interval
+    cache_dir:  str, optional
+        if provided, read IBIs via the binary
+        IBI cache in this directory (see read_ibi_cached())
+    correct_artifacts:  bool
+        if True, correct ectopic/missed beats for the whole
+        recording before cutting out intervals
+        (see correct_ibi_artifacts())
+
+    Returns
+    -------
+    list of [pnum, interval_name] for intervals
+    without valid data, HRV features dataframe
+    (None if neither features nor correct_artifacts;
+    includes % corrected beats per interval if
+    correct_artifacts) and list of
+    segments (empty if to_store is False).
+    """
+    missing = []
+    segments = []
+    hrv_df = read_hrv_record(hrv_path, cache_dir = cache_dir)
+    # offsets are based on the raw beat times (ie recording clock)
+    offsets = get_hrv_segments(hrv_df.IB_intervals, boundaries)
+    if correct_artifacts:
+        corrected, flags = correct_ibi_artifacts(hrv_df.IB_intervals)
+        hrv_df = pd.DataFrame({"IB_intervals": corrected})
+    for interval_name, (start_ind, end_ind) in zip(interval_names, offsets):
+        if start_ind < 0:
+            print(f"Start or end of {interval_name} interval for participant {pnum} is missing. Indexing not possible. Skipping.")
+            continue
+        interval_df = hrv_df["IB_intervals"].iloc[start_ind:end_ind]
+        # if the resulting dataframe is empty, flag this and hold on to pnum/interval
+        if interval_df.empty:
+            print(f"Participant {pnum} has no valid data for {interval_name} interval.\nManual check advised. Skipping.")
+            missing.append([pnum,interval_name])
+            continue
+        if to_store:
+            segments.append(("hrv", interval_name, pnum, interval_df.to_numpy()))
+        else:
+            interval_df.to_csv(os.path.join(output_dir, "_".join([interval_name,str(int(pnum)),"hrv.csv"])),index = False)
+    features_df = None
+    if features:
+        features_df = get_hrv_features(
+                                    {pnum: hrv_df.IB_intervals.to_numpy()},
+                                    {pnum: offsets}, interval_names,
+                                    freq_domain = freq_domain
+                                    )
+    if correct_artifacts:
+        artifact_pct = get_artifact_percent(flags, offsets)
+        if features_df is None:
+            features_df = pd.DataFrame({
+                                        "participant_number": [int(pnum)]*len(interval_names),
+                                        "interval": interval_names
+                                        })
+        features_df["artifact_pct"] = artifact_pct
+    return missing, features_df, segments
+
+# interval table etc. for worker processes, set once per worker
+# by _init_hrv_worker() so it isn't sent with every participant.
+_worker_state = {}
+
+def _init_hrv_worker(boundaries, interval_names, output_dir, kwargs):
+    _worker_state["boundaries"] = boundaries
+    _worker_state["interval_names"] = interval_names
+    _worker_state["output_dir"] = output_dir
+    _worker_state["kwargs"] = kwargs
+
+def _run_hrv_job(job):
+    pnum, row, hrv_path = job
+    return process_hrv_participant(
+                                pnum, hrv_path,
+                                _worker_state["boundaries"][row],
+                                _worker_state["interval_names"],
+                                _worker_state["output_dir"],
+                                **_worker_state["kwargs"]
+                                )
+
+def process_hrv_participants(jobs, boundaries, interval_names, output_dir, n_workers = 1,
+    store_path = None, **kwargs):
+    """
+    Run process_hrv_participant() for a number of participants,
+    optionally in parallel.
+
+    Parameters
+    ----------
+    jobs:   list[tuple]
+        (pnum, row, hrv_path) for each participant, where row
+        is the participant's row in boundaries
+    boundaries: np.ndarray
+        interval start/end times, one row per participant
+    interval_names: list[str]
+        names of intervals, in the same order as boundaries
+    output_dir: str
+        directory to write interval files to
+    n_workers:  int
+        number of worker processes. 1 = no parallel processing.
+        NB: the calling script must be guarded by
+        if __name__ == "__main__" when n_workers > 1.
+    store_path: str, optional
+        if provided, intervals are written to this
+        .npz segment store (see utilities_store) rather
+        than to one csv file per interval
+    kwargs:
+        passed on to process_hrv_participant()
+        (eg features = True)
+
+    Returns
+    -------
+    list of [pnum, interval_name] for intervals
+    without valid data, sorted by participant number,
+    and HRV features dataframe for all participants
+    (None if features were not requested).
+    """
+    kwargs["to_store"] = store_path is not None
+    missing_pnums = []
+    features_dfs = []
+
+    def collect(results):
+        # hold on to missing/features, pass segments on
+        for missing, features_df, segments in results:
+            missing_pnums.extend(missing)
+            if features_df is not None:
+                features_dfs.append(features_df)
+            yield from segments
+
+    if n_workers > 1:
+        pool = ProcessPoolExecutor(
+                                max_workers = n_workers,
+                                initializer = _init_hrv_worker,
+                                initargs = (boundaries, interval_names, output_dir, kwargs)
+                                )
+    else:
+        _init_hrv_worker(boundaries, interval_names, output_dir, kwargs)
+        pool = nullcontext()
+    with pool:
+        results = pool.map(_run_hrv_job, jobs) if n_workers > 1 else map(_run_hrv_job, jobs)
+        segments = collect(results)
+        if store_path is None:
+            # csv files are written by the workers, just run through results
+            for _ in segments:
+                pass
+        else:
+            utilities_store.write_segments(store_path, segments)
+    missing_pnums.sort(key = lambda x: x[0])
+    features_df = None
+    if features_dfs:
+        features_df = pd.concat(features_dfs, ignore_index = True).sort_values(
+                                "participant_number", kind = "stable").reset_index(drop = True)
+    return missing_pnums, features_df
@@ -0,0 +1,313 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from preprocess_modules import utilities_store
+from preprocess_modules import utilities_catalog
+
+MANIFEST_VERSION = 1
+
+
+def _key(key):
+    """
+    Manifest key for participant number
+    (json keys are always strings).
+    """
+    if isinstance(key, str):
+        return key
+    return str(int(key))
+
+def load_manifest(manifest_path):
+    """
+    Load manifest from disk. Returns an empty
+    manifest if the file does not exist.
+
+    Parameters
+    ----------
+    manifest_path:  str
+        path to manifest (json)
+
+    Returns
+    -------
+    manifest dict with "settings" and "entries"
+    (one entry per participant or input file)
+    """
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        manifest = {}
+    if manifest.get("version") != MANIFEST_VERSION:
+        manifest = {"version": MANIFEST_VERSION, "settings": None, "entries": {}}
+    return manifest
+
+def save_manifest(manifest, manifest_path):
+    """
+    Write manifest to disk (the file is
+    replaced in one step, through a temp file
+    named per process, as the watcher and the
+    batch scripts share manifests).
+
+    Parameters
+    ----------
+    manifest:   dict
+        manifest to save
+    manifest_path:  str
+        path to manifest (json)
+    """
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+def fingerprint_files(paths, catalog = None):
+    """
+    Get size and mtime for input files.
+    Values recorded in the file catalog are used
+    where available, other files are stat'ed.
+
+    Parameters
+    ----------
+    paths:  list[str]
+        input files
+    catalog:    dict or None
+        file catalog (see utilities_catalog)
+
+    Returns
+    -------
+    dict of path: [size, mtime_ns]
+    (None for files that do not exist)
+    """
+    fingerprints = {}
+    for path in paths:
+        record = None
+        if catalog is not None:
+            record = utilities_catalog.get_file_record(catalog, path)
+        if record is None:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                fingerprints[path] = None
+                continue
+            record = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+        fingerprints[path] = [record["size"], record["mtime_ns"]]
+    return fingerprints
+
+def make_entry(inputs, boundaries = None, reference = None):
+    """
+    Make manifest entry for a participant.
+
+    Parameters
+    ----------
+    inputs: dict
+        input fingerprints (see fingerprint_files())
+    boundaries: array-like or None
+        participant's interval start/end values
+    reference:  str or None
+        any other value the outputs depend on
+        (eg Firstbeat start time)
+
+    Returns
+    -------
+    entry dict (NaN boundaries are stored as None,
+    so entries can be compared after reloading)
+    """
+    if boundaries is not None:
+        boundaries = [None if np.isnan(value) else float(value)
+                        for value in np.asarray(boundaries, dtype = np.float64).ravel()]
+    return {"inputs": inputs, "boundaries": boundaries, "reference": reference}
+
+def get_changed(manifest, entries, settings = None, force = False):
+    """
+    Compare entries against the manifest.
+
+    Parameters
+    ----------
+    manifest:   dict
+        manifest from the previous run
+    entries:    dict
+        participant number (or file name): entry for this run
+    settings:   dict or None
+        settings the outputs depend on. If they differ
+        from the previous run, everything is reprocessed.
+    force:  bool
+        reprocess everything
+
+    Returns
+    -------
+    changed:    list
+        keys of entries that are new or changed
+    removed:    list
+        manifest keys that are no longer in entries
+    """
+    old_entries = manifest["entries"]
+    force = force or manifest["settings"] != settings
+    changed = []
+    for key, entry in entries.items():
+        old = old_entries.get(_key(key))
+        if force or old is None or {k: old.get(k) for k in entry} != entry:
+            changed.append(key)
+    current = set(_key(key) for key in entries)
+    removed = [key for key in old_entries if key not in current]
+    return changed, removed
+
+def is_changed(manifest, key, entry, settings = None):
+    """
+    Check a single participant (or file) against the
+    manifest, same rule as get_changed().
+
+    Returns
+    -------
+    True if the entry is new or changed, or
+    the settings differ from the manifest.
+    """
+    old = manifest["entries"].get(_key(key))
+    return manifest["settings"] != settings or old is None or {k: old.get(k) for k in entry} != entry
+
+def get_outputs(manifest, key):
+    """
+    Outputs recorded for participant number
+    (or file name) in the manifest.
+    """
+    entry = manifest["entries"].get(_key(key))
+    return [] if entry is None else entry["outputs"]
+
+def find_outputs(pnums, interval_names, modalities, output_dir = None, store_path = None):
+    """
+    Find interval outputs that exist for participants,
+    either csv files (eg Film_12_eda.csv) or segments
+    in the segment store.
+
+    Parameters
+    ----------
+    pnums:  list
+        participant numbers
+    interval_names: list[str]
+        interval names
+    modalities: list[str]
+        eg ["hrv"] or ["eda", "bvp"]
+    output_dir: str or None
+        directory with csv files
+    store_path: str or None
+        path to segment store. If given,
+        output_dir is ignored.
+
+    Returns
+    -------
+    dict of pnum: list of file names or segment keys
+    """
+    if store_path is not None:
+        stored = set()
+        if os.path.exists(store_path):
+            segments_df = utilities_store.list_segments(store_path)
+            stored = set(utilities_store.segment_key(*seg)
+                        for seg in segments_df.itertuples(index = False))
+    outputs = {}
+    for pnum in pnums:
+        found = []
+        for modality in modalities:
+            for interval_name in interval_names:
+                if store_path is not None:
+                    key = utilities_store.segment_key(modality, interval_name, pnum)
+                    if key in stored:
+                        found.append(key)
+                else:
+                    name = "_".join([interval_name,str(int(pnum)),f"{modality}.csv"])
+                    if os.path.exists(os.path.join(output_dir, name)):
+                        found.append(name)
+        outputs[pnum] = found
+    return outputs
+
+def remove_outputs(outputs, output_dir, store_path = None):
+    """
+    Delete outputs (see find_outputs()). csv files
+    and segments in the store can be mixed, eg when
+    the output format was changed between runs.
+
+    Parameters
+    ----------
+    outputs:    list[str]
+        csv file names and/or segment keys
+    output_dir: str
+        directory with csv files
+    store_path: str or None
+        path to segment store
+
+    Returns
+    -------
+    number of outputs removed
+    """
+    n_removed = 0
+    keys = []
+    for name in outputs:
+        if not name.endswith(".csv"):
+            keys.append(name)
+            continue
+        try:
+            os.remove(os.path.join(output_dir, name))
+            n_removed += 1
+        except FileNotFoundError:
+            pass
+    if keys and store_path is not None:
+        n_removed += len(utilities_store.remove_segments(store_path, keys))
+    return n_removed
+
+def update_manifest(manifest, entries, outputs, removed = (), settings = None):
+    """
+    Record entries/outputs for processed participants
+    and drop participants that are gone.
+
+    Parameters
+    ----------
+    manifest:   dict
+        manifest to update
+    entries:    dict
+        participant number (or file name): entry
+        for processed participants
+    outputs:    dict
+        participant number (or file name): outputs
+    removed:    iterable
+        manifest keys to drop
+    settings:   dict or None
+        settings for this run
+
+    Returns
+    -------
+    updated manifest
+    """
+    for key in removed:
+        manifest["entries"].pop(_key(key), None)
+    for key, entry in entries.items():
+        manifest["entries"][_key(key)] = dict(entry, outputs = outputs.get(key, []))
+    manifest["settings"] = settings
+    return manifest
+
+def update_table(table_path, new_df, pnums, id_col = "participant_number"):
+    """
+    Update cohort-wide table (eg hrv_features.csv):
+    rows for pnums are replaced by new_df, all other
+    rows are kept.
+
+    Parameters
+    ----------
+    table_path: str
+        path to csv file
+    new_df: pd DataFrame or None
+        rows for reprocessed participants
+    pnums:  list
+        participants to replace (reprocessed or removed)
+    id_col: str
+        participant number column
+
+    Returns
+    -------
+    updated table (not written to file)
+    """
+    if not os.path.exists(table_path):
+        return new_df
+    old_df = pd.read_csv(table_path, float_precision = "round_trip")
+    old_df = old_df[~old_df[id_col].isin([int(pnum) for pnum in pnums])]
+    if new_df is None or new_df.empty:
+        return old_df.reset_index(drop = True)
+    return pd.concat([old_df, new_df], ignore_index = True).sort_values(
+                                    id_col, kind = "stable").reset_index(drop = True)
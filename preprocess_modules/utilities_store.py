@@ -0,0 +1,144 @@
+import os
+import zipfile
+import numpy as np
+import pandas as pd
+
+# output format of the segmenting scripts and the watcher:
+# "csv" = one file per participant/interval, "npz" = single segment store
+OUTPUT_FORMAT = "csv"
+
+def segment_key(modality, interval, pnum):
+    """
+    Get key for a segment in the segment store.
+
+    Parameters
+    ----------
+    modality:   str
+        eg "hrv", "eda"
+    interval:   str
+        interval name, eg "Film"
+    pnum:   int or float
+        participant number
+
+    Returns
+    -------
+    key as string, eg "hrv/Film/12"
+    """
+    return "/".join([modality, interval, str(int(pnum))])
+
+def write_segments(store_path, segments, mode = "a"):
+    """
+    Write segments to a single compressed .npz
+    file (one array per participant/interval/modality),
+    instead of one csv file per segment.
+    Segments are written as they come, so this
+    works with generators.
+
+    Parameters
+    ----------
+    store_path: str
+        path to .npz file
+    segments:   iterable of tuples
+        (modality, interval, pnum, values) for each
+        segment, where values is array-like
+    mode:   str
+        "a" = keep segments already in the store
+        (those with the same key are replaced)
+        "w" = start a new store
+    
+    Returns
+    -------
+    list of keys written
+    """
+    tmp_path = store_path + ".tmp"
+    written = []
+    with zipfile.ZipFile(tmp_path, "w", compression = zipfile.ZIP_DEFLATED,
+                        allowZip64 = True) as store:
+        for modality, interval, pnum, values in segments:
+            key = segment_key(modality, interval, pnum)
+            if key in written:
+                raise ValueError(f"Segment {key} was provided more than once.")
+            with store.open(key + ".npy", "w", force_zip64 = True) as f:
+                np.lib.format.write_array(f, np.asarray(values), allow_pickle = False)
+            written.append(key)
+        if mode == "a" and os.path.exists(store_path):
+            new_members = set(key + ".npy" for key in written)
+            with zipfile.ZipFile(store_path) as old_store:
+                for info in old_store.infolist():
+                    if info.filename not in new_members:
+                        store.writestr(info, old_store.read(info.filename))
+    os.replace(tmp_path, store_path)
+    return written
+
+def read_segment(store_path, modality, interval, pnum):
+    """
+    Read a single segment from the segment store.
+    Only this segment is decompressed.
+
+    Parameters
+    ----------
+    store_path: str
+        path to .npz file
+    modality, interval, pnum:
+        see segment_key()
+    
+    Returns
+    -------
+    segment as numpy array
+    """
+    with np.load(store_path, allow_pickle = False) as store:
+        return store[segment_key(modality, interval, pnum)]
+
+def list_segments(store_path):
+    """
+    List segments in the segment store
+    without reading any data.
+
+    Parameters
+    ----------
+    store_path: str
+        path to .npz file
+    
+    Returns
+    -------
+    dataframe with modality, interval and
+    participant_number for each segment.
+    """
+    with zipfile.ZipFile(store_path) as store:
+        keys = [name[:-len(".npy")].split("/") for name in store.namelist()]
+    segments_df = pd.DataFrame(keys, columns = ["modality","interval","participant_number"])
+    segments_df["participant_number"] = segments_df.participant_number.astype(int)
+    return segments_df
+
+def remove_segments(store_path, keys):
+    """
+    Remove segments from the segment store.
+    Keys that are not in the store are ignored.
+
+    Parameters
+    ----------
+    store_path: str
+        path to .npz file
+    keys:   iterable of str
+        keys to remove (see segment_key())
+    
+    Returns
+    -------
+    list of keys removed
+    """
+    members = set(key + ".npy" for key in keys)
+    if not members or not os.path.exists(store_path):
+        return []
+    with zipfile.ZipFile(store_path) as old_store:
+        infos = old_store.infolist()
+        removed = [info.filename[:-len(".npy")] for info in infos if info.filename in members]
+        if not removed:
+            return []
+        tmp_path = store_path + ".tmp"
+        with zipfile.ZipFile(tmp_path, "w", compression = zipfile.ZIP_DEFLATED,
+                            allowZip64 = True) as store:
+            for info in infos:
+                if info.filename not in members:
+                    store.writestr(info, old_store.read(info.filename))
+    os.replace(tmp_path, store_path)
+    return removed
@@ -0,0 +1,86 @@
+import os
+import time
+import pandas as pd
+
+
+def snapshot_files(catalog, modalities = None):
+    """
+    Get size and mtime for all files in the catalog
+    (for E4, the files in each participant folder).
+
+    Parameters
+    ----------
+    catalog:    dict
+        file catalog (see utilities_catalog)
+    modalities: list[str] or None
+        modalities to include (None = all)
+
+    Returns
+    -------
+    dict of path: (size, mtime_ns)
+    """
+    snapshot = {}
+    for modality, scan in catalog["modalities"].items():
+        if modalities is not None and modality not in modalities:
+            continue
+        for name, record in scan["entries"].items():
+            if "files" in record:
+                folder_path = os.path.join(scan["path"], name)
+                for file_name, file_record in record["files"].items():
+                    snapshot[os.path.join(folder_path, file_name)] = (file_record["size"], file_record["mtime_ns"])
+            else:
+                snapshot[os.path.join(scan["path"], name)] = (record["size"], record["mtime_ns"])
+    return snapshot
+
+def find_stable(snapshot, previous, settle_secs = 60, now = None):
+    """
+    Debounce files that may still be being written:
+    a file counts as complete once its size and mtime
+    are the same as at the previous poll and it has
+    not been modified for settle_secs.
+
+    Parameters
+    ----------
+    snapshot:   dict
+        current snapshot (see snapshot_files())
+    previous:   dict
+        snapshot from the previous poll
+    settle_secs:    float
+        min time since last modification
+    now:    float or None
+        current unix time (None = time.time())
+
+    Returns
+    -------
+    set of paths of stable files
+    """
+    if now is None:
+        now = time.time()
+    return set(
+                path for path, fingerprint in snapshot.items()
+                if previous.get(path) == fingerprint and now - fingerprint[1]/1e9 >= settle_secs
+                )
+
+def get_landed_time(snapshot, paths):
+    """
+    Unix time the last of paths was modified
+    (ie when the participant's data landed).
+    Paths not in snapshot are ignored.
+    """
+    mtimes = [snapshot[path][1] for path in paths if path in snapshot]
+    return max(mtimes)/1e9 if mtimes else float("nan")
+
+def log_event(log_path, **values):
+    """
+    Append a row to a csv log (the
+    header is written with the first row).
+
+    Parameters
+    ----------
+    log_path:   str
+        path to csv log
+    values:
+        column: value for the row
+    """
+    row_df = pd.DataFrame([values])
+    row_df.to_csv(log_path, mode = "a", index = False, header = not os.path.exists(log_path))
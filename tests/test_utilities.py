@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+import pytest
+from preprocess_modules import utilities as dutils
+
+SELECT_LIST = ("Start Date", "Participant number:", "Start time (HH:MM):")
+
+
+@pytest.fixture
+def diary_df():
+    columns = ["Start Date", "Other question", "Participant number:", "Start time (HH:MM):",
+                "In the last day, have you experienced any intrusions?"]
+    columns += [f"COLUMN {col} - Intrusion {num}" for col in range(1, 5) for num in range(1, 13)]
+    rng = np.random.default_rng(0)
+    return pd.DataFrame(rng.integers(0, 10, (3, len(columns))), columns = columns)
+
+def test_get_column_plan_matches_step_by_step(diary_df):
+    # renaming/selection as preprocess_main.py did before the plan
+    expected = dutils.rename_diary_cols(diary_df.copy(), start_phrase = "have you experienced")
+    for num in range(1, 5):
+        expected = dutils.rename_diary_cols(expected, col_num = f"column {num}")
+    expected = dutils.select_columns(expected, list(SELECT_LIST))
+    expected = dutils.strip_col_names(expected)
+    plan = dutils.get_column_plan(tuple(diary_df.columns), SELECT_LIST)
+    pd.testing.assert_frame_equal(dutils.apply_column_plan(diary_df, plan), expected)
+    assert plan[2] == "In the last day, have you experienced any intrusions?"
+    assert "had_intrusions" in plan[1] and "vivid_12" in plan[1]
+
+def test_get_column_plan_cached(diary_df):
+    dutils.get_column_plan.cache_clear()
+    plan = dutils.get_column_plan(tuple(diary_df.columns), SELECT_LIST)
+    assert dutils.get_column_plan(tuple(diary_df.columns), SELECT_LIST) is plan
+    assert dutils.get_column_plan.cache_info().hits == 1
+
+@pytest.fixture
+def qualtrics_path(tmp_path):
+    # qualtrics export: column names, question text and import id rows, then responses
+    in_df = pd.DataFrame({
+                        "ResponseId": ["R_1", "R_2", "R_3"],
+                        "Participant number:": [2, 3, 4],
+                        "622_1": ["Not at all", "Somewhat", "Not at all"],
+                        "Other": ["a", "b", "c"],
+                        "622_2": ["Somewhat", "Very much", "Somewhat"],
+                        "RT1_start": ["10:00", "10:05", "09:55"],
+                        "DQ-1 score": [1.0, np.nan, 3.0]
+                        })
+    path = tmp_path/"main.csv"
+    with open(path, "w") as f:
+        f.write(",".join(in_df.columns)+"\n")
+        f.write(",".join(f"Question {num}" for num in range(len(in_df.columns)))+"\n")
+        f.write(",".join(f'"{{""ImportId"":""QID{num}""}}"' for num in range(len(in_df.columns)))+"\n")
+        in_df.to_csv(f, index = False, header = False)
+    return path
+
+def test_read_qualtrics_header(qualtrics_path):
+    assert dutils.read_qualtrics_header(qualtrics_path) == [
+                                                            "ResponseId", "Participant number:", "622_1", "Other",
+                                                            "622_2", "RT1_start", "DQ-1 score"
+                                                            ]
+
+def test_read_qualtrics_matches_full_read(qualtrics_path):
+    in_df = dutils.read_qualtrics(
+                                qualtrics_path, names = ["RT1_start", "Participant number:"],
+                                prefixes = ["622_"], contains = ["DQ-1"],
+                                dtype = {"622_": "category", "RT1_start": "string"}
+                                )
+    # names in the order given, then matches in header order
+    columns = ["RT1_start", "Participant number:", "622_1", "622_2", "DQ-1 score"]
+    assert in_df.columns.tolist() == columns
+    expected = pd.read_csv(qualtrics_path, skiprows = [1,2])[columns]
+    pd.testing.assert_frame_equal(in_df, expected, check_dtype = False, check_categorical = False)
+    assert in_df["622_1"].dtype == "category" and in_df["622_2"].dtype == "category"
+    assert in_df.RT1_start.dtype == "string"
+    assert in_df["DQ-1 score"].dtype == np.float64
+
+def test_read_qualtrics_missing_name(qualtrics_path):
+    with pytest.raises(ValueError, match = "Participant_number"):
+        dutils.read_qualtrics(qualtrics_path, names = ["Participant_number"])
+
+def test_decide(monkeypatch):
+    assert dutils.decide({"clean": False}, "clean", "Continue? Y/N\n") == (False, "policy")
+    monkeypatch.setattr("builtins.input", lambda question: "y")
+    assert dutils.decide({"clean": None}, "clean", "Continue? Y/N\n") == (True, "prompt")
+    assert dutils.decide(None, "clean", "Continue? Y/N\n") == (True, "prompt")
+
+def test_process_diary_file_runs_from_policy(tmp_path, monkeypatch, diary_df):
+    def no_input(question):
+        raise AssertionError(f"Asked: {question}")
+    monkeypatch.setattr("builtins.input", no_input)
+    diary_df = diary_df.astype(object)
+    diary_df.insert(0, "Finished", [True, False, True])
+    diary_df["Participant number:"] = [2, 3, 4]
+    diary_df["In the last day, have you experienced any intrusions?"] = ["Yes", "Yes", "No"]
+    # participant 4 answered no, but gave ratings
+    diary_df.loc[:, diary_df.columns.str.startswith("COLUMN 1")] = 0
+    diary_df.loc[2, "COLUMN 3 - Intrusion 1"] = 5
+    # diary exports: import id row, column names, question text row
+    input_path = tmp_path/"diary.csv"
+    with open(input_path, "w") as f:
+        f.write(",".join(f"QID{num}" for num in range(diary_df.shape[1]))+"\n")
+        diary_df.head(0).to_csv(f, index = False)
+        f.write(",".join(f"Question {num}" for num in range(diary_df.shape[1]))+"\n")
+        diary_df.to_csv(f, index = False, header = False)
+    output_path = tmp_path/"diary_processed.csv"
+    cleaned, audit = dutils.process_diary_file(
+                                                input_path, output_path, SELECT_LIST,
+                                                policy = {"remove_incomplete": True, "clean": True}
+                                                )
+    assert cleaned
+    assert [(row["step"], row["source"]) for row in audit] == [
+                                                            ("remove_incomplete", "policy"), ("not_yes_no", "flag"),
+                                                            ("no_intrusions_with_content", "flag"), ("clean", "policy")
+                                                            ]
+    assert audit[0]["participants"] == "3" and audit[1]["value"] == 0
+    out_df = pd.read_csv(output_path)
+    assert out_df.participant_number.tolist() == [2, 4]
+    assert np.isnan(out_df.loc[1, "distress_1"])
+    assert out_df.loc[0, "distress_1"] == diary_df.loc[0, "COLUMN 3 - Intrusion 1"]
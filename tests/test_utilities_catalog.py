@@ -0,0 +1,58 @@
+import os
+import pytest
+from preprocess_modules import utilities_catalog as catalogutils
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    hrv_dir = tmp_path/"Firstbeat"
+    e4_dir = tmp_path/"E4"
+    hrv_dir.mkdir()
+    e4_dir.mkdir()
+    for name in ["P002_fb.csv", "p003 session.csv", "notes.txt"]:
+        (hrv_dir/name).write_text("x")
+    for folder in ["p002", "p003_a", "p003_b", "other"]:
+        (e4_dir/folder).mkdir()
+        (e4_dir/folder/"EDA.csv").write_text("1500000000\n4\n0.1\n")
+    return {"firstbeat": str(hrv_dir), "e4": str(e4_dir)}
+
+def test_refresh_catalog_lookup(dirs):
+    catalog = catalogutils.refresh_catalog(dirs)
+    assert catalogutils.get_pnums(catalog, "firstbeat") == [2, 3]
+    assert catalogutils.get_pnums(catalog, "e4") == [2, 3]
+    assert catalogutils.get_path(catalog, "firstbeat", 2) == os.path.join(dirs["firstbeat"], "P002_fb.csv")
+    assert catalogutils.get_duplicates(catalog, "firstbeat") == []
+    assert catalogutils.get_duplicates(catalog, "e4") == [3]
+    with pytest.warns(UserWarning, match = "more than one file"):
+        assert catalogutils.get_path(catalog, "e4", 3) == os.path.join(dirs["e4"], "p003_b")
+    with pytest.raises(IndexError):
+        catalogutils.get_path(catalog, "firstbeat", 4)
+    eda_path = os.path.join(dirs["e4"], "p002", "EDA.csv")
+    assert catalogutils.get_file_record(catalog, eda_path)["size"] == os.path.getsize(eda_path)
+    assert catalogutils.get_file_record(catalog, os.path.join(dirs["e4"], "p002", "BVP.csv")) is None
+
+def test_refresh_catalog_saves_and_reloads(dirs, tmp_path):
+    catalog_path = str(tmp_path/"cache"/"catalog.json")
+    catalog = catalogutils.refresh_catalog(dirs, catalog_path)
+    loaded = catalogutils.load_catalog(catalog_path)
+    assert loaded == catalog
+    # modalities that are not refreshed are kept
+    catalog = catalogutils.refresh_catalog({"firstbeat": dirs["firstbeat"]}, catalog_path)
+    assert catalogutils.get_pnums(catalog, "e4") == [2, 3]
+
+def test_refresh_catalog_restats_overwritten_files(dirs, tmp_path):
+    catalog_path = str(tmp_path/"catalog.json")
+    catalogutils.refresh_catalog(dirs, catalog_path)
+    folder = os.path.join(dirs["e4"], "p002")
+    eda_path = os.path.join(folder, "EDA.csv")
+    folder_stat = os.stat(folder)
+    # overwriting a file in place does not change the folder mtime
+    with open(eda_path, "a") as f:
+        f.write("0.2\n0.3\n")
+    os.utime(folder, ns = (folder_stat.st_atime_ns, folder_stat.st_mtime_ns))
+    catalog = catalogutils.refresh_catalog(dirs, catalog_path)
+    assert catalogutils.get_file_record(catalog, eda_path)["size"] == os.path.getsize(eda_path)
+    # a new file does change the folder mtime, so the folder is listed again
+    (tmp_path/"E4"/"p002"/"BVP.csv").write_text("1500000000\n64\n")
+    catalog = catalogutils.refresh_catalog(dirs, catalog_path)
+    assert catalogutils.get_file_record(catalog, os.path.join(folder, "BVP.csv")) is not None
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from preprocess_modules import utilities_crossdevice as cdutils
+
+
+@pytest.fixture
+def beat_times():
+    rng = np.random.default_rng(0)
+    fb_times = np.cumsum(rng.uniform(0.6, 1.1, 1500))
+    # E4 misses about 10% of beats, its clock is 37.4 secs ahead and times jitter by ~10 ms
+    kept = np.sort(rng.choice(len(fb_times), int(len(fb_times)*0.9), replace = False))
+    e4_times = fb_times[kept]+37.4+rng.normal(0, 0.01, len(kept))
+    return fb_times, np.sort(e4_times), kept
+
+def test_match_beats_mutual_nearest_within_tolerance():
+    matches, lags = cdutils.match_beats([1, 2, 3, 4], [1.05, 2.3, 3.02, 3.1, 5], tolerance = 0.15)
+    # 2 is too far from 2.3, and the nearest beat to 4 (3.1) is closer to 3
+    assert matches.tolist() == [0, -1, 2, -1]
+    np.testing.assert_allclose(lags, [0.05, np.nan, 0.02, np.nan])
+    matches, lags = cdutils.match_beats([1, 2], [])
+    assert matches.tolist() == [-1, -1] and np.isnan(lags).all()
+
+def test_estimate_clock_offset(beat_times):
+    fb_times, e4_times, _ = beat_times
+    offset, match_rate = cdutils.estimate_clock_offset(fb_times, e4_times, initial_offset = 20)
+    assert offset == pytest.approx(37.4, abs = 0.01)
+    assert match_rate == pytest.approx(0.9, abs = 0.02)
+    # true offset outside the search window: only chance matches
+    offset, match_rate = cdutils.estimate_clock_offset(fb_times, e4_times, initial_offset = -300, max_offset = 100)
+    assert -400 <= offset <= -200 and match_rate < 0.5
+    offset, match_rate = cdutils.estimate_clock_offset(fb_times, [])
+    assert np.isnan(offset) and match_rate == 0
+
+def test_get_beat_agreement(beat_times):
+    fb_times, e4_times, kept = beat_times
+    agreement_df = cdutils.get_beat_agreement(
+                                            fb_times, e4_times, [[100, 400], [np.nan, 500]],
+                                            ["Film", "RT1"], offset = 37.4
+                                            )
+    assert agreement_df.interval.tolist() == ["Film", "RT1"]
+    film = agreement_df.iloc[0]
+    in_film = (fb_times >= 100) & (fb_times < 400)
+    assert film.n_ref == in_film.sum()
+    assert film.match_rate == pytest.approx(np.isin(np.flatnonzero(in_film), kept).mean(), abs = 0.01)
+    assert film.dropout_rate == pytest.approx(1-film.match_rate)
+    assert abs(film.lag_mean) < 0.005
+    assert film.lag_sd == pytest.approx(0.01, abs = 0.003)
+    # IBI error is the difference of two jitters: mean absolute value of N(0, sqrt(2)*10 ms)
+    assert film.ibi_mae == pytest.approx(np.sqrt(2)*0.01*np.sqrt(2/np.pi)*1000, rel = 0.2)
+    assert agreement_df.iloc[1].drop("interval").isna().all()
@@ -0,0 +1,261 @@
+import numpy as np
+import pandas as pd
+import pytest
+from preprocess_modules import utilities_e4 as e4utils
+
+
+@pytest.fixture
+def tag_deltas():
+    rng = np.random.default_rng(0)
+    # differences between successive tags for 6 participants, NaN padded
+    deltas = rng.uniform(1, 60, (15, 6))
+    for col, n_tags in enumerate([15, 12, 10, 14, 11, 13]):
+        deltas[n_tags:, col] = np.nan
+    return pd.DataFrame(deltas)
+
+def test_sweep_double_thresholds_matches_loop(tag_deltas):
+    min_deltas = e4utils.find_min_delta(tag_deltas)
+    thresholds = np.arange(1.5, 5, 0.01)
+    num_with_doubles, double_counts = e4utils.sweep_double_thresholds(min_deltas, tag_deltas, thresholds)
+    assert double_counts.shape == (len(thresholds), 6)
+    # one threshold at a time, as e4_double_tags.py did before the sweep
+    for thresh, num_twos, counts in zip(thresholds, num_with_doubles, double_counts):
+        double_df = e4utils.return_likely_doubles(min_deltas, tag_deltas, thresh)
+        assert num_twos == e4utils.get_num_double_tags(double_df).get(2, 0)
+        np.testing.assert_array_equal(counts, double_df.notna().sum().to_numpy())
+
+def test_get_best_thresh_lowest_of_max(capsys):
+    thresholds = np.array([1.5, 2.0, 2.5, 3.0, 3.5])
+    # neighbouring thresholds with the same result are not flagged
+    assert e4utils.get_best_thresh([1, 3, 3, 2, 1], thresholds) == 2.0
+    assert capsys.readouterr().out == ""
+    assert e4utils.get_best_thresh([3, 1, 3, 2, 1], thresholds) == 1.5
+    assert "More than 1 max val detected" in capsys.readouterr().out
+
+def write_signal(path, start_time, samp_rate, values):
+    # E4 signal file: start time and sample rate rows (one value per column), then the samples
+    values = np.asarray(values, dtype = np.float64).reshape(len(values), -1)
+    n_cols = values.shape[1]
+    with open(path, "w") as f:
+        f.write(",".join([f"{start_time:.6f}"]*n_cols)+"\n")
+        f.write(",".join([f"{samp_rate:.6f}"]*n_cols)+"\n")
+        for row in values:
+            f.write(",".join(f"{value:.3f}" for value in row)+"\n")
+
+@pytest.mark.parametrize("trailing_newline", [True, False])
+def test_read_e4_rows_matches_full_read(tmp_path, trailing_newline):
+    values = np.round(np.random.default_rng(2).uniform(0, 5, 500), 3)
+    path = tmp_path/"EDA.csv"
+    write_signal(path, 1.5e9, 4, values)
+    if not trailing_newline:
+        path.write_bytes(path.read_bytes().rstrip(b"\n"))
+    # small chunks, so rows are split between reads
+    line_index = e4utils.build_line_index(path, chunk_size = 64)
+    assert len(line_index)-1 == len(values)
+    np.testing.assert_array_equal(line_index, e4utils.build_line_index(path))
+    for start_row, end_row in [(0, 500), (10, 20), (499, 500), (490, 600), (-5, 3), (20, 10)]:
+        expected = values[max(start_row, 0):min(end_row, 500)].astype(np.float32)
+        np.testing.assert_array_equal(e4utils.read_e4_rows(path, line_index, start_row, end_row), expected)
+
+def test_read_e4_rows_multi_column(tmp_path):
+    values = np.arange(30).reshape(10, 3)
+    path = tmp_path/"ACC.csv"
+    write_signal(path, 1.5e9, 32, values)
+    start_time, samp_rate, n_cols = e4utils.read_e4_header(path)
+    assert (start_time, samp_rate, n_cols) == (1.5e9, 32, 3)
+    line_index = e4utils.build_line_index(path)
+    np.testing.assert_array_equal(e4utils.read_e4_rows(path, line_index, 2, 5, n_cols), values[2:5])
+
+def test_get_row_range():
+    assert e4utils.get_row_range(10, 20, 4, offset_secs = 5) == (60, 100)
+    # end before start gives no rows
+    assert e4utils.get_row_range(10, 5, 4) == (40, 40)
+
+def test_get_row_range_warns_before_recording():
+    with pytest.warns(UserWarning, match = "before the E4 recording"):
+        assert e4utils.get_row_range(10, 20, 4, offset_secs = -15) == (0, 0)
+
+@pytest.mark.parametrize("date", ["2024-01-15", "2024-07-01"])
+def test_get_clock_offset_uses_study_time_zone(date):
+    # E4 started at 09:00 local time (UTC in winter, UTC+1 in summer)
+    e4_start = pd.Timestamp(f"{date} 09:00", tz = e4utils.STUDY_TZ).timestamp()
+    assert e4utils.get_clock_offset(e4_start, pd.Timestamp("1900-01-01 09:30")) == 1800
+    assert np.isnan(e4utils.get_clock_offset(e4_start, pd.NaT))
+
+def test_segment_e4_participant(tmp_path):
+    e4_start = pd.Timestamp("2024-07-01 09:00", tz = e4utils.STUDY_TZ).timestamp()
+    # 10 mins of EDA (4 Hz) and ACC (32 Hz)
+    eda = np.arange(4*600)/100
+    acc = np.arange(32*600*3).reshape(-1, 3) % 128
+    write_signal(tmp_path/"EDA.csv", e4_start, 4, eda)
+    write_signal(tmp_path/"ACC.csv", e4_start, 32, acc)
+    # Firstbeat started 1 min after the E4, interval times are secs from then
+    boundaries = [[0, 60], [120, 180], [np.nan, 300], [-120, 0]]
+    with pytest.warns(UserWarning, match = "RT3 interval starts 60 secs before"):
+        segments, flags, samp_rates = e4utils.segment_e4_participant(
+                                                                    tmp_path, 12, boundaries,
+                                                                    ["Film","RT1","RT2","RT3"],
+                                                                    reference_time = pd.Timestamp("1900-01-01 09:01"),
+                                                                    signals = ["EDA","ACC","TEMP"]
+                                                                    )
+    assert samp_rates == {"EDA": 4, "ACC": 32}
+    assert flags["missing_file"] == [[12, "TEMP"]]
+    assert flags["before_start"] == [[12, "EDA", "RT3"], [12, "ACC", "RT3"]]
+    assert [segment[:3] for segment in segments] == [
+                                                    ("eda","Film",12), ("eda","RT1",12),
+                                                    ("acc","Film",12), ("acc","RT1",12)
+                                                    ]
+    np.testing.assert_allclose(segments[0][3], eda[4*60:4*120], rtol = 1e-6)
+    np.testing.assert_array_equal(segments[3][3], acc[32*180:32*240])
+
+def test_estimate_num_rows(tmp_path):
+    path = tmp_path/"EDA.csv"
+    write_signal(path, 1.5e9, 4, np.random.default_rng(3).uniform(0, 20, 20000))
+    assert e4utils.count_rows(path) == 20000
+    assert e4utils.estimate_num_rows(path, sample_bytes = 4096) == pytest.approx(20000, rel = 0.01)
+    # whole file sampled: exact
+    assert e4utils.estimate_num_rows(path, sample_bytes = 2**20) == 20000
+
+def test_check_recording_lengths(tmp_path):
+    folders = ["p002", "p003", "p004", "p005", "p006"]
+    for folder in folders:
+        (tmp_path/folder).mkdir()
+    # 62 secs is within 5% of the minimum, so rows are counted exactly
+    write_signal(tmp_path/"p002"/"EDA.csv", 1.5e9, 4, np.ones(4*62))
+    write_signal(tmp_path/"p003"/"EDA.csv", 1.5e9, 4, np.ones(4*30))
+    (tmp_path/"p004"/"EDA.csv").write_text("")
+    (tmp_path/"p006"/"EDA.csv").write_text("1500000000.000000\n")
+    (tmp_path/"p002"/"IBI.csv").write_text("1500000000.000000, IBI\n1.5,0.8\n2.3,0.8\n75.25,0.7\n")
+    length_df = e4utils.check_recording_lengths(tmp_path, folders, ["EDA","IBI"], min_session_secs = 60)
+    assert length_df.participant_number.tolist() == [2, 2, 3, 3, 4, 4, 5, 5, 6, 6]
+    assert length_df.status.tolist() == ["ok", "ok", "short", "missing", "empty", "missing",
+                                        "missing", "missing", "empty", "missing"]
+    assert length_df.n_secs.iloc[0] == 62
+    assert length_df.n_secs.iloc[1] == 75.25
+    assert length_df.n_secs.iloc[2] == pytest.approx(30, rel = 0.05)
+
+def test_get_eda_features_per_participant_rate_and_missing_intervals():
+    rng = np.random.default_rng(4)
+    eda_2 = 2+np.cumsum(rng.normal(0, 0.02, 400))
+    eda_3 = 2+np.cumsum(rng.normal(0, 0.02, 800))
+    segments = [("eda", "Film", 2, eda_2), ("eda", "RT1", 3, eda_3), ("acc", "Film", 2, np.ones((8, 3)))]
+    features_df = e4utils.get_eda_features(segments, {2: 4.0, 3: 8.0}, interval_names = ["Film","RT1"], pnums = [2, 3, 4])
+    assert features_df[["participant_number","interval"]].values.tolist() == [
+                                                                            [2, "Film"], [2, "RT1"], [3, "Film"],
+                                                                            [3, "RT1"], [4, "Film"], [4, "RT1"]
+                                                                            ]
+    assert features_df.n_samples.notna().tolist() == [True, False, False, True, False, False]
+    # same as each participant on their own, with their own sample rate
+    for row, samp_rate, segment in [(0, 4.0, segments[0]), (3, 8.0, segments[1])]:
+        expected = e4utils.get_eda_features([segment], samp_rate).iloc[0]
+        pd.testing.assert_series_equal(
+                                        features_df.iloc[row], expected, check_names = False,
+                                        check_dtype = False
+                                        )
+
+def test_get_eda_features_no_segments():
+    features_df = e4utils.get_eda_features([], interval_names = ["Film","RT1"], pnums = [5])
+    assert features_df.participant_number.tolist() == [5, 5]
+    assert features_df.drop(columns = ["participant_number","interval"]).isna().to_numpy().all()
+
+def test_fit_clock_recovers_offset_and_drift():
+    event_time = 1.7e9+np.arange(0, 3600, 300.0)
+    matched = pd.DataFrame({
+                            "participant_number": np.r_[np.full(len(event_time), 2), 3],
+                            "event_time": np.r_[event_time, 1.7e9],
+                            "residual": np.r_[30+0.001*(event_time-event_time[0]), -12]
+                            })
+    clock_df = e4utils._fit_clock(matched)
+    assert clock_df.loc[2, "offset_secs"] == pytest.approx(30)
+    assert clock_df.loc[2, "drift"] == pytest.approx(0.001)
+    # a single match gives an offset but no drift
+    assert clock_df.loc[3, "offset_secs"] == -12
+    assert np.isnan(clock_df.loc[3, "drift"])
+    assert clock_df.n_matched.tolist() == [len(event_time), 1]
+
+def test_align_tags_labels_tags_and_estimates_clock():
+    t0 = 1.7e9
+    events_long = pd.DataFrame({
+                                "participant_number": 2,
+                                "event": [f"event_{i}" for i in range(8)],
+                                "event_time": t0+np.arange(8)*600.0
+                                })
+    # E4 clock 30 secs ahead and drifting 1 ms per sec, plus a tag far from any event
+    tag_times = events_long.event_time+30+0.001*(events_long.event_time-t0)
+    tags = np.append(tag_times, t0+10000)
+    tags_long = e4utils.tags_to_long(tags[:,None], [2])
+    labelled_df, clock_df = e4utils.align_tags(tags_long, events_long)
+    assert labelled_df.event.tolist()[:8] == events_long.event.tolist()
+    assert pd.isna(labelled_df.event.iloc[8])
+    clock = clock_df.set_index("participant_number").loc[2]
+    assert clock.offset_secs == pytest.approx(30)
+    assert clock.drift == pytest.approx(0.001)
+    assert (clock.n_matched, clock.n_events) == (8, 8)
+
+def test_events_to_unix_uses_study_time_zone():
+    events_df = pd.DataFrame({
+                            "pnum": [2, 3, 4],
+                            "fb_start": pd.to_datetime(["1900-01-01 10:00", "1900-01-01 10:00", None])
+                            })
+    # reference times in summer (UTC+1) and winter (UTC)
+    ref_times = {
+                2: pd.Timestamp("2024-07-01 09:00", tz = e4utils.STUDY_TZ).timestamp(),
+                3: pd.Timestamp("2024-01-15 09:00", tz = e4utils.STUDY_TZ).timestamp(),
+                4: pd.Timestamp("2024-01-15 09:00", tz = e4utils.STUDY_TZ).timestamp()
+                }
+    events_long = e4utils.events_to_unix(events_df, "pnum", {"Firstbeat": "fb_start"}, ref_times)
+    # the missing time is left out
+    assert events_long.participant_number.tolist() == [2, 3]
+    assert events_long.event_time.tolist() == [
+                                                pd.Timestamp("2024-07-01 09:00", tz = "UTC").timestamp(),
+                                                pd.Timestamp("2024-01-15 10:00", tz = "UTC").timestamp()
+                                                ]
+
+def test_label_tags_between():
+    labelled_df = pd.DataFrame({
+                                "participant_number": [2, 2, 2, 2, 2, 3, 3],
+                                "tag_time": [10, 20, 30, 40, 50, 10, 20.0],
+                                "event": ["RT1_end", np.nan, np.nan, "RT2_start", np.nan, np.nan, np.nan]
+                                })
+    out_df = e4utils.label_tags_between(labelled_df, "Drug", "RT1_end", "RT2_start")
+    # participant 3 has no matched RT1_end, so nothing is labelled
+    assert out_df.event.fillna("").tolist() == ["RT1_end", "Drug", "Drug", "RT2_start", "", "", ""]
+    assert labelled_df.event.isna().sum() == 5
+    out_df = e4utils.label_tags_between(out_df, "DT2_music_starts", "RT2_start")
+    assert out_df.event.fillna("").tolist()[4:] == ["DT2_music_starts", "", ""]
+
+def test_get_tag_deltas_matches_rowdiff():
+    rng = np.random.default_rng(6)
+    pnums = [2, 3, 5]
+    tag_arrays = [1.7e9+np.cumsum(rng.uniform(1, 600, n_tags)) for n_tags in [15, 20, 14]]
+    tags = e4utils.pack_ragged(tag_arrays)
+    assert tags.shape == (20, 3)
+    # one column per participant, differenced one at a time as before
+    tags_df = pd.concat([pd.Series(values, name = pnum) for pnum, values in zip(pnums, tag_arrays)], axis = 1)
+    pd.testing.assert_frame_equal(e4utils.get_tag_deltas(tags, pnums), tags_df.apply(e4utils.get_rowdiff))
+
+def test_pack_ragged_empty():
+    assert e4utils.pack_ragged([]).shape == (0, 0)
+    np.testing.assert_array_equal(e4utils.pack_ragged([[], [1.0, 2.0]]), [[np.nan, 1], [np.nan, 2]])
+
+def test_load_tag_files(tmp_path, capsys):
+    rng = np.random.default_rng(7)
+    tag_files = {"p002": 16, "p003_home": 10, "p005_a": 16, "p005_b": 16, "p006": 20}
+    for folder, n_rows in tag_files.items():
+        (tmp_path/folder).mkdir()
+        tags = 1.7e9+np.cumsum(rng.uniform(1, 600, n_rows))
+        (tmp_path/folder/"tags.csv").write_text("\n".join(f"{tag:.2f}" for tag in tags)+"\n")
+    (tmp_path/"p004").mkdir()
+    (tmp_path/"notes").mkdir()
+    tags, pnums, flags = e4utils.load_tag_files(str(tmp_path), n_workers = 4)
+    assert pnums == [2, 6]
+    assert flags == {"duplicates": [5], "missing": [4], "below_min": [3]}
+    # same values as reading each file with pandas (first row is taken as header)
+    for col, folder in enumerate(["p002", "p006"]):
+        expected = pd.read_csv(tmp_path/folder/"tags.csv", header = 0, names = ["tag"]).tag.to_numpy()
+        np.testing.assert_array_equal(tags[:len(expected), col], expected)
+        assert np.isnan(tags[len(expected):, col]).all()
+    assert "No tags file found for participant 4" in capsys.readouterr().out
+    # folders from the file catalog instead of a scan
+    _, pnums, _ = e4utils.load_tag_files(str(tmp_path), participant_folders = ["p006"])
+    assert pnums == [6]
@@ -0,0 +1,241 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+from preprocess_modules import utilities_hrv as hrvutils
+
+
+def get_hrv_interval_idxmin(hrv_df, interval_start, interval_end):
+    # get_hrv_interval before the sorted search (nearest beat by idxmin)
+    hrv_df = hrv_df.copy()
+    hrv_df["IBI_cumsum"] = hrv_df.IB_intervals.cumsum()/1000
+    start_vals = (hrv_df.IBI_cumsum-interval_start).sub(0).abs().idxmin()
+    end_vals = (hrv_df.IBI_cumsum-interval_end).sub(0).abs().idxmin()
+    return hrv_df.iloc[start_vals:end_vals]["IB_intervals"]
+
+@pytest.fixture
+def hrv_df():
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({"IB_intervals": rng.integers(600, 1100, 2000)})
+
+def test_get_hrv_interval_matches_idxmin(hrv_df):
+    beat_times = hrvutils.get_beat_times(hrv_df.IB_intervals)
+    rng = np.random.default_rng(1)
+    times = np.sort(rng.uniform(-10, beat_times[-1]+10, (200, 2)), axis = 1)
+    for start, end in times:
+        expected = get_hrv_interval_idxmin(hrv_df, start, end)
+        result = hrvutils.get_hrv_interval(hrv_df, start, end)
+        pd.testing.assert_series_equal(result, expected)
+        result = hrvutils.get_hrv_interval(hrv_df, start, end, beat_times = beat_times)
+        pd.testing.assert_series_equal(result, expected)
+
+def test_get_hrv_interval_ties_go_to_earlier_beat():
+    hrv_df = pd.DataFrame({"IB_intervals": [1000, 1000, 1000, 1000]})
+    # 1.5 and 3.5 secs are exactly between two beats
+    expected = get_hrv_interval_idxmin(hrv_df, 1.5, 3.5)
+    result = hrvutils.get_hrv_interval(hrv_df, 1.5, 3.5)
+    pd.testing.assert_series_equal(result, expected)
+    assert result.index.tolist() == [0, 1]
+
+def test_get_hrv_interval_does_not_modify_input(hrv_df):
+    hrvutils.get_hrv_interval(hrv_df, 10, 20)
+    assert hrv_df.columns.tolist() == ["IB_intervals"]
+
+def test_get_hrv_segments_offsets(hrv_df):
+    boundaries = [[10, 60], [np.nan, 100], [200, 400], [300, np.nan]]
+    offsets = hrvutils.get_hrv_segments(hrv_df.IB_intervals, boundaries)
+    assert offsets.shape == (4, 2)
+    assert offsets.dtype == np.int64
+    assert (offsets[[1, 3]] == -1).all()
+    for (start, end), (start_ind, end_ind) in zip(boundaries, offsets):
+        if np.isnan([start, end]).any():
+            continue
+        expected = hrvutils.get_hrv_interval(hrv_df, start, end)
+        np.testing.assert_array_equal(hrv_df.IB_intervals.to_numpy()[start_ind:end_ind], expected.to_numpy())
+
+def test_get_hrv_segments_flat_boundaries(hrv_df):
+    boundaries = np.array([[10, 60], [200, 400]])
+    np.testing.assert_array_equal(
+                                hrvutils.get_hrv_segments(hrv_df.IB_intervals, boundaries.ravel()),
+                                hrvutils.get_hrv_segments(hrv_df.IB_intervals, boundaries)
+                                )
+
+def test_get_hrv_segments_empty_recording():
+    offsets = hrvutils.get_hrv_segments([], [[10, 60], [np.nan, 100]])
+    np.testing.assert_array_equal(offsets, [[0, 0], [-1, -1]])
+
+def test_convert_time_cols_checks_all_values():
+    in_df = pd.DataFrame({"RT1_start": ["10:00", "10:05:30", None]})
+    out_df = hrvutils.convert_time_cols(in_df)
+    assert out_df.RT1_start.tolist()[:2] == [pd.Timestamp("1900-01-01 10:00"), pd.Timestamp("1900-01-01 10:05:30")]
+
+def test_convert_time_cols_same_date_for_all_columns():
+    in_df = pd.DataFrame({"RT1_start": ["10:00"], "RT1_end": ["2024-05-01 10:15"], "Film_start": ["10:30:00"]})
+    out_df = hrvutils.convert_time_cols(in_df)
+    assert (out_df.RT1_end-out_df.RT1_start).dt.total_seconds().tolist() == [900]
+    assert (out_df.Film_start-out_df.RT1_start).dt.total_seconds().tolist() == [1800]
+
+def test_resolve_duplicate_participants():
+    in_df = pd.DataFrame({
+                        "participant_number": [2, 3, 2, 4, 3, 2],
+                        "a": [1, np.nan, np.nan, 1, np.nan, 1],
+                        "b": [1, 1, 1, 1, np.nan, np.nan]
+                        }, index = [10, 11, 12, 13, 14, 15])
+    out_df, audit_df = hrvutils.resolve_duplicate_participants(in_df, "participant_number")
+    # participant 2: record 10 has fewest NaNs. participant 3: record 11 (14 has more NaNs)
+    assert out_df.index.tolist() == [10, 11, 13]
+    assert audit_df.participant_number.tolist() == [2, 2, 3]
+    assert audit_df.dropped_index.tolist() == [12, 15, 14]
+    assert audit_df.kept_index.tolist() == [10, 10, 11]
+    assert audit_df.dropped_nan_count.tolist() == [1, 1, 2]
+    assert audit_df.kept_nan_count.tolist() == [0, 0, 1]
+
+def test_resolve_duplicate_participants_tie_keeps_later_record():
+    in_df = pd.DataFrame({
+                        "participant_number": [5, 6, 5, 5],
+                        "a": [np.nan, 1, 1, np.nan],
+                        "b": [1, 1, np.nan, 1]
+                        })
+    out_df, audit_df = hrvutils.resolve_duplicate_participants(in_df, "participant_number")
+    assert out_df.index.tolist() == [1, 3]
+    assert audit_df.dropped_index.tolist() == [0, 2]
+    assert (audit_df.kept_index == 3).all()
+    # same result as keeping the last record with the fewest NaNs
+    pd.testing.assert_frame_equal(out_df, hrvutils.remove_duplicate_participants(in_df, "participant_number"))
+
+def test_correct_ibi_artifacts_flags():
+    ibi = np.full(50, 800.0)
+    # ectopic (short) beat, missed beat (long) and a deviation below threshold
+    ibi[10] = 400
+    ibi[30] = 1600
+    ibi[40] = 900
+    corrected, flags = hrvutils.correct_ibi_artifacts(ibi, window = 11, threshold = 0.2)
+    assert flags.dtype == bool
+    assert np.flatnonzero(flags).tolist() == [10, 30]
+    np.testing.assert_array_equal(corrected[[10, 30]], [800, 800])
+    np.testing.assert_array_equal(corrected[~flags], ibi[~flags])
+    # input is not modified
+    assert ibi[10] == 400
+
+def test_correct_ibi_artifacts_interpolates_between_valid_beats():
+    ibi = np.array([800.0, 800, 800, 400, 1000, 1000, 1000])
+    corrected, flags = hrvutils.correct_ibi_artifacts(ibi, window = 5, threshold = 0.2)
+    assert np.flatnonzero(flags).tolist() == [3]
+    assert corrected[3] == pytest.approx(900)
+
+def test_correct_ibi_artifacts_empty():
+    corrected, flags = hrvutils.correct_ibi_artifacts([])
+    assert corrected.shape == (0,) and flags.shape == (0,)
+
+def write_firstbeat(path, ib_intervals):
+    # Firstbeat export: 4 metadata rows and a header row above the IBIs (ms)
+    with open(path, "w") as f:
+        f.write("Firstbeat\nName,P002\nDate,01.07.2024\nTime,09:00\nRR\n")
+        f.write("\n".join(str(value) for value in ib_intervals)+"\n")
+
+@pytest.fixture
+def hrv_jobs(tmp_path):
+    rng = np.random.default_rng(5)
+    jobs = []
+    for row, pnum in enumerate([2, 3, 4]):
+        hrv_path = str(tmp_path/f"P00{pnum}.csv")
+        write_firstbeat(hrv_path, rng.integers(600, 1100, 2000))
+        jobs.append((pnum, row, hrv_path))
+    # Film, RT1 (missing start for participant 3, after the recording for participant 4)
+    boundaries = np.array([[10, 60, 100, 200], [10, 60, np.nan, 200], [0, 30, 5000, 5100]])
+    return jobs, boundaries, ["Film","RT1"]
+
+def test_process_hrv_participants_parallel_matches_serial(tmp_path, hrv_jobs):
+    jobs, boundaries, interval_names = hrv_jobs
+    results = []
+    for n_workers in [1, 2]:
+        output_dir = tmp_path/f"out_{n_workers}"
+        output_dir.mkdir()
+        missing, features_df = hrvutils.process_hrv_participants(
+                                                                jobs, boundaries, interval_names, str(output_dir),
+                                                                n_workers = n_workers, features = True
+                                                                )
+        files = {path.name: path.read_text() for path in sorted(output_dir.iterdir())}
+        results.append((missing, features_df, files))
+    (missing, features_df, files), (missing_2, features_df_2, files_2) = results
+    assert missing == missing_2 == [[4, "RT1"]]
+    pd.testing.assert_frame_equal(features_df, features_df_2)
+    assert files == files_2
+    assert sorted(files) == ["Film_2_hrv.csv", "Film_3_hrv.csv", "Film_4_hrv.csv", "RT1_2_hrv.csv"]
+
+def test_make_interval_table_matches_get_time_stamp(capsys):
+    interval_cols = ["Film_start_interval", "Film_end_interval"]
+    in_df = pd.DataFrame({
+                        "participant_number": [2, 3, 5],
+                        "Film_start_interval": [0, 10.5, np.nan],
+                        "Film_end_interval": ["900", 910.5, 900]
+                        })
+    table, pnum_rows, missing = hrvutils.make_interval_table(in_df, "participant_number", interval_cols)
+    assert table.dtype == np.float64 and table.flags.c_contiguous
+    assert pnum_rows == {2: 0, 3: 1, 5: 2}
+    for pnum, row in pnum_rows.items():
+        for col_num, col in enumerate(interval_cols):
+            expected = pd.to_numeric(hrvutils.get_time_stamp(in_df, "participant_number", col, pnum))
+            np.testing.assert_equal(table[row, col_num], expected)
+    assert hrvutils.flag_missing_intervals(pnum_rows, missing, interval_cols) == {5: ["Film_start_interval"]}
+    assert "[5]" in capsys.readouterr().out
+
+def test_make_interval_table_duplicates_use_last_record():
+    in_df = pd.DataFrame({"participant_number": [2, 2], "Film_start_interval": [0, 5]})
+    with pytest.warns(UserWarning, match = "Duplicate participant numbers"):
+        table, pnum_rows, _ = hrvutils.make_interval_table(in_df, "participant_number", ["Film_start_interval"])
+    assert table[pnum_rows[2], 0] == 5
+
+def test_get_hrv_features_matches_per_interval(hrv_df):
+    interval_names = ["Film", "RT1", "RT2", "RT3"]
+    ibi_data = {2: hrv_df.IB_intervals.to_numpy(), 3: hrv_df.IB_intervals.to_numpy()[::-1]}
+    # missing boundary, and an interval after the end of the recording
+    boundaries = {2: [[10, 60], [np.nan, 100], [200, 400], [5000, 5100]],
+                3: [[0, 1.5], [30, 90], [60, 120], [1000, 1200]]}
+    offsets = {pnum: hrvutils.get_hrv_segments(ibi_data[pnum], boundaries[pnum]) for pnum in ibi_data}
+    features_df = hrvutils.get_hrv_features(ibi_data, offsets, interval_names)
+    assert features_df.participant_number.tolist() == [2]*4+[3]*4
+    assert features_df.interval.tolist() == interval_names*2
+    for row, (pnum, (start_ind, end_ind)) in enumerate((pnum, seg) for pnum in ibi_data for seg in offsets[pnum]):
+        values = ibi_data[pnum][start_ind:end_ind].astype(np.float64) if start_ind >= 0 else np.array([])
+        diffs = np.diff(values)
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            expected = [
+                        len(values), np.mean(values) if len(values) else np.nan,
+                        np.std(values, ddof = 1) if len(values) > 1 else np.nan,
+                        np.sqrt(np.mean(diffs**2)) if len(diffs) else np.nan,
+                        np.mean(np.abs(diffs) > 50)*100 if len(diffs) else np.nan
+                        ]
+        result = features_df.loc[row, ["n_beats", "mean_ibi", "sdnn", "rmssd", "pnn50"]].to_numpy(dtype = np.float64)
+        np.testing.assert_allclose(result, expected, equal_nan = True)
+
+def test_get_hrv_features_no_participants():
+    features_df = hrvutils.get_hrv_features({}, {}, ["Film"])
+    assert features_df.empty
+    assert features_df.columns.tolist() == ["participant_number", "interval"]
+
+def test_read_ibi_cached(tmp_path):
+    hrv_path = str(tmp_path/"P002.csv")
+    cache_dir = str(tmp_path/"cache")
+    write_firstbeat(hrv_path, [800, 810, 790])
+    ibi = hrvutils.read_ibi_cached(hrv_path, cache_dir)
+    assert ibi.dtype == np.uint16 and ibi.tolist() == [800, 810, 790]
+    assert len(os.listdir(cache_dir)) == 1
+    # second read is served from the (memory-mapped) cache
+    cached = hrvutils.read_ibi_cached(hrv_path, cache_dir)
+    assert isinstance(cached, np.memmap) and cached.tolist() == [800, 810, 790]
+    # changed file is parsed again and replaces the old cache entry
+    write_firstbeat(hrv_path, [800, 810, 790, 805.5])
+    ibi = hrvutils.read_ibi_cached(hrv_path, cache_dir)
+    assert ibi.dtype == np.float64 and ibi.tolist() == [800, 810, 790, 805.5]
+    assert len(os.listdir(cache_dir)) == 1
+    pd.testing.assert_frame_equal(hrvutils.read_hrv_record(hrv_path, cache_dir = cache_dir), hrvutils.read_hrv_record(hrv_path))
+
+def test_evict_cache_removes_least_recently_used(tmp_path):
+    for num in range(3):
+        np.save(tmp_path/f"entry_{num}.npy", np.zeros(100))
+        os.utime(tmp_path/f"entry_{num}.npy", ns = ((num+1)*10**9, (num+1)*10**9))
+    entry_size = os.path.getsize(tmp_path/"entry_0.npy")
+    removed = hrvutils.evict_cache(str(tmp_path), max_cache_bytes = 2*entry_size)
+    assert [os.path.basename(path) for path in removed] == ["entry_0.npy"]
+    assert sorted(os.listdir(tmp_path)) == ["entry_1.npy", "entry_2.npy"]
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+import pytest
+from preprocess_modules import utilities_manifest as manifestutils
+
+
+@pytest.fixture
+def saved(tmp_path):
+    # manifest as saved by an earlier run, reloaded from disk
+    manifest_path = str(tmp_path/"manifest.json")
+    settings = {"intervals": ["Film","RT1"], "output_format": "csv"}
+    entries = {
+            2: manifestutils.make_entry({"P002.csv": [100, 1]}, [0, 60, np.nan, 120]),
+            3: manifestutils.make_entry({"P003.csv": [200, 1]}, [0, 60, 70, 130], "09:00:00")
+            }
+    manifest = manifestutils.load_manifest(manifest_path)
+    manifest = manifestutils.update_manifest(manifest, entries, {2: ["Film_2_hrv.csv"]}, settings = settings)
+    manifestutils.save_manifest(manifest, manifest_path)
+    return manifestutils.load_manifest(manifest_path), entries, settings
+
+def test_get_changed_unchanged_after_reload(saved):
+    manifest, entries, settings = saved
+    assert manifestutils.get_changed(manifest, entries, settings) == ([], [])
+    assert manifestutils.get_outputs(manifest, 2) == ["Film_2_hrv.csv"]
+    assert manifestutils.get_outputs(manifest, 3) == []
+
+def test_get_changed_inputs_and_removed(saved):
+    manifest, entries, settings = saved
+    new_entries = {
+                2: manifestutils.make_entry({"P002.csv": [100, 2]}, [0, 60, np.nan, 120]),
+                4: manifestutils.make_entry({"P004.csv": [300, 1]}, [0, 60, 70, 130])
+                }
+    assert manifestutils.get_changed(manifest, new_entries, settings) == ([2, 4], ["3"])
+    assert manifestutils.is_changed(manifest, 2, new_entries[2], settings)
+    assert not manifestutils.is_changed(manifest, 3, entries[3], settings)
+
+def test_get_changed_settings(saved):
+    manifest, entries, settings = saved
+    # a changed setting marks every entry as changed
+    new_settings = dict(settings, output_format = "npz")
+    assert manifestutils.get_changed(manifest, entries, new_settings) == ([2, 3], [])
+    assert manifestutils.is_changed(manifest, 3, entries[3], new_settings)
+    assert manifestutils.get_changed(manifest, entries, settings, force = True) == ([2, 3], [])
+
+def test_update_table(tmp_path):
+    table_path = str(tmp_path/"features.csv")
+    assert manifestutils.update_table(table_path, None, [2]) is None
+    pd.DataFrame({"participant_number": [2, 2, 3, 5], "mean_ibi": [800.1, 810.2, 900.3, 1000.4]}).to_csv(table_path, index = False)
+    new_df = pd.DataFrame({"participant_number": [4, 2], "mean_ibi": [700.5, 750.6]})
+    # 2 is reprocessed, 5 is removed, 3 is kept
+    out_df = manifestutils.update_table(table_path, new_df, [2, 4, "5"])
+    assert out_df.participant_number.tolist() == [2, 3, 4]
+    assert out_df.mean_ibi.tolist() == [750.6, 900.3, 700.5]
+    # participants removed without new rows
+    out_df = manifestutils.update_table(table_path, None, [3])
+    assert out_df.participant_number.tolist() == [2, 2, 5]
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from preprocess_modules import utilities_store as storeutils
+
+
+@pytest.fixture
+def segments():
+    return [
+            ("hrv", "Film", 12, np.array([800, 810, 790])),
+            ("hrv", "RT1", 12.0, np.array([], dtype = np.int64)),
+            ("eda", "Film", 3, np.linspace(0, 1, 40).reshape(-1, 1))
+            ]
+
+def test_write_read_list_round_trip(tmp_path, segments):
+    store_path = str(tmp_path / "segments.npz")
+    written = storeutils.write_segments(store_path, iter(segments))
+    assert written == ["hrv/Film/12", "hrv/RT1/12", "eda/Film/3"]
+    for modality, interval, pnum, values in segments:
+        result = storeutils.read_segment(store_path, modality, interval, pnum)
+        np.testing.assert_array_equal(result, values)
+        assert result.dtype == values.dtype and result.shape == values.shape
+    segments_df = storeutils.list_segments(store_path)
+    assert sorted(map(tuple, segments_df.to_numpy().tolist())) == [
+                                                                ("eda", "Film", 3),
+                                                                ("hrv", "Film", 12),
+                                                                ("hrv", "RT1", 12)
+                                                                ]
+
+def test_write_append_replaces_same_key(tmp_path, segments):
+    store_path = str(tmp_path / "segments.npz")
+    storeutils.write_segments(store_path, segments)
+    storeutils.write_segments(store_path, [("hrv", "Film", 12, np.array([1, 2]))])
+    np.testing.assert_array_equal(storeutils.read_segment(store_path, "hrv", "Film", 12), [1, 2])
+    assert len(storeutils.list_segments(store_path)) == 3
+    storeutils.write_segments(store_path, [("hrv", "Film", 12, np.array([3]))], mode = "w")
+    assert len(storeutils.list_segments(store_path)) == 1
+
+def test_write_duplicate_key_raises(tmp_path):
+    store_path = str(tmp_path / "segments.npz")
+    with pytest.raises(ValueError):
+        storeutils.write_segments(store_path, [("hrv", "Film", 1, [1]), ("hrv", "Film", 1.0, [2])])
+
+def test_remove_segments(tmp_path, segments):
+    store_path = str(tmp_path / "segments.npz")
+    storeutils.write_segments(store_path, segments)
+    removed = storeutils.remove_segments(store_path, ["hrv/RT1/12", "hrv/RT2/12"])
+    assert removed == ["hrv/RT1/12"]
+    assert storeutils.list_segments(store_path).interval.tolist() == ["Film", "Film"]
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+from preprocess_modules import utilities_e4 as e4utils
+from preprocess_modules import utilities_catalog as catalogutils
+from preprocess_modules import utilities_watch as watchutils
+
+
+def test_snapshot_files(tmp_path):
+    (tmp_path/"Firstbeat").mkdir()
+    (tmp_path/"E4"/"p002").mkdir(parents = True)
+    (tmp_path/"Firstbeat"/"P002.csv").write_text("x")
+    (tmp_path/"E4"/"p002"/"EDA.csv").write_text("xy")
+    (tmp_path/"E4"/"p002"/"tags.csv").write_text("xyz")
+    catalog = catalogutils.refresh_catalog({"firstbeat": str(tmp_path/"Firstbeat"), "e4": str(tmp_path/"E4")})
+    snapshot = watchutils.snapshot_files(catalog)
+    assert {path: size for path, (size, _) in snapshot.items()} == {
+                                                                    str(tmp_path/"Firstbeat"/"P002.csv"): 1,
+                                                                    str(tmp_path/"E4"/"p002"/"EDA.csv"): 2,
+                                                                    str(tmp_path/"E4"/"p002"/"tags.csv"): 3
+                                                                    }
+    assert list(watchutils.snapshot_files(catalog, ["firstbeat"])) == [str(tmp_path/"Firstbeat"/"P002.csv")]
+
+def test_find_stable():
+    now = 10000.0
+    to_ns = lambda secs: int(secs*1e9)
+    snapshot = {
+                "settled": (10, to_ns(now-120)),
+                "recent": (10, to_ns(now-30)),
+                "growing": (20, to_ns(now-120)),
+                "new": (10, to_ns(now-120))
+                }
+    previous = {"settled": (10, to_ns(now-120)), "recent": (10, to_ns(now-30)), "growing": (10, to_ns(now-120))}
+    # unchanged since the last poll and not modified for settle_secs
+    assert watchutils.find_stable(snapshot, previous, settle_secs = 60, now = now) == {"settled"}
+    assert watchutils.find_stable(snapshot, previous, settle_secs = 0, now = now) == {"settled", "recent"}
+    assert watchutils.get_landed_time(snapshot, ["settled", "recent", "gone"]) == now-30
+    assert np.isnan(watchutils.get_landed_time(snapshot, ["gone"]))
+
+def test_log_event(tmp_path):
+    log_path = str(tmp_path/"watch_log.csv")
+    watchutils.log_event(log_path, participant_number = 2, step = "hrv", status = "ok")
+    watchutils.log_event(log_path, participant_number = 3, step = "e4", status = "ValueError: bad header")
+    log_df = pd.read_csv(log_path)
+    assert log_df.columns.tolist() == ["participant_number", "step", "status"]
+    assert log_df.status.tolist() == ["ok", "ValueError: bad header"]
+
+def test_get_tag_qc_matches_cohort_rule():
+    rng = np.random.default_rng(0)
+    tags = 1.7e9+np.cumsum(rng.uniform(60, 600, 16))
+    # two double tags, 2 secs apart
+    tags = np.sort(np.r_[tags, tags[3]+2, tags[10]+2])
+    qc = e4utils.get_tag_qc(tags, 12, threshold = 2.5)
+    assert qc == {"participant_number": 12, "n_tags": 18, "n_doubles": 2, "below_min": False, "check": False}
+    # same count as the cohort-wide sweep
+    tag_deltas = e4utils.get_tag_deltas(e4utils.pack_ragged([tags]), [12])
+    _, double_counts = e4utils.sweep_double_thresholds(e4utils.find_min_delta(tag_deltas), tag_deltas, [2.5])
+    assert double_counts[0, 0] == qc["n_doubles"]
+    qc = e4utils.get_tag_qc(tags[:10], 12, threshold = 2.5)
+    assert qc["below_min"] and qc["check"]
@@ -0,0 +1,285 @@
+# watch input directories and process participants as their data comes in
+import os
+import time
+import warnings
+import pandas as pd
+from preprocess_modules import utilities_hrv as hrvutils
+from preprocess_modules import utilities_e4 as e4utils
+from preprocess_modules import utilities_store as storeutils
+from preprocess_modules import utilities_catalog as catalogutils
+from preprocess_modules import utilities_manifest as manifestutils
+from preprocess_modules import utilities_watch as watchutils
+
+main_dir = r"P:\Spironolactone\main_qualtrics"
+main_filename = "main_dat21.csv"
+hrv_dir = r"P:\Spironolactone\Firstbeat"
+e4_dir = r"P:\Spironolactone\E4"
+# secs between polls of the input directories
+poll_secs = 30
+# files must be unchanged for this long (and between two polls) before they are read,
+# so uploads that are still being written are not picked up
+settle_secs = 60
+# number of polls before stopping (0 = run until interrupted with ctrl+c)
+n_polls = 0
+# "csv" = one file per participant/interval, "npz" = single segment store
+# (same default as the batch scripts, so their manifests stay valid)
+output_format = storeutils.OUTPUT_FORMAT
+# HRV settings (as in get_hrv_segments.py, so the batch manifest stays valid)
+get_features = 1
+freq_domain = 0
+correct_artifacts = 0
+cache_dir = os.path.join(os.path.expanduser("~"),".spironolactone_cache","ibi")
+# E4 settings (as in get_eda_segments_e4.py)
+signals = ["EDA"]
+min_session_secs = 4*60*60
+# double tag threshold (max_thresh from the last e4_double_tags.py run) and min number of tags
+double_thresh = 2.5
+min_tags = 14
+catalog_path = os.path.join(os.path.expanduser("~"),".spironolactone_cache","catalog.json")
+# one row per processed participant, with processing time and time since upload
+log_path = os.path.join(os.path.expanduser("~"),".spironolactone_cache","watch_log.csv")
+
+hrv_output_dir = os.path.join(hrv_dir,"processed_hrv_files")
+e4_output_dir = os.path.join(e4_dir,"processed_e4_files")
+qualtrics_path = os.path.join(main_dir,main_filename)
+hrv_manifest_path = os.path.join(hrv_output_dir,"hrv_manifest.json")
+e4_manifest_path = os.path.join(e4_output_dir,"e4_manifest.json")
+tag_manifest_path = os.path.join(e4_output_dir,"tag_manifest.json")
+hrv_store_path = None
+e4_store_path = None
+if output_format == "npz":
+    hrv_store_path = os.path.join(hrv_output_dir,"hrv_segments.npz")
+    e4_store_path = os.path.join(e4_output_dir,"e4_segments.npz")
+
+
+def record_manifest(manifest_path, entries, outputs, removed = (), settings = None):
+    """
+    Record processed/removed participants in a manifest,
+    reloaded from disk first so that entries written by a
+    batch run in the meantime are kept.
+    """
+    manifest = manifestutils.load_manifest(manifest_path)
+    manifestutils.update_manifest(manifest, entries, outputs, removed, settings)
+    manifestutils.save_manifest(manifest, manifest_path)
+
+def process_hrv(pnum, hrv_path, row):
+    """
+    Cut out intervals (and get features) for one participant,
+    same as get_hrv_segments.py.
+    """
+    entry = manifestutils.make_entry(manifestutils.fingerprint_files([hrv_path], catalog), boundaries[row])
+    hrv_manifest = manifestutils.load_manifest(hrv_manifest_path)
+    if not manifestutils.is_changed(hrv_manifest, pnum, entry, hrv_settings):
+        return None
+    manifestutils.remove_outputs(manifestutils.get_outputs(hrv_manifest, pnum), hrv_output_dir, hrv_store_path)
+    _, features_df, segments = hrvutils.process_hrv_participant(
+                                                        pnum, hrv_path, boundaries[row], interval_names,
+                                                        hrv_output_dir, features = bool(get_features),
+                                                        freq_domain = bool(freq_domain),
+                                                        to_store = hrv_store_path is not None,
+                                                        cache_dir = cache_dir,
+                                                        correct_artifacts = bool(correct_artifacts)
+                                                        )
+    if hrv_store_path is not None:
+        storeutils.write_segments(hrv_store_path, segments)
+    outputs = manifestutils.find_outputs([pnum], interval_names, ["hrv"], hrv_output_dir, hrv_store_path)
+    record_manifest(hrv_manifest_path, {pnum: entry}, outputs, settings = hrv_settings)
+    if get_features or correct_artifacts:
+        features_path = os.path.join(hrv_output_dir,"hrv_features.csv")
+        features_df = manifestutils.update_table(features_path, features_df, [pnum])
+        features_df.to_csv(features_path,index = False)
+    return True
+
+def process_e4(pnum, folder, row):
+    """
+    Cut out intervals from E4 signals (and get EDA features) for
+    one participant, same as get_eda_segments_e4.py.
+    """
+    # same pre-flight check as the batch script, repeated only when the files change
+    signal_paths = [os.path.join(e4_dir,folder,f"{signal}.csv") for signal in signals]
+    fingerprints = manifestutils.fingerprint_files(signal_paths, catalog)
+    if pnum not in preflight or preflight[pnum][0] != fingerprints:
+        length_df = e4utils.check_recording_lengths(e4_dir, [folder], signals, min_session_secs)
+        for signal, status in zip(length_df.signal, length_df.status):
+            if status != "ok":
+                print(f"{signal} recording for participant {pnum} is {status}. Manual check advised.")
+        preflight[pnum] = (fingerprints, length_df.signal[length_df.status == "ok"].tolist())
+    ok_signals = preflight[pnum][1]
+    e4_manifest = manifestutils.load_manifest(e4_manifest_path)
+    if not ok_signals:
+        # no usable recording: drop outputs from earlier runs, as the batch script does
+        if str(int(pnum)) in e4_manifest["entries"]:
+            manifestutils.remove_outputs(manifestutils.get_outputs(e4_manifest, pnum), e4_output_dir, e4_store_path)
+            record_manifest(e4_manifest_path, {}, {}, [pnum], settings = e4_settings)
+            if get_features:
+                features_path = os.path.join(e4_output_dir,"eda_features.csv")
+                features_df = manifestutils.update_table(features_path, None, [pnum])
+                if features_df is not None:
+                    features_df.to_csv(features_path,index = False)
+            return True
+        return None
+    entry = manifestutils.make_entry(
+                                    {path: fingerprints[path] for path in signal_paths
+                                    if os.path.basename(path)[:-4] in ok_signals},
+                                    boundaries[row], str(firstbeat_starts[row])
+                                    )
+    if not manifestutils.is_changed(e4_manifest, pnum, entry, e4_settings):
+        return None
+    manifestutils.remove_outputs(manifestutils.get_outputs(e4_manifest, pnum), e4_output_dir, e4_store_path)
+    segments, _, samp_rates = e4utils.segment_e4_participant(
+                                                os.path.join(e4_dir,folder), pnum,
+                                                boundaries[row], interval_names,
+                                                reference_time = firstbeat_starts[row],
+                                                signals = ok_signals
+                                                )
+    if e4_store_path is not None:
+        storeutils.write_segments(e4_store_path, segments)
+    else:
+        for signal, interval_name, _, values in segments:
+            e4utils.write_segment_csv(e4_output_dir, signal, interval_name, pnum, values)
+    outputs = manifestutils.find_outputs(
+                                        [pnum], interval_names, [signal.lower() for signal in signals],
+                                        e4_output_dir, e4_store_path
+                                        )
+    record_manifest(e4_manifest_path, {pnum: entry}, outputs, settings = e4_settings)
+    if get_features:
+        features_path = os.path.join(e4_output_dir,"eda_features.csv")
+        features_df = e4utils.get_eda_features(
+                                                [seg for seg in segments if seg[0] == "eda"],
+                                                {pnum: samp_rates.get("EDA")},
+                                                interval_names = interval_names,
+                                                pnums = [pnum] if "EDA" in samp_rates else []
+                                                )
+        features_df = manifestutils.update_table(features_path, features_df, [pnum])
+        features_df.to_csv(features_path,index = False)
+    return True
+
+def process_tags(pnum, tags_path):
+    """
+    Double tag checks for one participant.
+    """
+    entry = manifestutils.make_entry(manifestutils.fingerprint_files([tags_path], catalog))
+    if not manifestutils.is_changed(manifestutils.load_manifest(tag_manifest_path), pnum, entry, tag_settings):
+        return None
+    qc = e4utils.get_tag_qc(e4utils.read_tags(tags_path), pnum, double_thresh, min_tags)
+    if qc["check"]:
+        print(f"Participant {pnum} has {qc['n_tags']} tags and {qc['n_doubles']} double tags. Manual check advised.")
+    qc_path = os.path.join(e4_output_dir,"tag_qc.csv")
+    qc_df = manifestutils.update_table(qc_path, pd.DataFrame([qc]), [pnum])
+    qc_df.to_csv(qc_path,index = False)
+    record_manifest(tag_manifest_path, {pnum: entry}, {}, settings = tag_settings)
+    return True
+
+
+if __name__ == "__main__":
+    for output_dir in [hrv_output_dir, e4_output_dir]:
+        os.makedirs(output_dir, exist_ok = True)
+    tag_settings = {"double_thresh": double_thresh, "min_tags": min_tags}
+    # E4 pre-flight results per participant: (signal file fingerprints, signals that passed)
+    preflight = {}
+    # jobs that failed: (participant, step): input fingerprints at the time,
+    # not retried until their files (or the qualtrics export) change
+    failed = {}
+
+    previous = {}
+    qualtrics_fingerprint = None
+    poll = 0
+    print(f"Watching {hrv_dir}, {e4_dir} and {qualtrics_path}. Press ctrl+c to stop.")
+    try:
+        while True:
+            poll_start = time.time()
+            try:
+                catalog = catalogutils.refresh_catalog(
+                                                    {"firstbeat": hrv_dir, "e4": e4_dir, "qualtrics": main_dir},
+                                                    catalog_path
+                                                    )
+            except OSError as err:
+                # eg network drive not available
+                warnings.warn(f"Could not scan input directories ({err}). Trying again at next poll.")
+                poll += 1
+                if n_polls and poll >= n_polls:
+                    break
+                time.sleep(poll_secs)
+                continue
+            snapshot = watchutils.snapshot_files(catalog)
+            stable = watchutils.find_stable(snapshot, previous, settle_secs)
+            previous = snapshot
+
+            # (re)load interval times once the qualtrics export has settled
+            if qualtrics_path in stable and snapshot[qualtrics_path] != qualtrics_fingerprint:
+                try:
+                    boundaries, pnum_rows, interval_names, firstbeat_starts, _ = hrvutils.load_interval_table(qualtrics_path)
+                    qualtrics_fingerprint = snapshot[qualtrics_path]
+                    hrv_settings = {
+                                    "intervals": interval_names, "output_format": output_format,
+                                    "features": get_features, "freq_domain": freq_domain,
+                                    "correct_artifacts": correct_artifacts
+                                    }
+                    e4_settings = {
+                                "intervals": interval_names, "output_format": output_format,
+                                "signals": signals, "features": get_features,
+                                "min_session_secs": min_session_secs
+                                }
+                except Exception as err:
+                    warnings.warn(f"Could not read qualtrics file ({err}). Trying again at next poll.")
+
+            if qualtrics_fingerprint is not None:
+                jobs = []
+                for pnum in catalogutils.get_pnums(catalog, "firstbeat"):
+                    hrv_path = catalogutils.get_path(catalog, "firstbeat", pnum)
+                    if pnum in pnum_rows and hrv_path in stable:
+                        jobs.append((pnum, [hrv_path], process_hrv, (pnum, hrv_path, pnum_rows[pnum])))
+                e4_duplicates = catalogutils.get_duplicates(catalog, "e4")
+                files_by_folder = {}
+                for path in snapshot:
+                    files_by_folder.setdefault(os.path.dirname(path), []).append(path)
+                for pnum in catalogutils.get_pnums(catalog, "e4"):
+                    if pnum in e4_duplicates:
+                        continue
+                    folder_path = catalogutils.get_path(catalog, "e4", pnum)
+                    folder = os.path.basename(folder_path)
+                    # wait for the whole folder to settle
+                    folder_files = files_by_folder.get(folder_path, [])
+                    if not folder_files or not stable.issuperset(folder_files):
+                        continue
+                    tags_path = os.path.join(folder_path,"tags.csv")
+                    if tags_path in stable:
+                        jobs.append((pnum, [tags_path], process_tags, (pnum, tags_path)))
+                    if pnum in pnum_rows:
+                        jobs.append((pnum, folder_files, process_e4, (pnum, folder, pnum_rows[pnum])))
+
+                # one participant at a time, as soon as their files are complete
+                for pnum, paths, process, args in jobs:
+                    step = process.__name__.replace("process_","")
+                    inputs = ([snapshot.get(path) for path in paths], qualtrics_fingerprint)
+                    if failed.get((pnum, step)) == inputs:
+                        continue
+                    start = time.time()
+                    try:
+                        status = "ok" if process(*args) else None
+                        failed.pop((pnum, step), None)
+                    except Exception as err:
+                        # log and carry on with the next participant, the watcher keeps running
+                        failed[(pnum, step)] = inputs
+                        status = f"{type(err).__name__}: {err}"
+                        print(f"Processing participant {pnum} ({step}) failed ({status}). Skipped until its files change, manual check advised.")
+                    # nothing changed since last processed
+                    if status is None:
+                        continue
+                    end = time.time()
+                    landed = watchutils.get_landed_time(snapshot, paths)
+                    if status == "ok":
+                        print(f"Participant {pnum} ({step}) done in {end-start:.1f} secs, {end-landed:.0f} secs after upload.")
+                    watchutils.log_event(
+                                        log_path, time = pd.Timestamp(end, unit = "s"),
+                                        participant_number = pnum, step = step,
+                                        secs_processing = end-start, secs_since_upload = end-landed,
+                                        status = status
+                                        )
+
+            poll += 1
+            if n_polls and poll >= n_polls:
+                break
+            time.sleep(max(0, poll_secs-(time.time()-poll_start)))
+    except KeyboardInterrupt:
+        print("Stopped watching.")